@@ -1,16 +1,27 @@
 from __future__ import absolute_import, division, print_function
-from collections import Counter, defaultdict
+import os.path
+import time
+import copy
+import logging
+from collections import Counter, defaultdict, deque
 from decimal import Decimal
 from operator import itemgetter
+from threading import Lock, RLock
 
 from manhattan import visitor
 
 from .rollups import AllRollup, LocalDayRollup, LocalWeekRollup, BrowserRollup
-from .cache import DeferredLRUCache
-from .model import VisitorHistory, Test, Goal
+from .cache import DeferredLRUCache, QueryCache
+from .complexgoals import ComplexGoalIndex
+from .fanout import FanoutConfig
+from .model import (VisitorHistory, Test, Goal, encode_history,
+                    decode_history)
+from .bloom import BloomFilter
+from .flush import FlushBatch, FlushThread, FlushPolicy
 
 from .persistence.sql import SQLPersistentStore
 
+log = logging.getLogger(__name__)
 
 default_rollups = {
     'all': AllRollup(),
@@ -23,31 +34,334 @@ default_rollups = {
 class Backend(object):
 
     def __init__(self, sqlalchemy_url, rollups=None, complex_goals=None,
-                 flush_every=500, cache_size=2000):
+                 flush_every=500, cache_size=2000, cache_bytes=None,
+                 vid_filter_capacity=None, vid_filter_error_rate=0.01,
+                 vid_filter_path=None, background_flush=False,
+                 max_pending_flushes=2, flush_policy=None,
+                 query_cache_size=1000, dedup_lateness=None,
+                 pending_ttl=7 * 86400, max_pending_records=500,
+                 fanout=None, test_inactivity=None,
+                 test_timestamp_resolution=3600):
         self.rollups = rollups or default_rollups
         self.complex_goals = complex_goals or []
+        self.complex_goal_index = ComplexGoalIndex(self.complex_goals)
+        self.fanout = fanout or FanoutConfig()
+        self.fanout.check(self.rollups)
 
         self.store = store = SQLPersistentStore(sqlalchemy_url)
 
-        self.visitors = DeferredLRUCache(get_backend=store.get_visitor_history,
-                                         put_backend=store.put_visitor_history,
-                                         max_size=cache_size)
-        self.tests = DeferredLRUCache(get_backend=store.get_test,
+        # Visitor histories vary a lot in size, so the visitor cache can be
+        # limited by estimated size in bytes. It is segmented so that replaying
+        # lots of one-time visitors doesn't evict the returning ones.
+        self.visitors = DeferredLRUCache(
+            get_backend=self.get_visitor_history,
+            put_backend=store.put_visitor_history,
+            get_many_backend=self.get_visitor_histories,
+            max_size=None if cache_bytes else cache_size,
+            max_bytes=cache_bytes,
+            sizeof=VisitorHistory.approximate_size,
+            protected_fraction=0.8,
+            max_missing=cache_size)
+        self.tests = DeferredLRUCache(get_backend=self.get_test,
                                       put_backend=store.put_test,
                                       max_size=cache_size)
-        self.goals = DeferredLRUCache(get_backend=store.get_goal,
+        self.goals = DeferredLRUCache(get_backend=self.get_goal,
                                       put_backend=store.put_goal,
+                                      get_many_backend=self.get_goals,
                                       max_size=cache_size)
 
+        # Batches which have been flushed but not yet committed, oldest
+        # first. Reads check these before the persistent store. The lock is
+        # held while a batch is committed, and by queries which combine
+        # persisted and unflushed counters, so that they never see a batch
+        # twice or not at all.
+        self.inflight = deque()
+        self.flush_lock = RLock()
+
+        # Held while records are counted, so that queries from other threads
+        # can take a consistent copy of the current generation of counters.
+        # Never held while waiting for ``flush_lock``.
+        self.counter_lock = Lock()
+
+        # Results of queries against the persistent store, which only change
+        # when a batch is committed. Only used with flush_lock held.
+        self.query_cache = QueryCache(query_cache_size)
+        self.flusher = None
+        if background_flush:
+            self.flusher = FlushThread(self.write_batch, max_pending_flushes)
+            self.flusher.start()
+
         self.pointer = self.store.get_pointer()
         self.records_since_flush = 0
-        self.flush_every = flush_every
+        self.last_flush_time = time.time()
+        self.latest_timestamp = None
+        self.flush_policy = flush_policy or FlushPolicy(every=flush_every)
+
+        # Concluded tests get no more variant conversions, and are pruned from
+        # visitor histories as they are loaded. Tests are concluded with
+        # ``conclude_test()``, or by a flush once they have had no impression
+        # for ``test_inactivity`` seconds, if set. Either way they stay
+        # concluded until they are reopened with ``conclude_test()``.
+        self.test_inactivity = test_inactivity
+        self.concluded_tests = store.get_concluded_tests()
+        self.unflushed_concluded_tests = {}
+        # The latest impression timestamp of each test which hasn't been
+        # concluded, as of the last inactivity check, or None if every test
+        # needs to be read by the next check.
+        self.open_tests = None
+
+        # A test's ``last_timestamp`` is only written back when it has moved
+        # on by ``test_timestamp_resolution`` seconds, so that impressions of
+        # existing variants don't rewrite the test on every flush. The exact
+        # time of the latest impression of each test is kept here instead.
+        self.test_timestamp_resolution = test_timestamp_resolution
+        self.test_last_seen = {}
+
+        # If set, visitor history keys for time buckets which ended more than
+        # this many seconds before the latest record are pruned, on the
+        # assumption that records are never that late.
+        self.dedup_lateness = dedup_lateness
+
+        # Records from visitors who haven't loaded the pixel yet are kept
+        # apart from their histories, so that bots don't cause history
+        # writes. They expire ``pending_ttl`` seconds before the latest
+        # record, and at most ``max_pending_records`` of them are replayed.
+        self.pending_ttl = pending_ttl
+        self.max_pending_records = max_pending_records
+
+        # Optional Bloom filter of vids which have a persisted history, so
+        # that first-time visitors can skip the database lookup.
+        self.vid_filter_path = vid_filter_path
+        self.known_vids = None
+        if vid_filter_capacity:
+            self.known_vids = self.load_vid_filter(vid_filter_capacity,
+                                                   vid_filter_error_rate)
 
         self.reset_counters()
 
     def get_pointer(self):
         return self.pointer
 
+    def load_vid_filter(self, capacity, error_rate):
+        """
+        Load the known vid filter from ``vid_filter_path`` if it was saved at
+        the currently persisted pointer, otherwise build it by scanning the
+        stored visitor histories.
+        """
+        path = self.vid_filter_path
+        if path and os.path.exists(path):
+            try:
+                bf = BloomFilter.load(path)
+            except ValueError as e:
+                log.warn('Ignoring unreadable vid filter: %s', e)
+            else:
+                if ((bf.tag == (self.pointer or u'')) and
+                        (bf.capacity, bf.error_rate) == (capacity,
+                                                         error_rate)):
+                    log.info('Loaded vid filter from %s: %s', path,
+                             self.vid_filter_stats(bf))
+                    return bf
+                log.info('Vid filter at %s is stale, rebuilding.', path)
+
+        bf = BloomFilter(capacity, error_rate)
+        bf.update(self.store.iter_visitor_ids())
+        bf.update(self.store.iter_pending_visitor_ids())
+        log.info('Built vid filter: %s', self.vid_filter_stats(bf))
+        return bf
+
+    def vid_filter_stats(self, bf=None):
+        bf = bf or self.known_vids
+        if bf is None:
+            return None
+        if bf.count > bf.capacity:
+            log.warn('Vid filter is over capacity (%d > %d), increase '
+                     'vid_filter_capacity.', bf.count, bf.capacity)
+        return ('%d vids, %d MB, estimated false positive rate %0.4f' %
+                (bf.count, bf.num_bytes // (1024 * 1024),
+                 bf.false_positive_rate()))
+
+    def save_vid_filter(self):
+        """
+        Persist the known vid filter, tagged with the persisted pointer so
+        that it is only reused if no flushes happen after it is saved.
+        """
+        if self.known_vids is None or not self.vid_filter_path:
+            return
+        self.known_vids.tag = self.store.get_pointer() or u''
+        self.known_vids.save(self.vid_filter_path)
+        log.info('Saved vid filter to %s: %s', self.vid_filter_path,
+                 self.vid_filter_stats())
+
+    def is_new_visitor(self, vid):
+        """
+        Return True if ``vid`` definitely has no cached history, and no
+        persisted history or pending records. Always returns False if the
+        known vid filter is disabled.
+        """
+        return ((self.known_vids is not None) and
+                (vid not in self.visitors) and
+                (vid not in self.known_vids))
+
+    def cache_stats(self):
+        return {'visitors': self.visitors.stats(),
+                'tests': self.tests.stats(),
+                'goals': self.goals.stats(),
+                'queries': self.query_cache.stats()}
+
+    def get_visitor_history(self, vid):
+        for batch in reversed(list(self.inflight)):
+            if vid in batch.histories:
+                history = decode_history(batch.histories[vid])
+                break
+        else:
+            history = self.store.get_visitor_history(vid)
+        return self.prune_concluded_tests(history)
+
+    def get_visitor_histories(self, vids):
+        found = {}
+        missing = set(vids)
+        for batch in reversed(list(self.inflight)):
+            for vid in missing & set(batch.histories):
+                found[vid] = decode_history(batch.histories[vid])
+                missing.discard(vid)
+        found.update(self.store.get_visitor_histories(missing))
+        for history in found.itervalues():
+            self.prune_concluded_tests(history)
+        return found
+
+    def conclude_test(self, name, concluded=True):
+        """
+        Mark the test ``name`` as concluded, or reopen it if ``concluded`` is
+        False. This is persisted by the next flush.
+        """
+        if concluded:
+            self.concluded_tests.add(name)
+        else:
+            self.concluded_tests.discard(name)
+            self.open_tests = None
+        self.unflushed_concluded_tests[name] = concluded
+
+    def is_concluded(self, name):
+        """
+        Return True if the test ``name`` has been concluded.
+        """
+        return name in self.concluded_tests
+
+    def conclude_inactive_tests(self):
+        """
+        Conclude the tests which have had no impressions for
+        ``test_inactivity`` seconds before the latest record. This is checked
+        once per flush rather than for every conversion, and the result is
+        persisted, so that a late impression can't reverse it after visitor
+        histories have been pruned.
+
+        Every test is only read by the first check, and the first after a
+        test is reopened. Later checks use the tests which were still open,
+        and the tests created since.
+        """
+        if self.test_inactivity is None or self.latest_timestamp is None:
+            return
+        if self.open_tests is None:
+            self.open_tests = {name: last_timestamp
+                               for name, first_timestamp, last_timestamp
+                               in self.all_tests()}
+        cutoff = self.latest_timestamp - self.test_inactivity
+        open_tests = self.open_tests
+        for name, last_timestamp in open_tests.items():
+            last_timestamp = max(last_timestamp,
+                                 self.test_last_seen.get(name, 0))
+            if name in self.concluded_tests:
+                del open_tests[name]
+            elif last_timestamp < cutoff:
+                log.info('Concluding test %r, no impressions since %d',
+                         name, last_timestamp)
+                self.conclude_test(name)
+                del open_tests[name]
+
+    def test_last_timestamp(self, name, test):
+        """
+        Return the timestamp of the latest impression of a test, including
+        ones which haven't been written back to ``test``.
+        """
+        return max(test.last_timestamp,
+                   self.test_last_seen.get(name, test.last_timestamp))
+
+    def prune_concluded_tests(self, history):
+        """
+        Remove concluded tests from a visitor history's variants, along with
+        the keys of their variant conversions. Impression keys are kept, so
+        that visitors who see a concluded test again aren't counted twice.
+        """
+        concluded = set(test_name for test_name, selected in history.variants
+                        if self.is_concluded(test_name))
+        if concluded:
+            history.variants = set(
+                variant for variant in history.variants
+                if variant[0] not in concluded)
+            history.variant_conversion_keys = set(
+                key for key in history.variant_conversion_keys
+                if key[1] not in concluded)
+        return history
+
+    def get_test(self, name):
+        for batch in reversed(list(self.inflight)):
+            if name in batch.tests:
+                return copy.deepcopy(batch.tests[name])
+        return self.store.get_test(name)
+
+    def get_goal(self, name):
+        for batch in reversed(list(self.inflight)):
+            if name in batch.goals:
+                return copy.deepcopy(batch.goals[name])
+        return self.store.get_goal(name)
+
+    def get_goals(self, names):
+        found = {}
+        missing = set(names)
+        for batch in reversed(list(self.inflight)):
+            for name in missing & set(batch.goals):
+                found[name] = copy.deepcopy(batch.goals[name])
+                missing.discard(name)
+        if missing:
+            found.update(self.store.get_goals(missing))
+        return found
+
+    def unflushed_counter_keys(self):
+        return (len(self.inc_conversions) + len(self.inc_values) +
+                len(self.inc_variant_conversions) +
+                len(self.inc_variant_values) + len(self.inc_impressions))
+
+    def unflushed_history_bytes(self):
+        """
+        Estimate the size of the visitor histories which will be written by
+        the next flush, from the average size of the cached histories.
+        """
+        cache = self.visitors
+        if not len(cache):
+            return 0
+        return ((len(cache.dirty) + len(cache.pending)) *
+                cache.total_bytes // len(cache))
+
+    def persisted(self, method, *args):
+        """
+        Return the result of ``self.store.<method>(*args)``, from the query
+        cache if possible. Must be called with ``flush_lock`` held, and the
+        result must not be modified.
+        """
+        return self.query_cache.get(
+            (method,) + args,
+            lambda: getattr(self.store, method)(*args))
+
+    def unflushed_count(self, counter, key):
+        """
+        Return the unpersisted part of the counter named ``counter``, both in
+        the current generation and in batches which are being flushed.
+        """
+        total = getattr(self, counter).get(key, 0)
+        for batch in list(self.inflight):
+            total += getattr(batch, counter).get(key, 0)
+        return total
+
     def reset_counters(self):
         self.inc_conversions = Counter()
         self.inc_values = defaultdict(Decimal)
@@ -57,105 +371,225 @@ class Backend(object):
 
         self.inc_impressions = Counter()
 
+        self.pending_records = defaultdict(list)
+        self.replayed_vids = set()
+
+    def prefetch(self, vids):
+        """
+        Load the histories for a batch of upcoming visitor IDs into the cache
+        with a single query, so that handling the corresponding records
+        doesn't need a query per record.
+        """
+        vids = [vid for vid in set(vids)
+                if (vid not in self.visitors) and
+                not self.is_new_visitor(vid)]
+        if vids:
+            self.visitors.get_many(vids)
+
     def handle(self, rec, ptr):
-        try:
-            history = self.visitors.get(rec.vid)
-        except KeyError:
+        """
+        Handle one record, where ``ptr`` is the log pointer following it.
+        """
+        self.handle_record(rec)
+        self.records_handled(1, ptr, float(rec.timestamp))
+
+    def handle_batch(self, records, last_pointer):
+        """
+        Handle a list of records, where ``last_pointer`` is the log pointer
+        following the last of them. The histories are loaded a chunk of
+        records at a time, just before the chunk is handled, and the pointer
+        and flush policy are only updated once, after the last record.
+        """
+        if not records:
+            return
+        # Prefetched histories go into the cache's probationary segment, as
+        # do the new histories created while handling them, so each chunk
+        # gets half of it. Larger chunks would evict histories before use.
+        capacity = self.visitors.probationary_capacity()
+        chunk_size = len(records) if capacity is None else max(capacity // 2,
+                                                               1)
+        handle_record = self.handle_record
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start + chunk_size]
+            if len(chunk) > 1:
+                self.prefetch([rec.vid for rec in chunk])
+            for rec in chunk:
+                handle_record(rec)
+        self.records_handled(len(records), last_pointer,
+                             float(records[-1].timestamp))
+
+    def idle(self):
+        """
+        Called while waiting for more records, so that changes are still
+        flushed after the flush policy's ``interval`` when the log is quiet.
+        """
+        if self.flush_policy.should_flush_idle(self, time.time()):
+            self.flush()
+
+    def records_handled(self, num_records, ptr, timestamp):
+        self.pointer = ptr
+        self.records_since_flush += num_records
+        if self.flush_policy.should_flush(self, timestamp, time.time()):
+            self.flush()
+
+    def handle_record(self, rec):
+        if self.is_new_visitor(rec.vid):
             history = VisitorHistory()
+        else:
+            try:
+                history = self.visitors.get(rec.vid)
+            except KeyError:
+                history = VisitorHistory()
 
         if rec.key == 'pixel':
-            history.nonbot = True
-            for rec in history.nonbot_queue:
-                self.handle_nonbot(rec, history)
+            if not history.nonbot:
+                history.nonbot = True
+                # Histories from older versions may still have a queue.
+                queued = history.nonbot_queue + self.take_pending(rec.vid)
+                history.nonbot_queue = []
+                with self.counter_lock:
+                    for queued_rec in queued[-self.max_pending_records:]:
+                        self.handle_nonbot(queued_rec, history)
+            self.visitors.put(rec.vid, history)
 
         elif history.nonbot:
-            self.handle_nonbot(rec, history)
+            # Repeated events often change nothing, in which case the history
+            # doesn't need to be written again.
+            with self.counter_lock:
+                changed = self.handle_nonbot(rec, history)
+            if changed:
+                self.visitors.put(rec.vid, history)
 
         else:
-            history.nonbot_queue.append(rec)
-            # Limit nonbot queue to most recent 500 events.
-            del history.nonbot_queue[:-500]
+            pending = self.pending_records[rec.vid]
+            pending.append(rec)
+            del pending[:-self.max_pending_records]
 
-        self.visitors.put(rec.vid, history)
-        self.pointer = ptr
-        self.records_since_flush += 1
+        timestamp = float(rec.timestamp)
+        if (self.latest_timestamp is None or
+                timestamp > self.latest_timestamp):
+            self.latest_timestamp = timestamp
 
-        if self.records_since_flush > self.flush_every:
-            self.flush()
-            self.records_since_flush = 0
+    def take_pending(self, vid):
+        """
+        Return all of the pending records for ``vid``, oldest first, whether
+        persisted, in flight or unflushed, and arrange for the persisted ones
+        to be deleted by the next flush.
+        """
+        with self.flush_lock:
+            records = []
+            if not self.is_new_visitor(vid):
+                records.extend(self.store.get_pending_records(
+                    vid, limit=self.max_pending_records))
+            for batch in self.inflight:
+                records.extend(batch.pending_records.get(vid, ()))
+        records.extend(self.pending_records.pop(vid, ()))
+        self.replayed_vids.add(vid)
+        return records
 
     def handle_nonbot(self, rec, history):
+        """
+        Count a record from a visitor who has loaded the pixel. Returns True
+        if ``history`` was changed.
+        """
         assert rec.key in ('page', 'goal', 'split')
         ts = int(float(rec.timestamp))
         site_id = int(rec.site_id)
 
         if rec.key == 'page':
+            changed = ((rec.ip not in history.ips) or
+                       (rec.user_agent not in history.user_agents))
             history.ips.add(rec.ip)
             history.user_agents.add(rec.user_agent)
-            self.record_conversion(history,
-                                   vid=rec.vid,
-                                   name=u'viewed page',
-                                   timestamp=ts,
-                                   site_id=site_id)
+            if history.user_agent is None:
+                history.user_agent = rec.user_agent
+            return self.record_conversion(history,
+                                          vid=rec.vid,
+                                          name=u'viewed page',
+                                          timestamp=ts,
+                                          site_id=site_id) or changed
 
         elif rec.key == 'goal':
-            self.record_conversion(history,
-                                   vid=rec.vid,
-                                   name=rec.name,
-                                   timestamp=ts,
-                                   site_id=site_id,
-                                   value=rec.value,
-                                   value_type=rec.value_type,
-                                   value_format=rec.value_format)
+            return self.record_conversion(history,
+                                          vid=rec.vid,
+                                          name=rec.name,
+                                          timestamp=ts,
+                                          site_id=site_id,
+                                          value=rec.value,
+                                          value_type=rec.value_type,
+                                          value_format=rec.value_format)
 
         else:  # split
-            self.record_impression(history,
-                                   vid=rec.vid,
-                                   name=rec.test_name,
-                                   selected=rec.selected,
-                                   timestamp=ts,
-                                   site_id=site_id)
+            return self.record_impression(history,
+                                          vid=rec.vid,
+                                          name=rec.test_name,
+                                          selected=rec.selected,
+                                          timestamp=ts,
+                                          site_id=site_id)
 
     def record_impression(self, history, vid, name, selected, timestamp,
                           site_id):
+        """
+        Count an impression of a test variant. Returns True if ``history``
+        was changed.
+        """
         variant = name, selected
+        changed = variant not in history.variants
         history.variants.add(variant)
 
+        if timestamp > self.test_last_seen.get(name, timestamp - 1):
+            self.test_last_seen[name] = timestamp
+
+        # Tests are only written back when they actually change, since most
+        # impressions are of an existing variant.
         try:
             test = self.tests.get(name)
         except KeyError:
-            test = Test()
-            test.first_timestamp = timestamp
-
-        test.last_timestamp = timestamp
-        test.variants.add(variant)
-
-        self.tests.put(name, test)
+            test = Test(first_timestamp=timestamp, last_timestamp=timestamp,
+                        variants=set([variant]))
+            self.tests.put(name, test)
+            if self.open_tests is not None:
+                self.open_tests[name] = timestamp
+        else:
+            if ((variant not in test.variants) or
+                    (timestamp - test.last_timestamp >=
+                     self.test_timestamp_resolution)):
+                test.last_timestamp = max(test.last_timestamp, timestamp)
+                test.variants.add(variant)
+                self.tests.put(name, test)
 
         # Record this impression in appropriate time buckets both on the
         # history object and in the current incremental accumulators.
-        for rollup_key, rollup in self.rollups.iteritems():
-            bucket_id = rollup.get_bucket(timestamp, history)
+        for rollup_key, bucket_id in self.iter_rollups(
+                timestamp, history, self.fanout.rollups_for_test(name)):
             key = (name, selected, rollup_key, bucket_id, site_id)
             if key not in history.impression_keys:
                 history.impression_keys.add(key)
                 self.inc_impressions[key] += 1
+                changed = True
+        return changed
 
-    def iter_rollups(self, timestamp, history):
+    def iter_rollups(self, timestamp, history, rollup_keys=None):
+        """
+        Yield ``(rollup_key, bucket_id)`` for each rollup, or only for those
+        in ``rollup_keys`` if it isn't None.
+        """
         for rollup_key, rollup in self.rollups.iteritems():
-            bucket_id = rollup.get_bucket(timestamp, history)
-            yield rollup_key, bucket_id
+            if (rollup_keys is None) or (rollup_key in rollup_keys):
+                yield rollup_key, rollup.get_bucket(timestamp, history)
 
     def record_complex_goals(self, history, new_name, timestamp, site_id):
-        for complex_name, include, exclude in self.complex_goals:
+        for complex_name, include_rest, exclude_rest in \
+                self.complex_goal_index.affected(new_name):
             # If all goals have now been satisfied in the 'include' set,
             # trigger a +1 delta on this complex goal in the current
             # rollups, and track that as a complex goal conversion in this
             # visitor history.
-            if (new_name in include) and (history.goals >= include):
+            if (include_rest is not None) and (history.goals >= include_rest):
                 new_keys = []
-                for rollup_key, bucket_id in self.iter_rollups(timestamp,
-                                                               history):
+                for rollup_key, bucket_id in self.iter_rollups(
+                        timestamp, history,
+                        self.fanout.rollups_for_goal(complex_name)):
                     conv_key = (complex_name, rollup_key, bucket_id, site_id)
                     new_keys.append(conv_key)
                     self.inc_conversions[conv_key] += 1
@@ -164,87 +598,224 @@ class Backend(object):
             # If we are adding the first goal in the 'exclude' set, trigger
             # a -1 delta for all conversions on that complex goal in the
             # visitory history.
-            if history.goals & exclude == set([new_name]):
+            if ((exclude_rest is not None) and
+                    history.goals.isdisjoint(exclude_rest)):
                 for key in history.complex_keys.pop(complex_name, []):
                     self.inc_conversions[key] -= 1
 
     def record_conversion(self, history, vid, name, timestamp, site_id,
                           value=None, value_type='', value_format=''):
-        try:
-            goal = self.goals.get(name)
-        except KeyError:
-            goal = Goal()
-            goal.value_type = value_type
-            goal.value_format = value_format
-
-        self.goals.put(name, goal)
+        """
+        Count a goal conversion. Returns True if ``history`` was changed.
+        """
+        # A goal never changes once it has been created, so it is only
+        # written the first time it is seen.
+        if name not in self.goals:
+            try:
+                self.goals.get(name)
+            except KeyError:
+                self.goals.put(name, Goal(value_type=value_type,
+                                          value_format=value_format))
 
         if value:
             value = Decimal(value)
 
+        changed = False
         if name not in history.goals:
             history.goals.add(name)
+            changed = True
             # If this is a 'new' goal for this visitor, process complex
             # conversion goals.
             self.record_complex_goals(history, name, timestamp, site_id)
 
+        fanout = self.fanout
+        variants = [(test_name, selected, fanout.rollups_for_test(test_name))
+                    for test_name, selected in history.variants
+                    if fanout.counts_variant(name, test_name) and
+                    not self.is_concluded(test_name)]
+
         # Record this goal conversion in appropriate time buckets both on the
         # history object and in the current incremental accumulators.
-        for rollup_key, bucket_id in self.iter_rollups(timestamp, history):
+        for rollup_key, bucket_id in self.iter_rollups(
+                timestamp, history, fanout.rollups_for_goal(name)):
 
             conv_key = (name, rollup_key, bucket_id, site_id)
             if conv_key not in history.conversion_keys:
                 history.conversion_keys.add(conv_key)
                 self.inc_conversions[conv_key] += 1
+                changed = True
             if value:
                 self.inc_values[conv_key] += value
 
-            for test_name, selected in history.variants:
+            for test_name, selected, test_rollups in variants:
+                if (test_rollups is not None) and (rollup_key not in
+                                                   test_rollups):
+                    continue
                 vc_key = (name, test_name, selected, rollup_key, bucket_id,
                           site_id)
                 if vc_key not in history.variant_conversion_keys:
                     history.variant_conversion_keys.add(vc_key)
                     self.inc_variant_conversions[vc_key] += 1
+                    changed = True
                 if value:
                     self.inc_variant_values[vc_key] += value
+        return changed
 
-    def flush(self):
+    def prune_history(self, history, cutoff, closed):
+        """
+        Remove the conversion and impression keys of ``history`` for rollup
+        buckets which ended before ``cutoff``. ``closed`` is a dict used to
+        remember whether each ``(rollup_key, bucket_id)`` has ended.
+        """
+        for keys in (history.conversion_keys, history.impression_keys,
+                     history.variant_conversion_keys):
+            stale = []
+            for key in keys:
+                bucket = key[-3:-1]
+                is_closed = closed.get(bucket)
+                if is_closed is None:
+                    rollup = self.rollups.get(bucket[0])
+                    bucket_end = getattr(rollup, 'bucket_end', None)
+                    is_closed = closed[bucket] = (
+                        bucket_end is not None and
+                        bucket_end(bucket[1]) < cutoff)
+                if is_closed:
+                    stale.append(key)
+            keys.difference_update(stale)
+
+    def freeze(self):
+        """
+        Move everything which has changed since the last flush into a new
+        ``FlushBatch``, and start a fresh generation of counters.
+        """
+        self.conclude_inactive_tests()
+        histories = self.visitors.take_unflushed()
+        if (self.dedup_lateness is not None and
+                self.latest_timestamp is not None):
+            cutoff = self.latest_timestamp - self.dedup_lateness
+            closed = {}
+            for history in histories.itervalues():
+                self.prune_history(history, cutoff, closed)
+        pending_records = dict(self.pending_records)
+        if self.known_vids is not None:
+            self.known_vids.update(histories)
+            self.known_vids.update(pending_records)
+        expire_pending_before = None
+        if self.pending_ttl is not None and self.latest_timestamp is not None:
+            expire_pending_before = int(self.latest_timestamp -
+                                        self.pending_ttl)
+
+        # Histories, tests and goals are copied, since they will continue to
+        # be modified by record handling while the batch is written.
+        batch = FlushBatch(
+            pointer=self.pointer,
+            histories={vid: encode_history(history)
+                       for vid, history in histories.iteritems()},
+            tests=copy.deepcopy(self.tests.take_unflushed()),
+            goals=copy.deepcopy(self.goals.take_unflushed()),
+            inc_conversions=self.inc_conversions,
+            inc_values=self.inc_values,
+            inc_variant_conversions=self.inc_variant_conversions,
+            inc_variant_values=self.inc_variant_values,
+            inc_impressions=self.inc_impressions,
+            pending_records=pending_records,
+            replayed_vids=self.replayed_vids,
+            expire_pending_before=expire_pending_before,
+            concluded_tests=self.unflushed_concluded_tests)
+        self.unflushed_concluded_tests = {}
+
+        with self.flush_lock:
+            self.inflight.append(batch)
+            self.reset_counters()
+        self.records_since_flush = 0
+        self.last_flush_time = time.time()
+        return batch
+
+    def write_batch(self, batch):
+        """
+        Write a batch and its pointer to the persistent store in a single
+        transaction.
+        """
         self.store.begin()
+        try:
+            self.store.put_visitor_history(batch.histories)
+            self.store.put_test(batch.tests)
+            self.store.put_goal(batch.goals)
+            self.store.put_concluded_tests(batch.concluded_tests)
 
-        self.visitors.flush()
-        self.tests.flush()
-        self.goals.flush()
+            self.store.append_pending_records(batch.pending_records)
+            self.store.delete_pending_records(batch.replayed_vids)
+            if batch.expire_pending_before is not None:
+                self.store.expire_pending_records(batch.expire_pending_before)
 
-        # Add local counter state onto existing persisted counters.
-        self.store.increment_conversion_counters(self.inc_conversions,
-                                                 self.inc_values)
-        self.store.increment_impression_counters(self.inc_impressions)
-        self.store.increment_variant_conversion_counters(
-            self.inc_variant_conversions, self.inc_variant_values)
-        self.reset_counters()
+            # Add local counter state onto existing persisted counters.
+            self.store.increment_conversion_counters(batch.inc_conversions,
+                                                     batch.inc_values)
+            self.store.increment_impression_counters(batch.inc_impressions)
+            self.store.increment_variant_conversion_counters(
+                batch.inc_variant_conversions, batch.inc_variant_values)
+
+            self.store.update_pointer(batch.pointer)
+        except Exception:
+            self.store.rollback()
+            raise
+
+        with self.flush_lock:
+            self.store.commit()
+            assert self.inflight[0] is batch
+            self.inflight.popleft()
+            self.query_cache.clear()
+
+    def flush(self):
+        """
+        Persist everything which has changed since the last flush. With
+        ``background_flush``, the write is handed to the flush thread, and
+        this only blocks if ``max_pending_flushes`` batches are already
+        waiting to be written.
+        """
+        batch = self.freeze()
+        if self.flusher:
+            self.flusher.submit(batch)
+        else:
+            self.write_batch(batch)
+
+    def wait_for_flushes(self):
+        """
+        Block until all background flushes have been committed.
+        """
+        if self.flusher:
+            self.flusher.drain()
 
-        self.store.update_pointer(self.pointer)
-        self.store.commit()
+    def close(self):
+        """
+        Finish any background flushes, and save the known vid filter.
+        """
+        if self.flusher:
+            self.flusher.drain()
+            self.flusher.stop()
+            self.flusher = None
+        self.save_vid_filter()
 
     def count(self, goal=None, variant=None, rollup_key='all', bucket_id=0,
               site_id=None):
         assert goal or variant, "must specify goal or variant"
 
-        if goal and variant:
-            test_name, selected = variant
-            key = goal, test_name, selected, rollup_key, bucket_id, site_id
-            local = self.inc_variant_conversions[key]
-            flushed = self.store.count_variant_conversions(*key)[0]
-        elif goal:
-            key = goal, rollup_key, bucket_id, site_id
-            local = self.inc_conversions[key]
-            flushed = self.store.count_conversions(*key)[0]
-        else:
-            # variant
-            name, selected = variant
-            key = name, selected, rollup_key, bucket_id, site_id
-            local = self.inc_impressions[key]
-            flushed = self.store.count_impressions(*key)
+        with self.flush_lock:
+            if goal and variant:
+                test_name, selected = variant
+                key = goal, test_name, selected, rollup_key, bucket_id, site_id
+                local = self.unflushed_count('inc_variant_conversions', key)
+                flushed = self.persisted('count_variant_conversions', *key)[0]
+            elif goal:
+                key = goal, rollup_key, bucket_id, site_id
+                local = self.unflushed_count('inc_conversions', key)
+                flushed = self.persisted('count_conversions', *key)[0]
+            else:
+                # variant
+                name, selected = variant
+                key = name, selected, rollup_key, bucket_id, site_id
+                local = self.unflushed_count('inc_impressions', key)
+                flushed = self.persisted('count_impressions', *key)
 
         return local + flushed
 
@@ -257,15 +828,16 @@ class Backend(object):
             return self.count(goal, variant, rollup_key=rollup_key,
                               bucket_id=bucket_id, site_id=site_id)
 
-        if variant:
-            test_name, selected = variant
-            key = goal, test_name, selected, rollup_key, bucket_id, site_id
-            local = self.inc_variant_values[key]
-            flushed = self.store.count_variant_conversions(*key)[1]
-        else:
-            key = goal, rollup_key, bucket_id, site_id
-            local = self.inc_values[key]
-            flushed = self.store.count_conversions(*key)[1]
+        with self.flush_lock:
+            if variant:
+                test_name, selected = variant
+                key = goal, test_name, selected, rollup_key, bucket_id, site_id
+                local = self.unflushed_count('inc_variant_values', key)
+                flushed = self.persisted('count_variant_conversions', *key)[1]
+            else:
+                key = goal, rollup_key, bucket_id, site_id
+                local = self.unflushed_count('inc_values', key)
+                flushed = self.persisted('count_conversions', *key)[1]
         value = local + Decimal(str(flushed))
 
         if goal_obj.value_type == visitor.SUM:
@@ -274,36 +846,215 @@ class Backend(object):
         elif goal_obj.value_type == visitor.AVERAGE:
             count = self.count(goal, variant, rollup_key=rollup_key,
                                bucket_id=bucket_id, site_id=site_id)
-            return value / count if count > 0 else 0
-
         else:
             # visitor.PER
             count = self.count(u'viewed page', variant,
                                rollup_key=rollup_key,
                                bucket_id=bucket_id, site_id=site_id)
-            return value / count if count > 0 else 0
+        return value / count if count > 0 else 0
 
     def all_tests(self):
         # Start with flushed.
-        all = self.store.all_tests()
+        with self.flush_lock:
+            all = dict(self.persisted('all_tests'))
+            for batch in self.inflight:
+                all.update(batch.tests)
         # Update from unflushed (so that dirty entries overwrite the flushed).
-        all.update(self.tests.entries)
+        all.update(self.tests.unflushed())
         # Sort by last timestamp descending.
-        all = [(name, test.first_timestamp, test.last_timestamp)
+        all = [(name, test.first_timestamp,
+                self.test_last_timestamp(name, test))
                for name, test in all.iteritems()]
         all.sort(key=itemgetter(2), reverse=True)
         return all
 
-    def results(self, test_name, goals, site_id=None):
-        # Return a dict: keys are populations, values are a list of values for
-        # the goals specified.
+    def get_goal_objs(self, goals):
+        goal_objs = self.goals.get_many(goals)
+        for goal in goals:
+            if goal not in goal_objs:
+                raise KeyError(goal)
+        return goal_objs
+
+    def goal_values(self, goals, goal_objs, get):
+        """
+        Compute the values of ``goals`` as returned by ``goal_value()``, where
+        ``get(goal)`` returns the ``(count, value)`` counters of a goal.
+        """
+        values = []
+        for goal in goals:
+            count, value = get(goal)
+            value_type = goal_objs[goal].value_type
+            if not value_type:
+                values.append(count)
+            elif value_type == visitor.SUM:
+                values.append(value)
+            else:
+                if value_type == visitor.PER:
+                    count = get(u'viewed page')[0]
+                values.append(value / count if count > 0 else 0)
+        return values
+
+    def value_names(self, goals, goal_objs):
+        """
+        Return the names of the goals whose counters are needed to compute the
+        values of ``goals``.
+        """
+        names = set(goals)
+        if any(goal_objs[goal].value_type == visitor.PER for goal in goals):
+            names.add(u'viewed page')
+        return tuple(sorted(names))
+
+    def results(self, test_name, goals, site_id=None, rollup_key='all',
+                bucket_id=0):
+        """
+        Return a dict mapping each population of a test to a list of the
+        values of ``goals``, as returned by ``goal_value()``. All of the
+        counters are fetched with one query.
+        """
+        test = self.tests.get(test_name)
+        goal_objs = self.get_goal_objs(goals)
+
+        with self.flush_lock:
+            flushed = self.persisted('count_test_variant_conversions',
+                                     test_name,
+                                     self.value_names(goals, goal_objs),
+                                     rollup_key, bucket_id, site_id)
+
+            ret = {}
+            for _, selected in test.variants:
+                def get(goal):
+                    key = (goal, test_name, selected, rollup_key, bucket_id,
+                           site_id)
+                    count, value = flushed.get((goal, selected), (0, 0))
+                    count += self.unflushed_count('inc_variant_conversions',
+                                                  key)
+                    value = (self.unflushed_count('inc_variant_values', key) +
+                             Decimal(str(value)))
+                    return count, value
+
+                ret[selected] = self.goal_values(goals, goal_objs, get)
+
+        return ret
+
+    def unflushed_series(self, counter, prefixes, site_id, start, end):
+        """
+        Return a dict mapping ``(prefix, bucket_id)`` to the unpersisted part
+        of the counters named ``counter`` whose keys are ``prefix +
+        (bucket_id, site_id)``, for each of ``prefixes``, with time buckets in
+        the range ``[start, end)``. Like persisted series, buckets which
+        aren't whole numbers are skipped. Must be called with ``flush_lock``
+        held.
+        """
+        # The current generation is still being counted into by the worker,
+        # so it is copied, while batches in flight no longer change.
+        with self.counter_lock:
+            current = getattr(self, counter).items()
+        generations = [current] + [getattr(batch, counter).iteritems()
+                                   for batch in self.inflight]
+        totals = defaultdict(int)
+        for items in generations:
+            for key, delta in items:
+                prefix, bucket_id = key[:-2], key[-2]
+                if ((key[-1] != site_id) or (prefix not in prefixes) or
+                        isinstance(bucket_id, basestring) or
+                        (bucket_id != int(bucket_id)) or
+                        (start is not None and bucket_id < start) or
+                        (end is not None and bucket_id >= end)):
+                    continue
+                totals[prefix, bucket_id] += delta
+        return totals
+
+    def count_series(self, goal=None, variant=None, rollup_key='pst_day',
+                     start=None, end=None, site_id=None):
+        """
+        Like ``count()``, for every time bucket of a rollup whose start is in
+        the range ``[start, end)``. Returns a list of ``(bucket_id, count)``
+        pairs sorted by bucket, omitting buckets which have no counts.
+        """
+        assert goal or variant, "must specify goal or variant"
+
+        with self.flush_lock:
+            if goal and variant:
+                test_name, selected = variant
+                prefix = goal, test_name, selected, rollup_key
+                flushed = self.persisted('test_variant_conversion_series',
+                                         test_name, (goal,), rollup_key,
+                                         site_id, start, end)
+                flushed = {bucket_id: value[0]
+                           for (_, sel, bucket_id), value
+                           in flushed.iteritems() if sel == selected}
+                counter = 'inc_variant_conversions'
+            elif goal:
+                prefix = goal, rollup_key
+                flushed = self.persisted('conversion_series', goal,
+                                         rollup_key, site_id, start, end)
+                flushed = {bucket_id: value[0]
+                           for bucket_id, value in flushed.iteritems()}
+                counter = 'inc_conversions'
+            else:
+                # variant
+                name, selected = variant
+                prefix = name, selected, rollup_key
+                flushed = dict(self.persisted('impression_series', name,
+                                              selected, rollup_key, site_id,
+                                              start, end))
+                counter = 'inc_impressions'
+            local = self.unflushed_series(counter, set([prefix]), site_id,
+                                          start, end)
+
+        for (_, bucket_id), delta in local.iteritems():
+            flushed[bucket_id] = flushed.get(bucket_id, 0) + delta
+        return sorted(flushed.iteritems())
+
+    def results_series(self, test_name, goals, rollup_key='pst_day',
+                       start=None, end=None, site_id=None):
+        """
+        Like ``results()``, for every time bucket of a rollup whose start is
+        in the range ``[start, end)``. Returns a dict mapping each population
+        of the test to a list of ``(bucket_id, values)`` pairs sorted by
+        bucket, omitting buckets which have no counts for that population.
+        All of the counters are fetched with one query.
+        """
         test = self.tests.get(test_name)
+        goal_objs = self.get_goal_objs(goals)
+        names = self.value_names(goals, goal_objs)
+
+        with self.flush_lock:
+            flushed = self.persisted('test_variant_conversion_series',
+                                     test_name, names, rollup_key, site_id,
+                                     start, end)
+            prefixes = set((name, test_name, selected, rollup_key)
+                           for name in names
+                           for _, selected in test.variants)
+            local_counts = self.unflushed_series('inc_variant_conversions',
+                                                 prefixes, site_id, start,
+                                                 end)
+            local_values = self.unflushed_series('inc_variant_values',
+                                                 prefixes, site_id, start,
+                                                 end)
+
+        buckets = defaultdict(set)
+        for name, selected, bucket_id in flushed:
+            buckets[selected].add(bucket_id)
+        for (prefix, bucket_id) in local_counts:
+            buckets[prefix[2]].add(bucket_id)
+        for (prefix, bucket_id) in local_values:
+            buckets[prefix[2]].add(bucket_id)
 
         ret = {}
-        for variant in test.variants:
-            values = []
-            for goal in goals:
-                values.append(self.goal_value(goal, variant, site_id=site_id))
-            ret[variant[1]] = values
+        for _, selected in test.variants:
+            series = []
+            for bucket_id in sorted(buckets[selected]):
+                def get(goal):
+                    prefix = goal, test_name, selected, rollup_key
+                    count, value = flushed.get((goal, selected, bucket_id),
+                                               (0, 0))
+                    count += local_counts.get((prefix, bucket_id), 0)
+                    value = (local_values.get((prefix, bucket_id), 0) +
+                             Decimal(str(value)))
+                    return count, value
 
+                series.append((bucket_id,
+                               self.goal_values(goals, goal_objs, get)))
+            ret[selected] = series
         return ret
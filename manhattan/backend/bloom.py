@@ -0,0 +1,125 @@
+from __future__ import absolute_import, division, print_function
+"""
+A simple Bloom filter, used by the backend to remember which visitor IDs have
+a stored history so that first-time visitors don't need a database lookup.
+"""
+
+import os
+import math
+import struct
+import hashlib
+
+
+class BloomFilter(object):
+    """
+    A probabilistic set membership structure. ``key in bf`` is always True for
+    keys which have been added, and False for most (but not all) keys which
+    have not.
+
+    The filter is sized from an expected number of keys and a target false
+    positive rate. At the defaults, it costs about 1.2 bytes per expected key,
+    so a filter for 500 million visitors uses roughly 600 MB.
+    """
+    magic = b'MHBF'
+    format_version = 1
+    header = struct.Struct('>4sBQdQH')
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        Create a new, empty Bloom filter.
+
+        :param capacity:
+            Number of keys the filter is expected to hold.
+        :type capacity:
+            int
+        :param error_rate:
+            Target false positive rate once ``capacity`` keys have been added.
+        :type error_rate:
+            float
+        """
+        assert capacity > 0
+        assert 0 < error_rate < 1
+        self.capacity = capacity
+        self.error_rate = error_rate
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                 (math.log(2) ** 2)))
+        self.num_bytes = (num_bits + 7) // 8
+        self.num_bits = self.num_bytes * 8
+        self.num_hashes = max(1, int(round((self.num_bits / capacity) *
+                                           math.log(2))))
+        self.bits = bytearray(self.num_bytes)
+        self.count = 0
+        self.tag = ''
+
+    def positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        # Kirsch-Mitzenmacher double hashing: derive all of the bit positions
+        # from two independent 64-bit hashes.
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        h2 |= 1
+        num_bits = self.num_bits
+        return [(h1 + ii * h2) % num_bits for ii in range(self.num_hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        new = False
+        for pos in self.positions(key):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self.positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def false_positive_rate(self):
+        """
+        Estimate the current false positive rate, based on the number of keys
+        which have been added so far.
+        """
+        k = self.num_hashes
+        return (1 - math.exp(-k * self.count / self.num_bits)) ** k
+
+    def save(self, path):
+        """
+        Write the filter to ``path``. The file is replaced atomically, so a
+        crash during the write leaves the previous version intact.
+        """
+        tag = self.tag.encode('utf-8')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.format_version,
+                                     self.capacity, self.error_rate,
+                                     self.count, len(tag)))
+            f.write(tag)
+            f.write(self.bits)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a filter previously written with ``save()``.
+        """
+        with open(path, 'rb') as f:
+            magic, version, capacity, error_rate, count, tag_len = \
+                cls.header.unpack(f.read(cls.header.size))
+            if magic != cls.magic or version != cls.format_version:
+                raise ValueError('%s is not a version %d Bloom filter' %
+                                 (path, cls.format_version))
+            bf = cls(capacity, error_rate)
+            bf.tag = f.read(tag_len).decode('utf-8')
+            if f.readinto(bf.bits) != bf.num_bytes:
+                raise ValueError('%s is truncated' % path)
+        bf.count = count
+        return bf
@@ -2,17 +2,34 @@ from __future__ import absolute_import, division, print_function
 from collections import OrderedDict
 
 
+_missing = object()
+
+
 class DeferredLRUCache(object):
     """
     An LRU cache with deferred (on-request) writing. When values put back into
     the cache, they are flagged as dirty, but are not written to the backend
     until ``.flush()`` is called. When the cache is flushed, all dirty values
-    will be written back. Note that ``.flush()`` must be called frequently
-    enough that the cache does not self-evict dirty values--this will fail.
+    will be written back. If a dirty value is evicted before the cache is
+    flushed, it is moved to a pending write buffer, which is checked by reads
+    and written back along with the dirty values on the next ``.flush()``.
+
+    The cache can be limited by number of entries, by estimated size in
+    bytes, or both. It can optionally be segmented: new entries go into a
+    probationary segment, and are promoted to a protected segment when they
+    are used again. Entries are evicted from the probationary segment first,
+    so a scan over many keys which are only used once (like a log replay)
+    can't push out the entries which are used repeatedly.
+
+    Keys which the persistent backend doesn't have are remembered too, for
+    up to ``max_missing`` keys, so that looking them up again doesn't query the
+    backend until they are put.
 
     This is NOT thread-safe.
     """
-    def __init__(self, get_backend, put_backend, max_size=2000):
+    def __init__(self, get_backend, put_backend, max_size=2000,
+                 get_many_backend=None, max_bytes=None, sizeof=None,
+                 protected_fraction=0, max_missing=2000):
         """
         Create a new LRU cache.
 
@@ -27,54 +44,376 @@ class DeferredLRUCache(object):
             Callable with the signature ``func(key, value)``. Return value is
             ignored.
         :param max_size:
-            Maximum number of entries to allow in the cache.
+            Maximum number of entries to allow in the cache, or None for no
+            limit.
         :type max_size:
             int
+        :param get_many_backend:
+            Optional function which fetches several values from the persistent
+            backend at once. If not supplied, ``get_many()`` will call
+            ``get_backend`` for each key.
+        :type get_many_backend:
+            Callable with the signature ``func(keys)``, returning a dict
+            mapping each key which was found to its value.
+        :param max_bytes:
+            Maximum total estimated size of the cached entries, or None for no
+            limit. Requires ``sizeof``.
+        :type max_bytes:
+            int
+        :param sizeof:
+            Function which estimates the size of a value in bytes. It is
+            called whenever a value is loaded or put into the cache.
+        :type sizeof:
+            Callable with the signature ``func(value)``, returning an int.
+        :param protected_fraction:
+            Fraction of the cache reserved for the protected segment. If 0,
+            the cache is a plain LRU.
+        :type protected_fraction:
+            float
+        :param max_missing:
+            Maximum number of keys to remember as missing from the persistent
+            backend, independent of ``max_size`` and ``max_bytes``.
+        :type max_missing:
+            int
         """
+        assert (max_bytes is None) or sizeof, "max_bytes requires sizeof"
+        assert 0 <= protected_fraction < 1
         self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.protected_fraction = protected_fraction
+        self.max_missing = max_missing
         self.get_backend = get_backend
         self.put_backend = put_backend
+        self.get_many_backend = get_many_backend
+
+        # Probationary segment (the whole cache, if it isn't segmented), and
+        # protected segment, each in LRU order.
         self.entries = OrderedDict()
+        self.protected = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.protected_bytes = 0
+
         self.dirty = set()
+        self.pending = {}
+
+        # Keys known not to exist in the persistent backend, in LRU order.
+        self.missing = OrderedDict()
+
+        # Keys loaded by ``get_many()`` which haven't been read since. Their
+        # first read doesn't count as reuse for promotion.
+        self.prefetched = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def __contains__(self, key):
+        return ((key in self.entries) or (key in self.protected) or
+                (key in self.pending))
+
+    def __len__(self):
+        return len(self.entries) + len(self.protected)
+
+    def stats(self):
+        """
+        Return a dict of counters describing the cache's effectiveness and
+        current size.
+        """
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / requests) if requests else 0,
+            'evictions': self.evictions,
+            'writebacks': self.writebacks,
+            'entries': len(self),
+            'protected': len(self.protected),
+            'bytes': self.total_bytes,
+            'dirty': len(self.dirty),
+            'pending': len(self.pending),
+            'missing': len(self.missing),
+        }
+
+    def _insert(self, key, value):
+        size = self.sizeof(value) if self.sizeof else 0
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.total_bytes += size
+
+    def _remove(self, key):
+        if key in self.protected:
+            value = self.protected.pop(key)
+            self.protected_bytes -= self.sizes[key]
+        else:
+            value = self.entries.pop(key)
+        self.total_bytes -= self.sizes.pop(key)
+        return value
+
+    def _remember_missing(self, key):
+        missing = self.missing
+        missing.pop(key, None)
+        missing[key] = True
+        if len(missing) > self.max_missing:
+            missing.popitem(last=False)
+
+    def _touch(self, key, value, promote):
+        """
+        Move a cached entry to the most recently used position of its
+        segment. If ``promote`` is set and the cache is segmented, move a
+        probationary entry to the protected segment.
+        """
+        if key in self.protected:
+            del self.protected[key]
+            self.protected[key] = value
+        elif promote and self.protected_fraction:
+            del self.entries[key]
+            self.protected[key] = value
+            self.protected_bytes += self.sizes[key]
+            self.demote()
+        else:
+            del self.entries[key]
+            self.entries[key] = value
+
+    def _resize(self, key, value):
+        size = self.sizeof(value)
+        delta = size - self.sizes[key]
+        self.sizes[key] = size
+        self.total_bytes += delta
+        if key in self.protected:
+            self.protected_bytes += delta
+
+    def demote(self):
+        """
+        Move the least recently used protected entries back to the
+        probationary segment, until the protected segment is within its share
+        of the cache.
+        """
+        protected = self.protected
+        while protected and (
+                ((self.max_size is not None) and
+                 (len(protected) > self.max_size * self.protected_fraction)) or
+                ((self.max_bytes is not None) and
+                 (self.protected_bytes >
+                  self.max_bytes * self.protected_fraction))):
+            key, value = protected.popitem(last=False)
+            self.protected_bytes -= self.sizes[key]
+            self.entries[key] = value
+
+    def probationary_capacity(self):
+        """
+        Return roughly how many entries fit in the probationary segment, based
+        on the average entry size if the cache is limited by bytes, or None
+        if it is unlimited. ``get_many()`` with more keys than this will
+        evict some of them before they are read.
+        """
+        fraction = self.protected_fraction
+        limits = []
+        if self.max_size is not None:
+            limits.append(self.max_size - int(self.max_size * fraction))
+        if (self.max_bytes is not None) and self.total_bytes:
+            average = self.total_bytes / len(self)
+            limits.append(int((self.max_bytes - self.max_bytes * fraction) /
+                              average))
+        if not limits:
+            return None
+        return max(min(limits), 1)
 
     def get(self, key):
         """
         Fetch a value from the cache, reading it from the persistent backend if
         necessary.
         """
-        try:
-            value = self.entries.pop(key)
-        except KeyError:
-            value = self.get_backend(key)
-        self.entries[key] = value
+        value = self.entries.get(key, self.protected.get(key, _missing))
+        if value is not _missing:
+            self.hits += 1
+            if key in self.prefetched:
+                self.prefetched.discard(key)
+                self._touch(key, value, promote=False)
+            else:
+                self._touch(key, value, promote=True)
+            return value
+
+        if key in self.pending:
+            self.hits += 1
+            value = self.pending.pop(key)
+            self.dirty.add(key)
+        elif key in self.missing:
+            self.hits += 1
+            self._remember_missing(key)
+            raise KeyError(key)
+        else:
+            self.misses += 1
+            try:
+                value = self.get_backend(key)
+            except KeyError:
+                self._remember_missing(key)
+                raise
+        self._insert(key, value)
         self.prune()
         return value
 
+    def get_many(self, keys):
+        """
+        Fetch several values from the cache, reading all of the ones which
+        aren't cached from the persistent backend in one call. Returns a dict
+        of the keys which were found; keys which don't exist in the backend
+        are omitted.
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self.entries:
+                found[key] = self.entries[key]
+            elif key in self.protected:
+                found[key] = self.protected[key]
+            elif key in self.pending:
+                found[key] = self.pending[key]
+            elif key not in self.missing:
+                missing.append(key)
+
+        if missing:
+            self.misses += len(missing)
+            if self.get_many_backend:
+                loaded = self.get_many_backend(missing)
+            else:
+                loaded = {}
+                for key in missing:
+                    try:
+                        loaded[key] = self.get_backend(key)
+                    except KeyError:
+                        pass
+            for key, value in loaded.iteritems():
+                self._insert(key, value)
+            for key in missing:
+                if key not in loaded:
+                    self._remember_missing(key)
+            self.prefetched.update(loaded)
+            found.update(loaded)
+            self.prune()
+
+        return found
+
     def put(self, key, value):
         """
         Put a value into the cache, flagging it as dirty to be written back to
         the persistent backend on the next ``flush()`` call.
         """
-        if key in self.entries:
-            self.entries.pop(key)
-        self.entries[key] = value
+        if (key in self.entries) or (key in self.protected):
+            if self.sizeof:
+                self._resize(key, value)
+            self._touch(key, value, promote=False)
+        else:
+            self.pending.pop(key, None)
+            self.missing.pop(key, None)
+            self._insert(key, value)
         self.dirty.add(key)
         self.prune()
 
+    def over_limit(self):
+        return (((self.max_size is not None) and
+                 (len(self) > self.max_size)) or
+                ((self.max_bytes is not None) and
+                 (self.total_bytes > self.max_bytes)))
+
     def prune(self):
         """
         Prune the cache object back down to the desired size, if it is larger.
+        Dirty values which are evicted are moved to the pending write buffer.
         """
-        while len(self.entries) > self.max_size:
-            key, value = self.entries.popitem(last=False)
-            assert key not in self.dirty
+        self.demote()
+        # Always keep the most recent entry, even if it is over the size
+        # limit by itself.
+        while self.over_limit() and len(self) > 1:
+            key = next(iter(self.entries or self.protected))
+            value = self._remove(key)
+            self.prefetched.discard(key)
+            self.evictions += 1
+            if key in self.dirty:
+                self.dirty.discard(key)
+                self.pending[key] = value
+                self.writebacks += 1
 
-    def flush(self):
+    def cached_value(self, key):
+        if key in self.protected:
+            return self.protected[key]
+        return self.entries[key]
+
+    def unflushed(self):
+        """
+        Return a dict of all values which have not yet been written to the
+        persistent backend.
+        """
+        to_put = dict(self.pending)
+        for key in self.dirty:
+            to_put[key] = self.cached_value(key)
+        return to_put
+
+    def take_unflushed(self):
         """
-        Flush dirty cache entries to the persistent backend.
+        Return a dict of all values which have not yet been written to the
+        persistent backend, and mark them as written. The caller becomes
+        responsible for writing them.
         """
-        to_put = {}
-        for key in list(self.dirty):
-            to_put[key] = self.entries[key]
-        self.put_backend(to_put)
+        to_put = self.unflushed()
         self.dirty = set()
+        self.pending = {}
+        return to_put
+
+    def flush(self):
+        """
+        Flush dirty cache entries and the pending write buffer to the
+        persistent backend.
+        """
+        self.put_backend(self.take_unflushed())
+
+
+class QueryCache(object):
+    """
+    An LRU cache of query results, for data which only changes at known
+    points. Call ``clear()`` whenever the underlying data changes.
+
+    This is NOT thread-safe.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, compute):
+        """
+        Return the cached result for ``key``, calling ``compute()`` to
+        produce it if it isn't cached.
+        """
+        entries = self.entries
+        try:
+            value = entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            if not self.max_size:
+                return value
+            if len(entries) >= self.max_size:
+                entries.popitem(last=False)
+        else:
+            self.hits += 1
+        entries[key] = value
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / requests) if requests else 0,
+            'entries': len(self),
+        }
@@ -0,0 +1,47 @@
+from __future__ import absolute_import, division, print_function
+"""
+Lookup structure for complex goals, which are converted by reaching every
+goal in an ``include`` set, and un-converted by later reaching any goal in an
+``exclude`` set.
+"""
+
+
+class ComplexGoalIndex(object):
+    """
+    Maps each goal name to the complex goals which it can affect, so that a
+    new conversion only checks those. For each of them, the goals *other*
+    than this one in its ``include`` and ``exclude`` sets are precomputed, so
+    that the check is against the rest of the visitor's progress only, and is
+    free for the common single-goal sets.
+    """
+    def __init__(self, complex_goals):
+        """
+        :param complex_goals:
+            Complex goal configuration, as a list of ``(complex_name,
+            include, exclude)``.
+        :type complex_goals:
+            list
+        """
+        self.complex_goals = list(complex_goals)
+        self.by_goal = {}
+        for complex_name, include, exclude in self.complex_goals:
+            for name in set(include) | set(exclude):
+                include_rest = exclude_rest = None
+                if name in include:
+                    include_rest = frozenset(include) - set([name])
+                if name in exclude:
+                    exclude_rest = frozenset(exclude) - set([name])
+                self.by_goal.setdefault(name, []).append(
+                    (complex_name, include_rest, exclude_rest))
+
+    def __len__(self):
+        return len(self.complex_goals)
+
+    def affected(self, name):
+        """
+        Return the complex goals which reaching ``name`` can affect, in
+        configuration order, as a list of ``(complex_name, include_rest,
+        exclude_rest)``. Each ``*_rest`` is the rest of the corresponding set
+        without ``name``, or None if ``name`` isn't in the set.
+        """
+        return self.by_goal.get(name, ())
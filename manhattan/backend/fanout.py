@@ -0,0 +1,76 @@
+from __future__ import absolute_import, division, print_function
+"""
+Configuration of which counters the backend keeps for each conversion and
+impression. By default, every goal and test is counted in every rollup, and
+every goal conversion is counted against every test variant the visitor has
+seen. Each of these multiplies the number of counter keys, so counters which
+will never be queried can be turned off here.
+"""
+
+
+class FanoutConfig(object):
+    """
+    Declares which rollups apply to which goals and tests, and which goal and
+    test pairs get variant conversion counters.
+
+    - ``goal_rollups`` maps goal names (including complex goals) to the
+      rollup keys they are counted in. Other goals use ``default_rollups``.
+    - ``test_rollups`` maps test names to the rollup keys their impressions
+      are counted in. Other tests use ``default_rollups``.
+    - ``default_rollups`` is the rollup keys for goals and tests which aren't
+      listed, or None for every rollup.
+    - ``variant_goals`` and ``variant_tests`` are the goal and test names
+      which get variant conversion counters, or None for all of them.
+      Variant conversions are counted in the rollups which apply to both the
+      goal and the test.
+
+    Queries for counters which aren't kept return zero, so leave the ``all``
+    rollup enabled for anything which is shown in results.
+    """
+    def __init__(self, goal_rollups=None, test_rollups=None,
+                 default_rollups=None, variant_goals=None,
+                 variant_tests=None):
+        self.goal_rollups = {name: frozenset(keys) for name, keys in
+                             (goal_rollups or {}).iteritems()}
+        self.test_rollups = {name: frozenset(keys) for name, keys in
+                             (test_rollups or {}).iteritems()}
+        self.default_rollups = (None if default_rollups is None else
+                                frozenset(default_rollups))
+        self.variant_goals = (None if variant_goals is None else
+                              frozenset(variant_goals))
+        self.variant_tests = (None if variant_tests is None else
+                              frozenset(variant_tests))
+
+    def check(self, rollups):
+        """
+        Raise ``ValueError`` if any rollup key isn't one of ``rollups``.
+        """
+        configured = set(self.default_rollups or ())
+        for keys in self.goal_rollups.values() + self.test_rollups.values():
+            configured.update(keys)
+        unknown = configured - set(rollups)
+        if unknown:
+            raise ValueError('Unknown rollup keys in fanout config: %s' %
+                             ', '.join(sorted(unknown)))
+
+    def rollups_for_goal(self, name):
+        """
+        Return the set of rollup keys for goal ``name``, or None for all.
+        """
+        return self.goal_rollups.get(name, self.default_rollups)
+
+    def rollups_for_test(self, name):
+        """
+        Return the set of rollup keys for test ``name``, or None for all.
+        """
+        return self.test_rollups.get(name, self.default_rollups)
+
+    def counts_variant(self, goal_name, test_name):
+        """
+        Return True if conversions on ``goal_name`` are counted against the
+        variants of ``test_name``.
+        """
+        return (((self.variant_goals is None) or
+                 (goal_name in self.variant_goals)) and
+                ((self.variant_tests is None) or
+                 (test_name in self.variant_tests)))
@@ -0,0 +1,159 @@
+from __future__ import absolute_import, division, print_function
+"""
+Support for flushing backend state to the persistent store in a background
+thread, so that record handling doesn't stop while a flush is written.
+"""
+
+import logging
+from Queue import Queue
+from threading import Thread
+
+log = logging.getLogger(__name__)
+
+
+class FlushError(Exception):
+    pass
+
+
+class FlushBatch(object):
+    """
+    A frozen copy of everything which changed in the backend between two
+    flushes, along with the log pointer as of the end of that period. Nothing
+    in a batch is modified after it is created.
+    """
+    def __init__(self, pointer, histories, tests, goals, inc_conversions,
+                 inc_values, inc_variant_conversions, inc_variant_values,
+                 inc_impressions, pending_records=None, replayed_vids=None,
+                 expire_pending_before=None, concluded_tests=None):
+        self.pointer = pointer
+        # Map of vid to encoded visitor history.
+        self.histories = histories
+        self.tests = tests
+        self.goals = goals
+        self.inc_conversions = inc_conversions
+        self.inc_values = inc_values
+        self.inc_variant_conversions = inc_variant_conversions
+        self.inc_variant_values = inc_variant_values
+        self.inc_impressions = inc_impressions
+        # Map of vid to new records waiting for that visitor's pixel, the
+        # vids whose stored pending records have been replayed, and the
+        # timestamp before which stored pending records expire.
+        self.pending_records = pending_records or {}
+        self.replayed_vids = replayed_vids or set()
+        self.expire_pending_before = expire_pending_before
+        # Map of test name to whether it has been concluded.
+        self.concluded_tests = concluded_tests or {}
+
+
+class FlushThread(Thread):
+    """
+    Writes batches with ``write(batch)``, one at a time in the order they were
+    submitted. At most ``max_pending`` batches can be waiting to be written;
+    after that, ``submit()`` blocks until the oldest one is done.
+
+    If writing a batch fails, no later batches are written, since committing
+    them would move the persisted pointer past the lost batch. The error is
+    raised from the next call to ``submit()`` or ``drain()``.
+    """
+    def __init__(self, write, max_pending=2):
+        Thread.__init__(self, name='manhattan-flush')
+        self.daemon = True
+        self.write = write
+        self.queue = Queue(maxsize=max_pending)
+        self.error = None
+
+    def check(self):
+        if self.error:
+            raise FlushError('Background flush failed: %s: %s' %
+                             (self.error.__class__.__name__, self.error))
+
+    def submit(self, batch):
+        self.check()
+        self.queue.put(batch)
+
+    def drain(self):
+        """
+        Wait for all submitted batches to be written.
+        """
+        self.queue.join()
+        self.check()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                if not self.error:
+                    self.write(batch)
+            except Exception as e:
+                log.exception('Background flush failed.')
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+class FlushPolicy(object):
+    """
+    Decides when the backend should flush. A flush is triggered by whichever
+    of these limits is reached first:
+
+    - ``every`` records handled since the last flush. If ``catchup_lag`` is
+      set, while the records being handled are more than that many seconds
+      old, this grows in proportion to how far behind they are, up to
+      ``max_growth`` times, so that catching up uses fewer, larger
+      transactions.
+    - ``interval`` seconds since the last flush, while not catching up.
+    - ``max_counter_keys`` distinct unflushed counter keys.
+    - ``max_dirty_bytes`` estimated bytes of unflushed visitor histories.
+
+    Limits which are None are not checked. They are checked as records are
+    handled, and ``interval`` is also checked by ``should_flush_idle()``
+    while the worker waits for more records.
+    """
+    def __init__(self, every=500, interval=None, max_counter_keys=None,
+                 max_dirty_bytes=None, catchup_lag=None, max_growth=20):
+        self.every = every
+        self.interval = interval
+        self.max_counter_keys = max_counter_keys
+        self.max_dirty_bytes = max_dirty_bytes
+        self.catchup_lag = catchup_lag
+        self.max_growth = max_growth
+
+    def batch_size(self, lag):
+        """
+        Return the number of records to handle between flushes, when the
+        current record is ``lag`` seconds old.
+        """
+        if self.catchup_lag and lag > self.catchup_lag:
+            growth = min(self.max_growth, lag / self.catchup_lag)
+            return int(self.every * growth)
+        return self.every
+
+    def should_flush(self, backend, timestamp, now):
+        lag = now - timestamp
+        if backend.records_since_flush > self.batch_size(lag):
+            return True
+        if (self.interval and
+                (not self.catchup_lag or lag <= self.catchup_lag) and
+                (now - backend.last_flush_time) >= self.interval):
+            return True
+        if (self.max_counter_keys and
+                backend.unflushed_counter_keys() >= self.max_counter_keys):
+            return True
+        if (self.max_dirty_bytes and
+                backend.unflushed_history_bytes() >= self.max_dirty_bytes):
+            return True
+        return False
+
+    def should_flush_idle(self, backend, now):
+        """
+        Return True if the backend should flush while there are no records to
+        handle, so that a quiet log doesn't hold back unflushed changes.
+        """
+        return bool(self.interval and backend.records_since_flush and
+                    (now - backend.last_flush_time) >= self.interval)
@@ -1,4 +1,9 @@
 from __future__ import absolute_import, division, print_function
+import marshal
+import cPickle as pickle
+from array import array
+
+from ..record import _record_types
 
 
 class VisitorHistory(object):
@@ -16,6 +21,12 @@ class VisitorHistory(object):
         self.ips = set()
         self.user_agents = set()
 
+        # The first user agent seen for this visitor, which is the one used
+        # by user agent rollups.
+        self.user_agent = None
+        # Cached classification of ``user_agent``. Not persisted.
+        self.user_agent_info = None
+
         # Set of (goal name, rollup key, bucket start) that have already been
         # counted.
         self.conversion_keys = set()
@@ -32,6 +43,21 @@ class VisitorHistory(object):
         # on that complex goal.
         self.complex_keys = {}
 
+    def approximate_size(self):
+        """
+        Roughly estimate the memory used by this history in bytes, for
+        limiting cache sizes. This is cheap, rather than precise.
+        """
+        return (1000 +
+                1000 * len(self.nonbot_queue) +
+                100 * (len(self.goals) + len(self.variants) + len(self.ips) +
+                       len(self.user_agents)) +
+                150 * (len(self.conversion_keys) +
+                       len(self.impression_keys) +
+                       len(self.variant_conversion_keys)) +
+                200 * sum(len(keys) for keys in
+                          self.complex_keys.itervalues()))
+
 
 class Test(object):
     """
@@ -55,3 +81,261 @@ class Goal(object):
     def __init__(self, value_type=None, value_format=None):
         self.value_type = value_type
         self.value_format = value_format
+
+
+# Compact binary encoding of ``VisitorHistory`` objects.
+#
+# An encoded history is ``history_magic``, a format version byte, and then a
+# marshalled tuple of:
+#
+#   - A value table holding every distinct value used in the history.
+#   - The ``nonbot`` flag.
+#   - The ``nonbot_queue`` records, as a column of record keys and a column of
+#     all of the records' field values in order.
+#   - The ``goals``, ``variants``, ``ips``, ``user_agents``,
+#     ``conversion_keys``, ``impression_keys`` and ``variant_conversion_keys``
+#     sets, each as a list of columns.
+#   - The ``complex_keys`` dict, as a column of names, a column of list
+#     lengths, and the columns of the concatenated conversion keys.
+#   - The ``user_agent`` (added in version 2).
+#
+# Each column is normally stored as a packed array of indexes into the value
+# table, so goal names, test names, rollup keys and bucket IDs which repeat in
+# many counter keys are stored once and referenced with one or two bytes. A
+# column which can't be represented that way (e.g. because it mixes values
+# which compare equal but have different types, like ``0`` and ``0.0``) is
+# stored as a plain list instead. Packing and unpacking mostly use builtins
+# which loop in C: decoding is about as fast as cPickle, and encoding is a
+# little slower, but the output is usually several times smaller. See
+# ``manhattan/tests/perf/test_history_codec.py``.
+#
+# Data which doesn't start with ``history_magic`` is assumed to be a pickled
+# ``VisitorHistory`` from before this format existed, so rows written by older
+# versions can still be read. They are rewritten in the current format when
+# they are next flushed.
+
+history_magic = b'\xffMH'
+history_format_version = 2
+
+_marshal_version = 2
+
+
+def _index_typecode(table_size):
+    if table_size <= 0x100:
+        return 'B'
+    elif table_size <= 0x10000:
+        return 'H'
+    else:
+        return 'I'
+
+
+class HistoryEncoder(object):
+
+    def __init__(self):
+        self.table = []
+        self.ids = {}
+        self.columns = []
+
+    def column(self, values):
+        """
+        Add a column of values to the table, returning a placeholder which
+        will be replaced by the encoded column.
+        """
+        values = list(values)
+        table = self.table
+        ids = self.ids
+        # Values of different types which compare equal would share a table
+        # entry, and come back as the wrong type.
+        encodable = ((len(set(map(type, values))) < 2) or
+                     (len(set(values)) ==
+                      len(set(zip(map(type, values), values)))))
+        if encodable:
+            for v in set(values):
+                index = ids.get(v)
+                if index is None:
+                    ids[v] = len(table)
+                    table.append(v)
+                elif type(table[index]) is not type(v):
+                    encodable = False
+                    break
+        placeholder = len(self.columns)
+        self.columns.append((values, encodable))
+        return placeholder
+
+    def key_columns(self, keys):
+        keys = list(keys)
+        if len(set(map(len, keys))) > 1:
+            # Keys of varying lengths can't be split into columns.
+            return [self.column(map(tuple, keys)), None]
+        return [self.column(col) for col in zip(*keys)]
+
+    def encode(self, history):
+        queue = history.nonbot_queue
+        queue_values = []
+        for rec in queue:
+            queue_values.extend(getattr(rec, field) for field in
+                                rec.base_fields + rec.fields)
+
+        complex_names = list(history.complex_keys)
+        complex_keys = [history.complex_keys[name] for name in complex_names]
+
+        payload = [
+            history.nonbot,
+            self.column(rec.key for rec in queue),
+            self.column(queue_values),
+            self.column(history.goals),
+            self.key_columns(history.variants),
+            self.column(history.ips),
+            self.column(history.user_agents),
+            self.key_columns(history.conversion_keys),
+            self.key_columns(history.impression_keys),
+            self.key_columns(history.variant_conversion_keys),
+            self.column(complex_names),
+            map(len, complex_keys),
+            self.key_columns(key for keys in complex_keys for key in keys),
+            history.user_agent,
+        ]
+
+        typecode = _index_typecode(len(self.table))
+        ids = self.ids
+        encoded = []
+        for values, encodable in self.columns:
+            if encodable:
+                encoded.append(
+                    array(typecode, map(ids.__getitem__, values)).tostring())
+            else:
+                encoded.append(values)
+
+        def resolve(v):
+            if isinstance(v, list):
+                return [None if el is None else encoded[el] for el in v]
+            return encoded[v]
+
+        payload = ([self.table, payload[0]] +
+                   [resolve(v) for v in payload[1:11]] +
+                   [payload[11], resolve(payload[12]), payload[13]])
+        return (history_magic + chr(history_format_version) +
+                marshal.dumps(tuple(payload), _marshal_version))
+
+
+class HistoryDecoder(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def column(self, encoded):
+        if isinstance(encoded, list):
+            return encoded
+        indexes = array(self.typecode)
+        indexes.fromstring(encoded)
+        return map(self.table.__getitem__, indexes)
+
+    def keys(self, columns):
+        if columns[-1:] == [None]:
+            return self.column(columns[0])
+        return zip(*[self.column(col) for col in columns])
+
+    def decode(self):
+        data = self.data
+        version = ord(data[len(history_magic)])
+        if version not in (1, history_format_version):
+            raise ValueError('Unknown visitor history format version %d' %
+                             version)
+        payload = marshal.loads(data[len(history_magic) + 1:])
+        (self.table, nonbot, queue_keys, queue_values, goals, variants, ips,
+         user_agents, conversion_keys, impression_keys,
+         variant_conversion_keys, complex_names, complex_lengths,
+         complex_keys) = payload[:14]
+        self.typecode = _index_typecode(len(self.table))
+
+        history = VisitorHistory()
+        history.nonbot = nonbot
+
+        queue_values = self.column(queue_values)
+        pos = 0
+        for key in self.column(queue_keys):
+            cls = _record_types[key]
+            fields = cls.base_fields + cls.fields
+            rec = cls.__new__(cls)
+            rec.__dict__.update(zip(fields,
+                                    queue_values[pos:pos + len(fields)]))
+            pos += len(fields)
+            history.nonbot_queue.append(rec)
+
+        history.goals = set(self.column(goals))
+        history.variants = set(self.keys(variants))
+        history.ips = set(self.column(ips))
+        history.user_agents = set(self.column(user_agents))
+        history.conversion_keys = set(self.keys(conversion_keys))
+        history.impression_keys = set(self.keys(impression_keys))
+        history.variant_conversion_keys = set(
+            self.keys(variant_conversion_keys))
+
+        complex_keys = self.keys(complex_keys)
+        pos = 0
+        for name, length in zip(self.column(complex_names), complex_lengths):
+            history.complex_keys[name] = complex_keys[pos:pos + length]
+            pos += length
+
+        if version > 1:
+            history.user_agent = payload[14]
+        else:
+            upgrade_history(history)
+        return history
+
+
+def upgrade_history(history):
+    """
+    Fill in attributes which were added to ``VisitorHistory`` after
+    ``history`` was stored.
+    """
+    if getattr(history, 'user_agent', None) is None:
+        # The first user agent wasn't recorded, so pick one consistently.
+        history.user_agent = (min(history.user_agents)
+                              if history.user_agents else None)
+    history.user_agent_info = None
+    return history
+
+
+def encode_history(history):
+    """
+    Encode a ``VisitorHistory`` in the compact binary format.
+    """
+    return HistoryEncoder().encode(history)
+
+
+def decode_history(data):
+    """
+    Decode a ``VisitorHistory`` from the compact binary format, or from a
+    pickle written by an older version.
+    """
+    if not data.startswith(history_magic):
+        return upgrade_history(pickle.loads(data))
+    return HistoryDecoder(data).decode()
+
+
+# Records which are waiting for a visitor's pixel are stored one per row,
+# keyed by vid, so each is encoded on its own as a marshalled tuple of the
+# record key and its field values, without the vid.
+
+def encode_record(rec):
+    """
+    Encode a pending ``Record``, omitting its vid.
+    """
+    fields = [getattr(rec, field) for field in rec.base_fields + rec.fields
+              if field != 'vid']
+    return marshal.dumps((rec.key, fields), _marshal_version)
+
+
+def decode_record(vid, data):
+    """
+    Decode a pending ``Record`` written by ``encode_record()``.
+    """
+    key, values = marshal.loads(data)
+    cls = _record_types[key]
+    fields = [field for field in cls.base_fields + cls.fields
+              if field != 'vid']
+    rec = cls.__new__(cls)
+    rec.__dict__.update(zip(fields, values))
+    rec.vid = vid
+    return rec
@@ -1,10 +1,41 @@
 from __future__ import absolute_import, division, print_function
-from sqlalchemy import MetaData, Table, Column, types, create_engine, select
-from sqlalchemy.sql import and_
+import logging
+from collections import defaultdict
+
+from sqlalchemy import (MetaData, Table, Column, types, create_engine, select,
+                        text, bindparam)
+from sqlalchemy.sql import and_, type_coerce
 from sqlalchemy.dialects import mysql
 
 
-from ..model import Goal, Test
+from ..model import (Goal, Test, encode_history, decode_history,
+                     history_magic, encode_record, decode_record)
+
+log = logging.getLogger(__name__)
+
+
+# Counter tables from before names were interned: the table name, and the
+# table's name columns, in the order of the fields of the backend's counter
+# keys. Each also has bucket_id and site_id key columns.
+legacy_counter_tables = [
+    ('conversion_counts', ['name', 'rollup_key'], ['count', 'value']),
+    ('impression_counts', ['name', 'selected', 'rollup_key'], ['count']),
+    ('variant_conversion_counts',
+     ['goal_name', 'test_name', 'selected', 'rollup_key'],
+     ['count', 'value']),
+]
+
+
+def parse_legacy_bucket_id(bucket_id):
+    """
+    Convert a bucket ID from a legacy counter table, where they were stored as
+    strings, back to the value the rollup returned.
+    """
+    try:
+        value = float(bucket_id)
+    except ValueError:
+        return bucket_id
+    return int(value) if value == int(value) else value
 
 
 class LargePickleType(types.PickleType):
@@ -16,7 +47,43 @@ class LargePickleType(types.PickleType):
             return dialect.type_descriptor(types.LargeBinary)
 
 
+class VisitorHistoryType(types.TypeDecorator):
+    """
+    Stores a ``VisitorHistory`` in the compact binary format from
+    ``manhattan.backend.model``. This uses the same column type as
+    ``LargePickleType``, and reads pickled histories written by older
+    versions.
+    """
+    impl = types.LargeBinary
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'mysql':
+            return dialect.type_descriptor(mysql.LONGBLOB)  # pragma: nocover
+        else:
+            return dialect.type_descriptor(types.LargeBinary)
+
+    def process_bind_param(self, value, dialect):
+        # Histories may be passed in already encoded.
+        if value is None or isinstance(value, bytes):
+            return value
+        return encode_history(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decode_history(bytes(value))
+
+
 class SQLPersistentStore(object):
+    # Key columns of each counter table, in the order of the fields of the
+    # backend's counter keys.
+    conversion_key_cols = ['name_id', 'rollup_id', 'bucket', 'bucket_name_id',
+                           'site_id']
+    impression_key_cols = ['name_id', 'selected_id', 'rollup_id', 'bucket',
+                           'bucket_name_id', 'site_id']
+    variant_conversion_key_cols = ['goal_id', 'test_id', 'selected_id',
+                                   'rollup_id', 'bucket', 'bucket_name_id',
+                                   'site_id']
 
     def __init__(self, sqlalchemy_url):
         self.engine = create_engine(sqlalchemy_url, pool_recycle=3600,
@@ -33,7 +100,19 @@ class SQLPersistentStore(object):
             'visitor_histories',
             self.metadata,
             Column('vid', types.String(40), primary_key=True),
-            Column('history', LargePickleType, nullable=False),
+            Column('history', VisitorHistoryType, nullable=False),
+            mysql_engine='InnoDB')
+
+        # Records from visitors who haven't loaded the pixel yet, which are
+        # only counted if they do. Rows are only ever inserted, deleted when
+        # the visitor's pixel arrives, or expired by timestamp.
+        self.pending_table = Table(
+            'pending_records',
+            self.metadata,
+            Column('id', types.Integer, primary_key=True),
+            Column('vid', types.String(40), nullable=False, index=True),
+            Column('timestamp', types.Integer, nullable=False, index=True),
+            Column('record', types.LargeBinary, nullable=False),
             mysql_engine='InnoDB')
 
         self.tests_table = Table(
@@ -46,6 +125,14 @@ class SQLPersistentStore(object):
             Column('variants', LargePickleType, nullable=False),
             mysql_engine='InnoDB')
 
+        # Tests which have been explicitly concluded (or reopened).
+        self.concluded_tests_table = Table(
+            'concluded_tests',
+            self.metadata,
+            Column('name', types.String(255), primary_key=True),
+            Column('concluded', types.Boolean, nullable=False),
+            mysql_engine='InnoDB')
+
         self.goal_table = Table(
             'goals',
             self.metadata,
@@ -55,36 +142,51 @@ class SQLPersistentStore(object):
             Column('value_format', types.CHAR(1), nullable=False, default=''),
             mysql_engine='InnoDB')
 
+        # Goal, test, population, rollup and (non-numeric) bucket names used
+        # in the counter tables are interned here, so that the counter keys
+        # are all integers.
+        self.names_table = Table(
+            'names',
+            self.metadata,
+            Column('id', types.Integer, primary_key=True),
+            Column('name', types.String(255), nullable=False, unique=True),
+            mysql_engine='InnoDB')
+
         self.conversion_counts_table = Table(
-            'conversion_counts',
+            'conversion_counters',
             self.metadata,
-            Column('name', types.String(255), primary_key=True),
-            Column('rollup_key', types.String(255), primary_key=True),
-            Column('bucket_id', types.String(255), primary_key=True),
+            Column('name_id', types.Integer, primary_key=True),
+            Column('rollup_id', types.Integer, primary_key=True),
+            Column('bucket', types.BigInteger, primary_key=True),
+            Column('bucket_name_id', types.Integer, primary_key=True),
             Column('site_id', types.Integer, primary_key=True),
             Column('count', types.Integer, nullable=False, default=0),
             Column('value', types.Float, nullable=False, default=0),
             mysql_engine='InnoDB')
 
         self.impression_counts_table = Table(
-            'impression_counts',
+            'impression_counters',
             self.metadata,
-            Column('name', types.String(255), primary_key=True),
-            Column('selected', types.String(255), primary_key=True),
-            Column('rollup_key', types.String(255), primary_key=True),
-            Column('bucket_id', types.String(255), primary_key=True),
+            Column('name_id', types.Integer, primary_key=True),
+            Column('selected_id', types.Integer, primary_key=True),
+            Column('rollup_id', types.Integer, primary_key=True),
+            Column('bucket', types.BigInteger, primary_key=True),
+            Column('bucket_name_id', types.Integer, primary_key=True),
             Column('site_id', types.Integer, primary_key=True),
             Column('count', types.Integer, nullable=False, default=0),
             mysql_engine='InnoDB')
 
+        # Results are queried for every population of a test at once, so
+        # ``selected_id`` follows the bucket in the primary key.
         self.variant_conversion_counts_table = Table(
-            'variant_conversion_counts',
+            'variant_conversion_counters',
             self.metadata,
-            Column('goal_name', types.String(100), primary_key=True),
-            Column('test_name', types.String(100), primary_key=True),
-            Column('selected', types.String(100), primary_key=True),
-            Column('rollup_key', types.String(100), primary_key=True),
-            Column('bucket_id', types.String(100), primary_key=True),
+            Column('goal_id', types.Integer, primary_key=True),
+            Column('test_id', types.Integer, primary_key=True),
+            Column('rollup_id', types.Integer, primary_key=True),
+            Column('bucket', types.BigInteger, primary_key=True),
+            Column('bucket_name_id', types.Integer, primary_key=True),
+            Column('selected_id', types.Integer, primary_key=True),
             Column('site_id', types.Integer, primary_key=True),
             Column('count', types.Integer, nullable=False, default=0),
             Column('value', types.Float, nullable=False, default=0),
@@ -92,6 +194,18 @@ class SQLPersistentStore(object):
 
         self.metadata.create_all()
 
+        # In-process caches of interned names, and the names interned by the
+        # current transaction, which are forgotten if it is rolled back.
+        self.name_ids = {}
+        self.id_names = {}
+        self.uncommitted_names = []
+        self.load_names()
+
+        if self.legacy_counter_tables():
+            log.warn('Counter tables from an older version of Manhattan '
+                     'exist, and will not be included in query results '
+                     'until they are migrated with manhattan-migrate.')
+
     def update_pointer(self, ptr):
         if ptr is None:
             return
@@ -105,10 +219,88 @@ class SQLPersistentStore(object):
         return select([self.pointer_table.c.pointer]).scalar()
 
     def begin(self):
+        self.uncommitted_names = []
         return self.engine.begin()
 
     def commit(self):
-        return self.engine.commit()
+        r = self.engine.commit()
+        self.uncommitted_names = []
+        return r
+
+    def rollback(self):
+        r = self.engine.rollback()
+        for name in self.uncommitted_names:
+            self.id_names.pop(self.name_ids.pop(name), None)
+        self.uncommitted_names = []
+        return r
+
+    def load_names(self):
+        t = self.names_table
+        for id, name in select([t.c.id, t.c.name]).execute():
+            self.name_ids[name] = id
+            self.id_names[id] = name
+
+    def name_id(self, name, create=False):
+        """
+        Return the integer ID of an interned name. If it hasn't been interned
+        yet, intern it if ``create`` is set, otherwise return None.
+        """
+        try:
+            return self.name_ids[name]
+        except KeyError:
+            pass
+        t = self.names_table
+        id = select([t.c.id]).where(t.c.name == name).scalar()
+        if id is None:
+            if not create:
+                return None
+            r = t.insert().values(name=name).execute()
+            id = r.inserted_primary_key[0]
+            self.uncommitted_names.append(name)
+        self.name_ids[name] = id
+        self.id_names[id] = name
+        return id
+
+    def name_for_id(self, id):
+        try:
+            return self.id_names[id]
+        except KeyError:
+            t = self.names_table
+            name = select([t.c.name]).where(t.c.id == id).scalar()
+            if name is None:
+                raise KeyError(id)
+            self.name_ids[name] = id
+            self.id_names[id] = name
+            return name
+
+    def bucket_values(self, bucket_id, create=False):
+        """
+        Return the ``bucket`` and ``bucket_name_id`` columns stored for a
+        bucket ID. Whole numeric bucket IDs (like the start of a time bucket)
+        are stored in ``bucket``. Other bucket IDs (like a browser name) are
+        interned as strings, and stored in ``bucket_name_id``, so they aren't
+        included in series. Returns None for ``bucket_name_id`` if the bucket
+        is an unknown name and ``create`` isn't set.
+        """
+        if not isinstance(bucket_id, basestring):
+            value = int(bucket_id)
+            if value == bucket_id:
+                return value, 0
+            bucket_id = unicode(bucket_id)
+        return 0, self.name_id(bucket_id, create=create)
+
+    def key_ids(self, names, bucket_id=None, create=False):
+        """
+        Return a list of the name IDs of ``names``, followed by the stored
+        ``bucket`` and ``bucket_name_id`` values of ``bucket_id`` if it is
+        given. Returns None if any name is unknown and ``create`` isn't set.
+        """
+        ids = [self.name_id(name, create=create) for name in names]
+        if bucket_id is not None:
+            ids.extend(self.bucket_values(bucket_id, create=create))
+        if None in ids:
+            return None
+        return ids
 
     def criteria_from_dict(self, table, key_dict):
         criteria = []
@@ -136,24 +328,187 @@ class SQLPersistentStore(object):
             q = table.insert().values(**value_dict)
             q.execute()
 
+    def upsert_style(self):
+        """
+        Return the flavor of native upsert supported by the connected
+        database: ``'mysql'`` for ``INSERT ... ON DUPLICATE KEY UPDATE``,
+        ``'on_conflict'`` for ``INSERT ... ON CONFLICT DO UPDATE``, or None if
+        rows must be upserted one at a time.
+        """
+        dialect = self.engine.dialect
+        version = dialect.server_version_info or ()
+        if dialect.name == 'mysql':
+            return 'mysql'  # pragma: nocover
+        elif dialect.name == 'sqlite' and version >= (3, 24):
+            return 'on_conflict'
+        elif dialect.name == 'postgresql' and version >= (9, 5):
+            return 'on_conflict'  # pragma: nocover
+        else:
+            return None  # pragma: nocover
+
+    def upsert_statement(self, table, key_cols, value_cols, increment, style):
+        quote = self.engine.dialect.identifier_preparer.quote
+        table_name = quote(table.name)
+        cols = list(key_cols) + list(value_cols)
+
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            table_name,
+            ', '.join(quote(col) for col in cols),
+            ', '.join(':%s' % col for col in cols))
+
+        updates = []
+        for col in value_cols:
+            if style == 'mysql':
+                new = 'VALUES(%s)' % quote(col)
+            else:
+                new = 'excluded.%s' % quote(col)
+            if increment:
+                new = '%s.%s + %s' % (table_name, quote(col), new)
+            updates.append('%s = %s' % (quote(col), new))
+
+        if style == 'mysql':
+            sql += ' ON DUPLICATE KEY UPDATE %s' % ', '.join(updates)
+        else:
+            sql += ' ON CONFLICT (%s) DO UPDATE SET %s' % (
+                ', '.join(quote(col) for col in key_cols),
+                ', '.join(updates))
+
+        params = [bindparam(col, type_=getattr(table.c, col).type)
+                  for col in cols]
+        return text(sql, bindparams=params)
+
+    def put_many(self, table, key_cols, rows, increment=False):
+        """
+        Write a batch of rows to ``table``, inserting rows which don't exist
+        and updating (or incrementing, if ``increment`` is set) rows which do.
+        Each row is a dict containing the ``key_cols`` columns plus the value
+        columns to be written; all rows must have the same columns.
+
+        When the database supports a native upsert and ``key_cols`` is the
+        primary key of the table, the whole batch is written with a single
+        executemany. Otherwise, fall back to ``put_kv()`` for each row.
+        """
+        if not rows:
+            return
+
+        style = self.upsert_style()
+        pk_cols = set(col.name for col in table.primary_key.columns)
+        if style and set(key_cols) == pk_cols:
+            value_cols = sorted(set(rows[0]) - set(key_cols))
+            q = self.upsert_statement(table, key_cols, value_cols, increment,
+                                      style)
+            self.engine.execute(q, rows)
+        else:
+            for row in rows:
+                key_dict = {col: row[col] for col in key_cols}
+                value_dict = {col: val for col, val in row.iteritems()
+                              if col not in key_dict}
+                self.put_kv(table, key_dict, value_dict, increment=increment)
+
     def put_visitor_history(self, histories):
-        for vid, history in histories.iteritems():
-            self.put_kv(self.history_table, {'vid': vid}, {'history': history})
+        self.put_many(self.history_table,
+                      ['vid'],
+                      [{'vid': vid, 'history': history}
+                       for vid, history in histories.iteritems()])
+
+    def append_pending_records(self, records):
+        """
+        Store records which are waiting for their visitor's pixel. Takes a
+        dict mapping vid to a list of records, oldest first.
+        """
+        rows = [{'vid': vid,
+                 'timestamp': int(float(rec.timestamp)),
+                 'record': encode_record(rec)}
+                for vid, recs in records.iteritems() for rec in recs]
+        if rows:
+            self.pending_table.insert().execute(rows)
+
+    def get_pending_records(self, vid, limit=None):
+        """
+        Return the stored pending records for ``vid``, oldest first. If
+        ``limit`` is given, only the newest ``limit`` records are returned.
+        """
+        t = self.pending_table
+        q = select([t.c.record]).where(t.c.vid == vid).order_by(t.c.id.desc())
+        if limit is not None:
+            q = q.limit(limit)
+        rows = q.execute().fetchall()
+        rows.reverse()
+        return [decode_record(vid, bytes(data)) for (data,) in rows]
+
+    def delete_pending_records(self, vids, chunk_size=500):
+        t = self.pending_table
+        vids = list(vids)
+        for ii in range(0, len(vids), chunk_size):
+            t.delete().where(t.c.vid.in_(vids[ii:ii + chunk_size])).execute()
+
+    def expire_pending_records(self, before):
+        """
+        Delete pending records with timestamps before ``before``. Returns the
+        number of records deleted.
+        """
+        t = self.pending_table
+        return t.delete().where(t.c.timestamp < before).execute().rowcount
+
+    def iter_pending_visitor_ids(self):
+        """
+        Iterate over the vids which have pending records.
+        """
+        t = self.pending_table
+        q = select([t.c.vid]).distinct().execution_options(
+            stream_results=True)
+        for (vid,) in q.execute():
+            yield vid
 
     def put_test(self, tests):
-        for name, test in tests.iteritems():
-            self.put_kv(self.tests_table,
-                        {'name': name},
-                        {'first_timestamp': test.first_timestamp,
-                         'last_timestamp': test.last_timestamp,
-                         'variants': test.variants})
+        self.put_many(self.tests_table,
+                      ['name'],
+                      [{'name': name,
+                        'first_timestamp': test.first_timestamp,
+                        'last_timestamp': test.last_timestamp,
+                        'variants': test.variants}
+                       for name, test in tests.iteritems()])
+
+    def put_concluded_tests(self, concluded):
+        """
+        Given a map of test name to whether it is concluded, record which
+        tests are concluded.
+        """
+        self.put_many(self.concluded_tests_table,
+                      ['name'],
+                      [{'name': name, 'concluded': flag}
+                       for name, flag in concluded.iteritems()])
+
+    def get_concluded_tests(self):
+        t = self.concluded_tests_table
+        q = select([t.c.name, t.c.concluded])
+        return set(name for name, concluded in q.execute() if concluded)
 
     def put_goal(self, goals):
-        for name, goal in goals.iteritems():
-            self.put_kv(self.goal_table,
-                        {'name': name},
-                        {'value_type': goal.value_type,
-                         'value_format': goal.value_format})
+        self.put_many(self.goal_table,
+                      ['name'],
+                      [{'name': name,
+                        'value_type': goal.value_type,
+                        'value_format': goal.value_format}
+                       for name, goal in goals.iteritems()])
+
+    def increment_counters(self, table, key_cols, keys, value_cols,
+                           values):
+        """
+        Add deltas onto the counters in ``table``. ``keys`` are counter keys
+        as used by the backend: names, then the bucket ID, then the site ID.
+        ``key_cols`` are the names of the corresponding ID columns. Each of
+        ``values`` is a map of counter key to delta for the column of the
+        same position in ``value_cols``.
+        """
+        rows = []
+        for key in keys:
+            ids = self.key_ids(key[:-2], key[-2], create=True)
+            row = dict(zip(key_cols, ids + [key[-1]]))
+            for col, deltas in zip(value_cols, values):
+                row[col] = deltas.get(key, 0)
+            rows.append(row)
+        self.put_many(table, key_cols, rows, increment=True)
 
     def increment_conversion_counters(self, inc_conversions, inc_values):
         """
@@ -161,51 +516,24 @@ class SQLPersistentStore(object):
         tuples of (integer counts, Decimal values), adjust the state of the
         counts in the SQL database.
         """
-        for key in set(inc_conversions) | set(inc_values):
-            delta = inc_conversions.get(key, 0)
-            value = inc_values.get(key, 0)
-            name, rollup_key, bucket_id, site_id = key
-
-            self.put_kv(self.conversion_counts_table,
-                        {'name': name,
-                         'rollup_key': rollup_key,
-                         'bucket_id': bucket_id,
-                         'site_id': site_id},
-                        {'count': delta,
-                         'value': value},
-                        increment=True)
+        self.increment_counters(
+            self.conversion_counts_table, self.conversion_key_cols,
+            set(inc_conversions) | set(inc_values),
+            ['count', 'value'], [inc_conversions, inc_values])
 
     def increment_impression_counters(self, inc_impressions):
-        for key, delta in inc_impressions.iteritems():
-            name, selected, rollup_key, bucket_id, site_id = key
-
-            self.put_kv(self.impression_counts_table,
-                        {'name': name,
-                         'selected': selected,
-                         'rollup_key': rollup_key,
-                         'bucket_id': bucket_id,
-                         'site_id': site_id},
-                        {'count': delta},
-                        increment=True)
+        self.increment_counters(
+            self.impression_counts_table, self.impression_key_cols,
+            inc_impressions, ['count'], [inc_impressions])
 
     def increment_variant_conversion_counters(self, inc_variant_conversions,
                                               inc_variant_values):
-        for key in set(inc_variant_conversions) | set(inc_variant_values):
-            delta = inc_variant_conversions.get(key, 0)
-            value = inc_variant_values.get(key, 0)
-            goal_name, test_name, selected, \
-                rollup_key, bucket_id, site_id = key
-
-            self.put_kv(self.variant_conversion_counts_table,
-                        {'goal_name': goal_name,
-                         'test_name': test_name,
-                         'selected': selected,
-                         'rollup_key': rollup_key,
-                         'bucket_id': bucket_id,
-                         'site_id': site_id},
-                        {'count': delta,
-                         'value': value},
-                        increment=True)
+        self.increment_counters(
+            self.variant_conversion_counts_table,
+            self.variant_conversion_key_cols,
+            set(inc_variant_conversions) | set(inc_variant_values),
+            ['count', 'value'],
+            [inc_variant_conversions, inc_variant_values])
 
     def get_kv(self, table, get_cols, key_dict, default=None):
         to_select = [getattr(table.c, col) for col in get_cols]
@@ -226,6 +554,60 @@ class SQLPersistentStore(object):
                         {'vid': vid})
         return r[0]
 
+    def get_visitor_histories(self, vids, chunk_size=500):
+        """
+        Fetch the histories for many visitors, using one query per
+        ``chunk_size`` vids. Returns a dict mapping vid to history, omitting
+        vids which have no stored history.
+        """
+        t = self.history_table
+        vids = list(vids)
+        ret = {}
+        for ii in range(0, len(vids), chunk_size):
+            chunk = vids[ii:ii + chunk_size]
+            q = select([t.c.vid, t.c.history]).where(t.c.vid.in_(chunk))
+            for vid, history in q.execute():
+                ret[vid] = history
+        return ret
+
+    def iter_visitor_ids(self):
+        """
+        Iterate over the vids of all stored visitor histories.
+        """
+        t = self.history_table
+        q = select([t.c.vid]).execution_options(stream_results=True)
+        for (vid,) in q.execute():
+            yield vid
+
+    def migrate_visitor_histories(self, batch_size=1000):
+        """
+        Rewrite every stored visitor history which is still pickled in the
+        current binary format. Histories are also converted lazily whenever
+        they are flushed, so this is only needed to convert histories which
+        are never touched again. Returns the number of rows converted.
+        """
+        t = self.history_table
+        raw = select([t.c.vid, type_coerce(t.c.history, types.LargeBinary)])
+        converted = 0
+        last_vid = None
+        while True:
+            q = raw.order_by(t.c.vid).limit(batch_size)
+            if last_vid is not None:
+                q = q.where(t.c.vid > last_vid)
+            rows = q.execute().fetchall()
+            if not rows:
+                return converted
+
+            pickled = {vid: decode_history(bytes(data))
+                       for vid, data in rows
+                       if not bytes(data).startswith(history_magic)}
+            if pickled:
+                self.begin()
+                self.put_visitor_history(pickled)
+                self.commit()
+            converted += len(pickled)
+            last_vid = rows[-1][0]
+
     def get_test(self, name):
         r = self.get_kv(self.tests_table,
                         ['first_timestamp', 'last_timestamp', 'variants'],
@@ -242,38 +624,231 @@ class SQLPersistentStore(object):
         value_type, value_format = r
         return Goal(value_type=value_type, value_format=value_format)
 
+    def get_goals(self, names):
+        """
+        Fetch several goals with one query. Returns a dict mapping name to
+        ``Goal``, omitting goals which don't exist.
+        """
+        t = self.goal_table
+        q = select([t.c.name, t.c.value_type, t.c.value_format]).where(
+            t.c.name.in_(list(names)))
+        return {name: Goal(value_type=value_type, value_format=value_format)
+                for name, value_type, value_format in q.execute()}
+
+    def get_counter(self, table, key_cols, key, get_cols, default):
+        ids = self.key_ids(key[:-2], key[-2])
+        if ids is None:
+            return default
+        return self.get_kv(table, get_cols,
+                           dict(zip(key_cols, ids + [key[-1]])),
+                           default=default)
+
     def count_conversions(self, name, rollup_key, bucket_id, site_id):
-        return self.get_kv(self.conversion_counts_table,
-                           ['count', 'value'],
-                           {'name': name,
-                            'rollup_key': rollup_key,
-                            'bucket_id': bucket_id,
-                            'site_id': site_id},
-                           default=(0, 0))
+        return self.get_counter(self.conversion_counts_table,
+                                self.conversion_key_cols,
+                                (name, rollup_key, bucket_id, site_id),
+                                ['count', 'value'], (0, 0))
 
     def count_impressions(self, name, selected, rollup_key, bucket_id,
                           site_id):
-        r = self.get_kv(self.impression_counts_table,
-                        ['count'],
-                        {'name': name,
-                         'selected': selected,
-                         'rollup_key': rollup_key,
-                         'bucket_id': bucket_id,
-                         'site_id': site_id},
-                        default=(0,))
+        r = self.get_counter(self.impression_counts_table,
+                             self.impression_key_cols,
+                             (name, selected, rollup_key, bucket_id, site_id),
+                             ['count'], (0,))
         return r[0]
 
     def count_variant_conversions(self, goal_name, test_name, selected,
                                   rollup_key, bucket_id, site_id):
-        return self.get_kv(self.variant_conversion_counts_table,
-                           ['count', 'value'],
-                           {'goal_name': goal_name,
-                            'test_name': test_name,
-                            'selected': selected,
-                            'rollup_key': rollup_key,
-                            'bucket_id': bucket_id,
-                            'site_id': site_id},
-                           default=(0, 0))
+        return self.get_counter(self.variant_conversion_counts_table,
+                                self.variant_conversion_key_cols,
+                                (goal_name, test_name, selected, rollup_key,
+                                 bucket_id, site_id),
+                                ['count', 'value'], (0, 0))
+
+    def count_test_variant_conversions(self, test_name, goal_names,
+                                       rollup_key, bucket_id, site_id):
+        """
+        Fetch the variant conversion counters for several goals and every
+        variant of a test with one query. Returns a dict mapping
+        ``(goal_name, selected)`` to ``(count, value)``, omitting counters
+        which don't exist.
+        """
+        ids = self.key_ids([test_name, rollup_key], bucket_id)
+        goal_ids = [id for id in (self.name_id(name) for name in goal_names)
+                    if id is not None]
+        if ids is None or not goal_ids:
+            return {}
+        test_id, rollup_id, bucket, bucket_name_id = ids
+        t = self.variant_conversion_counts_table
+        q = select([t.c.goal_id, t.c.selected_id, t.c.count, t.c.value]).where(
+            and_(t.c.goal_id.in_(goal_ids),
+                 t.c.test_id == test_id,
+                 t.c.rollup_id == rollup_id,
+                 t.c.bucket == bucket,
+                 t.c.bucket_name_id == bucket_name_id,
+                 t.c.site_id == site_id))
+        name_for_id = self.name_for_id
+        return {(name_for_id(goal_id), name_for_id(selected_id)):
+                (count, value)
+                for goal_id, selected_id, count, value in q.execute()}
+
+    def get_series(self, table, get_cols, key_dict, group_cols, start, end):
+        """
+        Fetch the rows of a counter table matching ``key_dict`` (which must
+        not include ``bucket``) whose time bucket starts in the range
+        ``[start, end)``. Either end of the range can be None. A list value
+        in ``key_dict`` matches any of its elements.
+
+        Returns a dict mapping ``(group col values..., bucket_id)`` to the
+        values of ``get_cols``. Rows whose bucket isn't numeric are skipped.
+        """
+        # Every primary key column before ``bucket`` is in ``key_dict``, so
+        # this is a range scan of the primary key (one for each value of a
+        # list), which only filters on the key columns after ``bucket``.
+        cols = ([getattr(table.c, col) for col in group_cols] +
+                [table.c.bucket] +
+                [getattr(table.c, col) for col in get_cols])
+        criteria = []
+        for col, val in key_dict.iteritems():
+            if isinstance(val, list):
+                criteria.append(getattr(table.c, col).in_(val))
+            else:
+                criteria.append(getattr(table.c, col) == val)
+        criteria.append(table.c.bucket_name_id == 0)
+        if start is not None:
+            criteria.append(table.c.bucket >= start)
+        if end is not None:
+            criteria.append(table.c.bucket < end)
+        q = select(cols).where(and_(*criteria))
+        ngroup = len(group_cols)
+        return {tuple(row[:ngroup + 1]): tuple(row[ngroup + 1:])
+                for row in q.execute()}
+
+    def conversion_series(self, name, rollup_key, site_id, start=None,
+                          end=None):
+        """
+        Return a dict mapping bucket ID to ``(count, value)`` for the
+        conversion counters of a goal in the range ``[start, end)``.
+        """
+        ids = self.key_ids([name, rollup_key])
+        if ids is None:
+            return {}
+        name_id, rollup_id = ids
+        r = self.get_series(self.conversion_counts_table,
+                            ['count', 'value'],
+                            {'name_id': name_id,
+                             'rollup_id': rollup_id,
+                             'site_id': site_id},
+                            [], start, end)
+        return {key[0]: value for key, value in r.iteritems()}
+
+    def impression_series(self, name, selected, rollup_key, site_id,
+                          start=None, end=None):
+        """
+        Return a dict mapping bucket ID to count for the impression counters
+        of a test population in the range ``[start, end)``.
+        """
+        ids = self.key_ids([name, selected, rollup_key])
+        if ids is None:
+            return {}
+        name_id, selected_id, rollup_id = ids
+        r = self.get_series(self.impression_counts_table,
+                            ['count'],
+                            {'name_id': name_id,
+                             'selected_id': selected_id,
+                             'rollup_id': rollup_id,
+                             'site_id': site_id},
+                            [], start, end)
+        return {key[0]: value[0] for key, value in r.iteritems()}
+
+    def test_variant_conversion_series(self, test_name, goal_names,
+                                       rollup_key, site_id, start=None,
+                                       end=None):
+        """
+        Return a dict mapping ``(goal_name, selected, bucket_id)`` to
+        ``(count, value)`` for the variant conversion counters of several
+        goals and every variant of a test in the range ``[start, end)``.
+        """
+        ids = self.key_ids([test_name, rollup_key])
+        goal_ids = [id for id in (self.name_id(name) for name in goal_names)
+                    if id is not None]
+        if ids is None or not goal_ids:
+            return {}
+        test_id, rollup_id = ids
+        r = self.get_series(self.variant_conversion_counts_table,
+                            ['count', 'value'],
+                            {'goal_id': goal_ids,
+                             'test_id': test_id,
+                             'rollup_id': rollup_id,
+                             'site_id': site_id},
+                            ['goal_id', 'selected_id'], start, end)
+        name_for_id = self.name_for_id
+        return {(name_for_id(goal_id), name_for_id(selected_id), bucket):
+                value
+                for (goal_id, selected_id, bucket), value in r.iteritems()}
+
+    def legacy_counter_tables(self):
+        """
+        Return a list of ``(legacy table, name columns, value columns, new
+        table, new key columns)`` for each legacy counter table which still
+        exists.
+        """
+        new_tables = [
+            (self.conversion_counts_table, self.conversion_key_cols),
+            (self.impression_counts_table, self.impression_key_cols),
+            (self.variant_conversion_counts_table,
+             self.variant_conversion_key_cols),
+        ]
+        metadata = MetaData(bind=self.engine)
+        ret = []
+        for (name, name_cols, value_cols), (new, new_key_cols) in \
+                zip(legacy_counter_tables, new_tables):
+            if self.engine.has_table(name):
+                legacy = Table(name, metadata, autoload=True)
+                ret.append((legacy, name_cols, value_cols, new, new_key_cols))
+        return ret
+
+    def migrate_counters(self, batch_size=1000):
+        """
+        Move the counters from the legacy counter tables, which used string
+        keys, into the current counter tables, and drop the legacy tables.
+        Counters are added onto any which have already been written to the
+        current tables. Each batch of rows is moved in one transaction, so the
+        migration can safely be interrupted and restarted. Returns the number
+        of rows migrated.
+        """
+        migrated = 0
+        for legacy, name_cols, value_cols, new, new_key_cols in \
+                self.legacy_counter_tables():
+            key_cols = name_cols + ['bucket_id', 'site_id']
+            delete = legacy.delete().where(and_(*[
+                getattr(legacy.c, col) == bindparam('old_' + col)
+                for col in key_cols]))
+            while True:
+                rows = select([legacy]).limit(batch_size).execute().fetchall()
+                if not rows:
+                    break
+                values = [defaultdict(int) for col in value_cols]
+                for row in rows:
+                    key = (tuple(row[col] for col in name_cols) +
+                           (parse_legacy_bucket_id(row['bucket_id']),
+                            row['site_id']))
+                    for col, deltas in zip(value_cols, values):
+                        deltas[key] += row[col]
+                self.begin()
+                try:
+                    self.increment_counters(new, new_key_cols, values[0],
+                                            value_cols, values)
+                    self.engine.execute(
+                        delete, [{'old_' + col: row[col] for col in key_cols}
+                                 for row in rows])
+                    self.commit()
+                except Exception:
+                    self.rollback()
+                    raise
+                migrated += len(rows)
+            legacy.drop()
+        return migrated
 
     def all_tests(self):
         t = self.tests_table
@@ -2,38 +2,125 @@ from __future__ import absolute_import, division, print_function
 """
 This module contains some example ``Rollup`` objects, each implementing the
 interface expected by the Manhattan backend for rollup aggregations.
+
+A rollup must implement ``get_bucket(timestamp, history)``. Rollups whose
+buckets cover a period of time can also implement ``bucket_end(bucket_id)``,
+returning the timestamp at which the bucket ends, which allows the backend to
+prune visitor history keys for buckets which can't receive more events.
 """
 
 import time
+import calendar
+from collections import deque
 from datetime import datetime, timedelta
 
 import pytz
 
+from .useragent import default_classifier, history_user_agent_info
+
 
 class LocalRollup(object):
+    """
+    Base class for rollups which bucket by a period of local time in a given
+    timezone. Subclasses implement ``period_for(day)``.
+
+    The UTC timestamp range covered by each bucket is computed when the bucket
+    is first seen, and the most recently used ranges are kept, so that most
+    calls to ``get_bucket()`` are just a comparison against the range of the
+    previous record.
+    """
+    # Number of recently used bucket ranges to remember.
+    span_cache_size = 8
 
     def __init__(self, tzname):
         self.tz = pytz.timezone(tzname)
+        # Most recently used first. Each span is (start, end, bucket), where
+        # start and end are UTC timestamps and end is exclusive.
+        self.spans = deque(maxlen=self.span_cache_size)
 
     def start_date_for(self, timestamp):
         dt = datetime.utcfromtimestamp(timestamp).replace(tzinfo=pytz.utc)
         dt_local = dt.astimezone(self.tz).replace(tzinfo=None)
         return dt_local.date()
 
+    def period_for(self, day):
+        """
+        Return the first local date of the period containing ``day``, and the
+        first local date of the next period.
+        """
+        raise NotImplementedError
+
+    def local_midnight(self, day):
+        """
+        Return the UTC timestamp of the first instant whose local date is
+        ``day`` or later, or None if it can't be determined exactly.
+        """
+        naive = datetime(day.year, day.month, day.day)
+        try:
+            dt = self.tz.localize(naive, is_dst=None)
+        except pytz.AmbiguousTimeError:
+            # Midnight happens twice, take the first one.
+            dt = self.tz.localize(naive, is_dst=True)
+        except pytz.NonExistentTimeError:
+            # The clocks skip over midnight, so the day starts at the end of
+            # the gap.
+            dt = self.tz.localize(naive, is_dst=False)
+        ts = calendar.timegm(dt.utctimetuple())
+        # Double-check the boundary, in case of timezone rules which the
+        # cases above don't cover.
+        if ((self.start_date_for(ts) < day) or
+                (self.start_date_for(ts - 1) >= day)):
+            return None
+        return ts
+
+    def get_bucket(self, timestamp, history):
+        spans = self.spans
+        for ii, span in enumerate(spans):
+            if span[0] <= timestamp < span[1]:
+                if ii:
+                    del spans[ii]
+                    spans.appendleft(span)
+                return span[2]
+
+        first, next_first = self.period_for(self.start_date_for(timestamp))
+        bucket = time.mktime(first.timetuple())
+        start = self.local_midnight(first)
+        end = self.local_midnight(next_first)
+        if (start is not None) and (end is not None):
+            spans.appendleft((start, end, bucket))
+        return bucket
+
+    def bucket_end(self, bucket_id):
+        """
+        Return the UTC timestamp at which the bucket ``bucket_id`` ends.
+        """
+        for start, end, bucket in self.spans:
+            if bucket == bucket_id:
+                return end
+        # Buckets are midnight of the first local date of the period in the
+        # process's timezone, as returned by time.mktime().
+        first, next_first = self.period_for(
+            datetime.fromtimestamp(bucket_id).date())
+        end = self.local_midnight(next_first)
+        if end is None:
+            # Err on the late side, since no timezone is more than a day
+            # ahead of UTC.
+            end = calendar.timegm(next_first.timetuple()) + 86400
+        return end
+
 
 class LocalDayRollup(LocalRollup):
 
-    def get_bucket(self, timestamp, history):
-        return time.mktime(self.start_date_for(timestamp).timetuple())
+    def period_for(self, day):
+        return day, day + timedelta(days=1)
 
 
 class LocalWeekRollup(LocalRollup):
 
-    def get_bucket(self, timestamp, history):
-        day = self.start_date_for(timestamp)
+    def period_for(self, day):
         days_from_sunday = day.isoweekday() % 7
         day -= timedelta(days=days_from_sunday)
-        return time.mktime(day.timetuple())
+        return day, day + timedelta(days=7)
 
 
 class AllRollup(object):
@@ -42,22 +129,35 @@ class AllRollup(object):
         return 0
 
 
-class BrowserRollup(object):
+class UserAgentRollup(object):
+    """
+    Buckets by one attribute (``browser``, ``os`` or ``device``) of the
+    classification of the visitor's first user agent. Visitors whose user
+    agent hasn't been seen yet are bucketed under an empty string.
+    """
+    attribute = None
 
-    def browser_from_user_agent(self, user_agent):
-        # FIXME This is a pretty naive and less useful implementation.
-        if 'Chrome' in user_agent:
-            return u'Chrome'
-        elif 'Safari' in user_agent:
-            return u'Safari'
-        elif 'Firefox' in user_agent:
-            return u'Firefox'
-        elif 'MSIE' in user_agent:
-            return u'IE'
-        else:
-            return u'Unknown'
+    def __init__(self, attribute=None, classifier=None):
+        self.attribute = attribute or self.attribute
+        self.classifier = classifier or default_classifier
 
     def get_bucket(self, timestamp, history):
-        return (history.user_agents and
-                self.browser_from_user_agent(list(history.user_agents)[0]) or
-                u'')
+        info = history_user_agent_info(history, self.classifier)
+        if info is None:
+            return u''
+        return getattr(info, self.attribute)
+
+
+class BrowserRollup(UserAgentRollup):
+    attribute = 'browser'
+
+    def browser_from_user_agent(self, user_agent):
+        return self.classifier.classify(user_agent).browser
+
+
+class OSRollup(UserAgentRollup):
+    attribute = 'os'
+
+
+class DeviceRollup(UserAgentRollup):
+    attribute = 'device'
@@ -0,0 +1,109 @@
+from __future__ import absolute_import, division, print_function
+"""
+Classification of user agent strings into browser, operating system and
+device class, for rollups which bucket by user agent.
+"""
+
+import re
+from collections import OrderedDict, namedtuple
+
+
+UserAgentInfo = namedtuple('UserAgentInfo', ['browser', 'os', 'device'])
+
+
+# Each list is checked in order, and the first matching pattern wins. Order
+# matters, since many user agents mention several browsers or platforms for
+# compatibility: e.g. Chrome claims to be Safari, and Edge claims to be both.
+browser_patterns = [
+    (re.compile(r'bot\b|crawl|spider|slurp', re.I), u'Bot'),
+    (re.compile(r'\bEdg(e|A|iOS)?/'), u'Edge'),
+    (re.compile(r'\bOPR/|\bOpera\b'), u'Opera'),
+    (re.compile(r'\bChrome\b|\bCriOS/|\bChromium/'), u'Chrome'),
+    (re.compile(r'\bFirefox\b|\bFxiOS/'), u'Firefox'),
+    (re.compile(r'\bMSIE\b|\bTrident/'), u'IE'),
+    (re.compile(r'\bSafari\b'), u'Safari'),
+]
+
+os_patterns = [
+    (re.compile(r'Windows Phone'), u'Windows Phone'),
+    (re.compile(r'Windows'), u'Windows'),
+    (re.compile(r'iPhone|iPad|iPod'), u'iOS'),
+    (re.compile(r'Android'), u'Android'),
+    (re.compile(r'Mac OS X|Macintosh'), u'Mac OS X'),
+    (re.compile(r'\bCrOS\b'), u'Chrome OS'),
+    (re.compile(r'Linux|X11'), u'Linux'),
+]
+
+tablet_pattern = re.compile(r'iPad|Tablet|Kindle|Silk/')
+mobile_pattern = re.compile(r'Mobi|iPhone|iPod|Opera Mini|Windows Phone')
+
+
+def _first_match(patterns, user_agent):
+    for pattern, name in patterns:
+        if pattern.search(user_agent):
+            return name
+    return u'Unknown'
+
+
+def classify_user_agent(user_agent):
+    """
+    Classify a user agent string, returning a ``UserAgentInfo``.
+    """
+    browser = _first_match(browser_patterns, user_agent)
+    os = _first_match(os_patterns, user_agent)
+    if browser == u'Bot':
+        device = u'Bot'
+    elif tablet_pattern.search(user_agent) or (
+            os == u'Android' and not mobile_pattern.search(user_agent)):
+        device = u'Tablet'
+    elif mobile_pattern.search(user_agent):
+        device = u'Mobile'
+    elif os != u'Unknown':
+        device = u'Desktop'
+    else:
+        device = u'Unknown'
+    return UserAgentInfo(browser, os, device)
+
+
+class UserAgentClassifier(object):
+    """
+    Classifies user agent strings, remembering the results for the
+    ``max_size`` most recently used strings. A small number of distinct user
+    agents covers almost all traffic, so nearly every lookup is a cache hit.
+    """
+    def __init__(self, max_size=5000, classify=classify_user_agent):
+        self.max_size = max_size
+        self.classify_uncached = classify
+        self.cache = OrderedDict()
+
+    def classify(self, user_agent):
+        cache = self.cache
+        try:
+            info = cache.pop(user_agent)
+        except KeyError:
+            info = self.classify_uncached(user_agent)
+            if len(cache) >= self.max_size:
+                cache.popitem(last=False)
+        cache[user_agent] = info
+        return info
+
+
+default_classifier = UserAgentClassifier()
+
+
+def history_user_agent_info(history, classifier=default_classifier):
+    """
+    Return the ``UserAgentInfo`` for a visitor's user agent, or None if it
+    hasn't been seen yet. The result is kept on the history, so each visitor
+    is only classified once while its history is cached.
+    """
+    user_agent = history.user_agent
+    if user_agent is None:
+        return None
+    cached = history.user_agent_info
+    if (cached is not None and cached[0] is classifier and
+            cached[1] == user_agent):
+        return cached[2]
+    info = classifier.classify(user_agent)
+    history.user_agent_info = classifier, user_agent, info
+    return info
@@ -0,0 +1,231 @@
+from __future__ import absolute_import, division, print_function
+"""
+A binary on-disk format for log records, which is faster to write and read
+than the tab-separated text format, and can hold any field values.
+
+A binary log file starts with ``segment_header``: ``segment_magic``, the
+format version, and the ``manhattan.record`` log version of its records.
+Records follow one after another, each framed as:
+
+  - ``frame_sync``, which marks the start of a frame.
+  - The payload length, as a big-endian unsigned int.
+  - The CRC-32 of the payload, as a big-endian unsigned int.
+  - The payload: a record type code, the byte lengths of each of the record
+    type's fields as big-endian unsigned shorts, then the UTF-8 encoded
+    field values. Values longer than ``max_field_length`` bytes are
+    truncated when they are written.
+
+The first byte of ``segment_magic`` can't start a line of the text format,
+so the format of a file can be detected from its first byte.
+
+If a frame is damaged, for example by a writer which died part way through
+appending it, reading can carry on from the next frame which is complete and
+has a valid checksum.
+"""
+
+import struct
+import zlib
+import logging
+
+from ..record import log_version, _record_types
+
+log = logging.getLogger(__name__)
+
+segment_magic = b'\xffMHL'
+format_version = 1
+segment_header = struct.Struct('>4sBB2x')
+
+frame_sync = b'\xa5\x5a'
+frame_header = struct.Struct('>2sII')
+
+# Frames which claim to be longer than this are treated as damaged, rather
+# than waiting for the rest of them to be written.
+max_payload = 1 << 22
+
+# Field lengths are stored as unsigned shorts.
+max_field_length = 0xffff
+
+# Record type codes. These are stored in log files, so they must never
+# change.
+record_type_codes = {
+    'page': 1,
+    'pixel': 2,
+    'goal': 3,
+    'split': 4,
+}
+
+
+class BinaryLogError(ValueError):
+    pass
+
+
+def _field_lengths(key):
+    cls = _record_types[key]
+    return struct.Struct('>B%dH' % len(cls.base_fields + cls.fields))
+
+
+_structs_by_key = {key: (code, _field_lengths(key))
+                   for key, code in record_type_codes.iteritems()}
+_structs_by_code = {code: (unicode(key), _field_lengths(key))
+                    for key, code in record_type_codes.iteritems()}
+
+
+def encode_header():
+    return segment_header.pack(segment_magic, format_version, log_version)
+
+
+def decode_header(data):
+    """
+    Return the log version from a binary segment header, or raise
+    ``BinaryLogError`` if it isn't one.
+    """
+    if len(data) < segment_header.size:
+        raise BinaryLogError('Truncated binary log header')
+    magic, version, record_version = segment_header.unpack_from(data)
+    if magic != segment_magic:
+        raise BinaryLogError('Not a binary log')
+    if version != format_version:
+        raise BinaryLogError('Unknown binary log format version %d' %
+                             version)
+    return record_version
+
+
+def is_binary(prefix):
+    """
+    Return True if data starting with ``prefix`` is a binary log, False if
+    it is a text log, or None if ``prefix`` is empty.
+    """
+    if not prefix:
+        return None
+    return prefix[:1] == segment_magic[:1]
+
+
+def encode_record(elements):
+    """
+    Encode a record, given as the list of values from ``Record.to_list()``,
+    as a complete frame.
+    """
+    key = elements[1]
+    code, lengths_struct = _structs_by_key[key]
+    values = [el if isinstance(el, bytes) else unicode(el).encode('utf-8')
+              for el in elements[2:]]
+    lengths = map(len, values)
+    if lengths and max(lengths) > max_field_length:
+        values = [truncate_field(key, ii, value)
+                  for ii, value in enumerate(values)]
+        lengths = map(len, values)
+    try:
+        payload = lengths_struct.pack(code, *lengths) + b''.join(values)
+    except struct.error:
+        raise BinaryLogError('Can not encode %r record: %r' %
+                             (key, elements))
+    return (frame_header.pack(frame_sync, len(payload),
+                              zlib.crc32(payload) & 0xffffffff) +
+            payload)
+
+
+def truncate_field(key, index, value):
+    """
+    Truncate a UTF-8 encoded field value to at most ``max_field_length``
+    bytes, without splitting a character, logging a warning if it is
+    changed.
+    """
+    if len(value) <= max_field_length:
+        return value
+    log.warn('Truncating %d byte field %d of %r record', len(value), index,
+             key)
+    return value[:max_field_length].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def decode_payload(payload, record_version=log_version):
+    """
+    Decode a frame payload into the list of values from
+    ``Record.to_list()``, as unicode strings.
+    """
+    try:
+        key, lengths_struct = _structs_by_code[ord(payload[0])]
+    except KeyError:
+        raise BinaryLogError('Unknown record type code %d' % ord(payload[0]))
+    lengths = lengths_struct.unpack_from(payload)[1:]
+    vals = [unicode(record_version), key]
+    pos = lengths_struct.size
+    for length in lengths:
+        vals.append(payload[pos:pos + length].decode('utf-8'))
+        pos += length
+    return vals
+
+
+def check_frame(data, pos, end):
+    """
+    Return the offset just past the frame at ``pos`` if it is complete and
+    undamaged, or None.
+    """
+    header_size = frame_header.size
+    if pos + header_size > end:
+        return None
+    sync, length, crc = frame_header.unpack_from(data, pos)
+    start = pos + header_size
+    if ((sync != frame_sync) or (length > max_payload) or
+            (start + length > end)):
+        return None
+    if zlib.crc32(data[start:start + length]) & 0xffffffff != crc:
+        return None
+    return start + length
+
+
+def find_frame(data, pos, end):
+    """
+    Return the offset of the first complete, undamaged frame in
+    ``data[pos:end]``, or None if there isn't one.
+    """
+    while True:
+        pos = data.find(frame_sync, pos, end)
+        if pos < 0:
+            return None
+        if check_frame(data, pos, end) is not None:
+            return pos
+        pos += 1
+
+
+def iter_frames(data, pos, end, on_damage=None):
+    """
+    Yield ``(payload, next_pos)`` for each complete frame in
+    ``data[pos:end]``. Stops at an incomplete frame.
+
+    If a frame is damaged, ``BinaryLogError`` is raised, unless
+    ``on_damage`` is given. Then reading resumes at the next complete,
+    undamaged frame, after calling ``on_damage(start, next_start, reason)``
+    for the bytes skipped. If there is no such frame, iteration stops at the
+    damaged one. An incomplete frame is only treated as damaged if a valid
+    frame follows it, since it may still be being written.
+    """
+    header_size = frame_header.size
+    unpack_from = frame_header.unpack_from
+    crc32 = zlib.crc32
+    while pos + header_size <= end:
+        sync, length, crc = unpack_from(data, pos)
+        start = pos + header_size
+        if sync != frame_sync:
+            reason = 'missing frame marker'
+        elif length > max_payload:
+            reason = 'bad frame length'
+        elif start + length > end:
+            if on_damage is None:
+                return
+            reason = 'incomplete frame'
+        else:
+            payload = data[start:start + length]
+            if crc32(payload) & 0xffffffff == crc:
+                pos = start + length
+                yield payload, pos
+                continue
+            reason = 'checksum mismatch'
+
+        if on_damage is None:
+            raise BinaryLogError('%s at offset %d' %
+                                 (reason.capitalize(), pos))
+        next_pos = find_frame(data, pos + 1, end)
+        if next_pos is None:
+            return
+        on_damage(pos, next_pos, reason)
+        pos = next_pos
@@ -0,0 +1,118 @@
+from __future__ import absolute_import, division, print_function
+"""
+Minimal Linux inotify support through ctypes, used by ``TimeRotatingLog`` to
+wake up as soon as a log segment is appended to or created, instead of
+polling.
+"""
+
+import os
+import sys
+import errno
+import struct
+import select
+import ctypes
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event: wd, mask, cookie, len, then ``len`` bytes of
+# NUL-padded name.
+_event_header = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify requires Linux')
+        try:
+            libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        except OSError:
+            libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        _libc = libc
+    return _libc
+
+
+def _check(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+class DirectoryWatcher(object):
+    """
+    Watches a directory for files being created, moved in or written to.
+    Raises ``OSError`` if inotify isn't available or the directory can't be
+    watched.
+    """
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, dirpath):
+        libc = _get_libc()
+        if isinstance(dirpath, unicode):
+            dirpath = dirpath.encode(sys.getfilesystemencoding() or 'utf-8')
+        self.fd = _check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        try:
+            _check(libc.inotify_add_watch(self.fd, dirpath, self.mask))
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    def read_events(self):
+        """
+        Return a list of ``(mask, name)`` for the events which are waiting,
+        without blocking.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return events
+                raise
+            if not data:
+                return events
+            pos = 0
+            while pos + _event_header.size <= len(data):
+                wd, mask, cookie, length = _event_header.unpack_from(data,
+                                                                     pos)
+                pos += _event_header.size
+                name = data[pos:pos + length].rstrip(b'\0')
+                pos += length
+                events.append((mask, name))
+
+    def wait(self, timeout):
+        """
+        Block until there are events or ``timeout`` seconds pass. Returns the
+        list of events, or None if the timeout expired.
+        """
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+        if not ready:
+            return None
+        return self.read_events()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -28,6 +28,13 @@ class MemoryLog(object):
             log.info('Playing record: %r', record)
             yield record, None
 
+    def process_batches(self, size=1000):
+        log.info('Swapping out log.')
+        to_process = list(self.q)
+        self.q = deque()
+        for ii in range(0, len(to_process), size):
+            yield to_process[ii:ii + size], None
+
     def purge(self):
         log.info('Purging log.')
         self.q = deque()
@@ -63,6 +63,10 @@ def server(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--path', default='log/manhattan.log')
     parser.add_argument('-k', '--key', default=DEFAULT_REDIS_KEY)
+    parser.add_argument('--binary', action='store_true',
+                        help='Write new log files in the binary format')
     args = parser.parse_args(argv)
-    log_server = RemoteLogServer(TimeRotatingLog(args.path), args.key)
+    log_server = RemoteLogServer(TimeRotatingLog(args.path,
+                                                 binary=args.binary),
+                                 args.key)
     log_server.run()
@@ -3,10 +3,21 @@ import os
 import os.path
 import time
 import glob
+import mmap
+import struct
+import json
+import zlib
+import errno
+import logging
 from fcntl import flock, LOCK_EX, LOCK_UN
 from threading import Event
 
+from ..record import is_valid_list
 from .text import TextLog
+from . import binary
+from .inotify import DirectoryWatcher, IN_CREATE, IN_MOVED_TO, IN_Q_OVERFLOW
+
+log = logging.getLogger(__name__)
 
 
 class TimeRotatingLog(TextLog):
@@ -14,14 +25,57 @@ class TimeRotatingLog(TextLog):
     A type of log which writes records as individual lines to a series of
     files, with one file per hour of time in which events occur. Files are
     written atomically (using ``fcntl.flock``) and only appended to.
+
+    When following the log, readers are woken by inotify as soon as a file is
+    written or created, if it is available. Otherwise they poll every
+    ``sleep_delay`` seconds. With inotify, the log is still checked at least
+    every ``max_latency`` seconds, in case an event is missed.
+
+    Files which have been superseded by a newer one are no longer written,
+    so they are read in bulk through ``mmap`` instead of a line at a time.
+
+    With ``binary`` set, new files are written in the framed binary format
+    from ``manhattan.log.binary`` instead of as lines of text. The format of
+    each file is detected when it is read or appended to, so a log can mix
+    text and binary files.
+
+    Damaged records, such as ones left part written by a writer which died,
+    are skipped and reported, and reading carries on from the next valid
+    record. If ``quarantine_dir`` is set, the skipped bytes are copied there.
+    Each file has a sidecar index recording how much of it has been checked,
+    which the reader updates as it finishes with each file, so that
+    ``scan()`` only needs to check what has been written since.
     """
     sleep_delay = 0.5
 
-    def __init__(self, path):
+    # Bulk reads of text files are split into lines about this many bytes at
+    # a time. Binary files which are being followed are read this many bytes
+    # at a time.
+    chunk_bytes = 1 << 20
+
+    def __init__(self, path, use_inotify=True, max_latency=1.0,
+                 binary=False, quarantine_dir=None, scan_on_start=True):
         self.path = path
         self.current_log_name = None
         self.killed = Event()
         self.f = None
+        self.binary = binary
+        # Whether the file open for writing is binary, or None if that
+        # isn't known yet.
+        self.f_binary = None
+        self.use_inotify = use_inotify
+        self.max_latency = max_latency
+        self.watcher = None
+        self.quarantine_dir = quarantine_dir
+        self.scan_on_start = scan_on_start
+        self.damaged_regions = 0
+        self.damaged_bytes = 0
+        # ``(fname, start, end)`` of the regions skipped in files whose index
+        # hasn't been updated yet.
+        self.skipped = []
+        self.on_idle = None
+        # ``(fname, offset, data)`` read ahead from the file being followed.
+        self.read_buffer = None
 
     def create_dirs(self):
         dirpath = os.path.dirname(self.path)
@@ -41,17 +95,87 @@ class TimeRotatingLog(TextLog):
             if self.f:
                 self.f.close()
             self.f = open(self.current_log_name, 'ab')
-
-        data = [self.format(r) for r in records]
-        for r in data:
-            assert b'\n' not in r, '\\n found in %r' % r
-        data.append('')  # to get the final \n
-        data = b'\n'.join(data)
+            self.f_binary = None
 
         flock(self.f, LOCK_EX)
-        self.f.write(data)
-        self.f.flush()
-        flock(self.f, LOCK_UN)
+        try:
+            if self.f_binary is None:
+                # Another writer may have already started the file, in which
+                # case its format is kept.
+                if os.fstat(self.f.fileno()).st_size == 0:
+                    self.f_binary = self.binary
+                    if self.binary:
+                        self.f.write(binary.encode_header())
+                else:
+                    with open(self.current_log_name, 'rb') as f:
+                        self.f_binary = binary.is_binary(f.read(1))
+
+            if self.f_binary:
+                data = b''.join(binary.encode_record(r) for r in records)
+            else:
+                data = [self.format(r) for r in records]
+                for r in data:
+                    assert b'\n' not in r, '\\n found in %r' % r
+                data.append('')  # to get the final \n
+                data = b'\n'.join(data)
+
+            self.f.write(data)
+            self.f.flush()
+        finally:
+            flock(self.f, LOCK_UN)
+
+    def get_watcher(self):
+        """
+        Return a ``DirectoryWatcher`` for the log directory, or None if
+        inotify can't be used (yet: the directory may not exist).
+        """
+        if self.watcher is None and self.use_inotify:
+            try:
+                self.watcher = DirectoryWatcher(
+                    os.path.dirname(self.path) or '.')
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    log.warn('Polling for log changes, inotify failed: %s',
+                             e)
+                    self.use_inotify = False
+        return self.watcher
+
+    def close_watcher(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def wait_for_change(self):
+        """
+        Block until the log may have changed. Returns False if only existing
+        files have changed, so the list of files doesn't need to be checked
+        again.
+        """
+        if self.watcher is None:
+            # If the watcher can be created now, changes made before it
+            # existed weren't seen, so check again right away.
+            if self.get_watcher() is None:
+                time.sleep(self.sleep_delay)
+            return True
+        events = self.watcher.wait(self.max_latency)
+        if events is None:
+            return True
+        prefix = os.path.basename(self.path) + '.'
+        for mask, name in events:
+            if (mask & IN_Q_OVERFLOW) or (
+                    (mask & (IN_CREATE | IN_MOVED_TO)) and
+                    name.startswith(prefix) and
+                    name[len(prefix):].isdigit()):
+                return True
+        return False
+
+    def segment_names(self):
+        """
+        Return the sorted names of the log files, leaving out sidecar files.
+        """
+        start = len(self.path) + 1
+        return sorted(fn for fn in glob.glob('%s.[0-9]*' % self.path)
+                      if fn[start:].isdigit())
 
     def live_iter_glob(self, start_file):
         """
@@ -60,8 +184,7 @@ class TimeRotatingLog(TextLog):
         """
         last_consumed = None
         while True:
-            fnames = glob.glob('%s.[0-9]*' % self.path)
-            fnames.sort()
+            fnames = self.segment_names()
 
             # Crop fnames to start at ``start_file`` if it is supplied.
             if start_file and (start_file in fnames):
@@ -77,53 +200,435 @@ class TimeRotatingLog(TextLog):
                 if fnames:
                     yield fnames[-1]
                 elif not self.killed.is_set():
-                    time.sleep(self.sleep_delay)
+                    self.wait_for_change()
                 else:
                     break
 
-    def tail_glob(self, start_file, start_offset):
+    def is_closed(self, fname):
         """
-        Return an iterator over all the matching log files, yielding a line at
-        a time. At the end of all available files, poll the last file for new
-        lines and look for new files. If a new file is created, abandon the
-        previous file and follow that one.
+        Return True if a newer log file than ``fname`` exists, so ``fname``
+        will not be written to again.
         """
-        fnames = self.live_iter_glob(start_file=start_file)
-        this_file = next(fnames)
-        f = open(this_file, 'rb')
+        return any(fn > fname for fn in self.segment_names())
 
-        if start_offset:
-            f.seek(start_offset)
+    def segment_format(self, f):
+        """
+        Detect the format of an open log file. Returns ``(is_binary,
+        data_start, record_version)``, or None if the file is too short to
+        tell yet.
+        """
+        f.seek(0)
+        prefix = f.read(binary.segment_header.size)
+        is_binary = binary.is_binary(prefix)
+        if is_binary is None:
+            return None
+        if not is_binary:
+            return False, 0, None
+        if len(prefix) < binary.segment_header.size:
+            return None
+        return True, len(prefix), binary.decode_header(prefix)
 
-        while True:
-            start = f.tell()
+    def skip_damaged(self, fname, start, end, reason):
+        """
+        Report a damaged region of a log file which is being skipped, and copy
+        it to ``quarantine_dir`` if that is set.
+        """
+        log.error('Skipping %d damaged bytes at %s:%d (%s)',
+                  end - start, fname, start, reason)
+        self.damaged_regions += 1
+        self.damaged_bytes += end - start
+        self.skipped.append((fname, start, end))
+        if self.quarantine_dir:
+            if not os.path.exists(self.quarantine_dir):
+                os.makedirs(self.quarantine_dir)
+            with open(fname, 'rb') as f:
+                f.seek(start)
+                data = f.read(end - start)
+            qname = os.path.join(self.quarantine_dir, '%s.%d.damaged' %
+                                 (os.path.basename(fname), start))
+            with open(qname, 'wb') as f:
+                f.write(data)
+
+    def segment_batches(self, fname, offset, size, closed=True,
+                        on_damage=None):
+        """
+        Read a log file from ``offset``, yielding ``(records, end)`` for
+        batches of up to ``size`` parsed records, where ``end`` is the offset
+        just past the batch. The file is mapped into memory and split in bulk,
+        so there are no per-record reads. Batches may be empty, if all of
+        their records were damaged.
+
+        Damaged records are passed to ``on_damage(start, end, reason)``,
+        which defaults to ``skip_damaged()``. If the file is ``closed``, a
+        partial record at the end of it, left by a writer which died, is
+        treated as damaged too.
+        """
+        if on_damage is None:
+            def on_damage(start, end, reason):
+                self.skip_damaged(fname, start, end, reason)
+
+        with open(fname, 'rb') as f:
+            fmt = self.segment_format(f)
+            length = os.fstat(f.fileno()).st_size
+            if fmt is None or length <= offset:
+                return
+            m = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+        is_binary, data_start, record_version = fmt
+        try:
+            pos = max(offset, data_start)
+            if is_binary:
+                batches = self.binary_batches(m, pos, length, size,
+                                              record_version, on_damage)
+            else:
+                batches = self.text_batches(m, pos, length, size, on_damage)
+            for records, pos in batches:
+                yield records, pos
+            if closed and pos < length:
+                on_damage(pos, length, 'partial record at end of file')
+                yield [], length
+        finally:
+            m.close()
+
+    def parse_lines(self, lines, pos, on_damage):
+        """
+        Parse lines of text starting at offset ``pos``, leaving out (and
+        reporting) any which aren't valid records.
+        """
+        parse = self.parse
+        records = []
+        for line in lines:
+            try:
+                vals = parse(line.strip())
+            except UnicodeDecodeError:
+                vals = []
+            if is_valid_list(vals):
+                records.append(vals)
+            else:
+                on_damage(pos, pos + len(line) + 1, 'invalid text record')
+            pos += len(line) + 1
+        return records
+
+    def text_batches(self, m, pos, length, size, on_damage):
+        while pos < length:
+            end = m.find(b'\n', min(pos + self.chunk_bytes, length) - 1)
+            if end < 0:
+                end = m.rfind(b'\n', pos)
+            if end < pos:
+                return
+            lines = m[pos:end].split(b'\n')
+            for ii in range(0, len(lines), size):
+                batch = lines[ii:ii + size]
+                records = self.parse_lines(batch, pos, on_damage)
+                pos += sum(map(len, batch)) + len(batch)
+                yield records, pos
+
+    def binary_batches(self, data, pos, length, size, record_version,
+                       on_damage):
+        decode = binary.decode_payload
+        records = []
+        for payload, end in binary.iter_frames(data, pos, length, on_damage):
+            try:
+                records.append(decode(payload, record_version))
+            except (binary.BinaryLogError, struct.error,
+                    UnicodeDecodeError) as e:
+                on_damage(pos, end, str(e) or 'undecodable record')
+            pos = end
+            if len(records) >= size:
+                yield records, pos
+                records = []
+        # The last batch is always yielded, even if it is empty, so that the
+        # caller sees where reading stopped.
+        yield records, pos
+
+    def read_available(self, fname, f, fmt, offset, size):
+        """
+        Read up to ``size`` complete records from an open log file which may
+        still be written, starting at ``offset``. Returns ``(records,
+        end)``. A record which is still being written is left to be read
+        again once it is complete. ``end`` may be past ``offset`` even if
+        there are no records, if damaged records were skipped.
+        """
+        is_binary, data_start, record_version = fmt
+        offset = max(offset, data_start)
+        if is_binary:
+            return self.read_available_binary(fname, f, offset, size,
+                                              record_version)
+
+        def on_damage(start, end, reason):
+            self.skip_damaged(fname, start, end, reason)
+
+        f.seek(offset)
+        records = []
+        parse_lines = self.parse_lines
+        while len(records) < size:
             line = f.readline()
-            if not line:
-                next_file = next(fnames)
+            if not line.endswith(b'\n'):
+                break
+            records.extend(parse_lines([line[:-1]], offset, on_damage))
+            offset += len(line)
+        return records, offset
+
+    def read_available_binary(self, fname, f, offset, size, record_version):
+        """
+        Like ``read_available()``, for binary files. Data is read
+        ``chunk_bytes`` at a time into ``read_buffer``, which is kept between
+        calls, so reading a few records at a time doesn't read the same data
+        again for each call.
+        """
+        buf_fname, buf_start, data = self.read_buffer or (None, 0, b'')
+        if ((buf_fname != fname) or
+                not (buf_start <= offset <= buf_start + len(data))):
+            buf_start, data = offset, b''
+        pos = offset - buf_start
+
+        # Read more once there is no complete frame left in the buffer.
+        if binary.check_frame(data, pos, len(data)) is None:
+            f.seek(buf_start + len(data))
+            more = f.read(self.chunk_bytes)
+            if more:
+                data = data[pos:] + more
+                buf_start, pos = offset, 0
+                header_size = binary.frame_header.size
+                if len(data) >= header_size:
+                    # Make sure that at least the first frame is complete,
+                    # however large it is.
+                    length = binary.frame_header.unpack_from(data)[1]
+                    if len(data) < header_size + length <= (
+                            header_size + binary.max_payload):
+                        data += f.read(header_size + length - len(data))
+        self.read_buffer = fname, buf_start, data
+
+        def on_damage(start, end, reason):
+            self.skip_damaged(fname, buf_start + start, buf_start + end,
+                              reason)
+
+        records, end = next(self.binary_batches(data, pos, len(data), size,
+                                                record_version, on_damage))
+        return records, buf_start + end
+
+    def index_name(self, fname):
+        return '%s.idx' % fname
+
+    def read_index(self, fname):
+        """
+        Return the sidecar index for a log file, or None if there isn't a
+        usable one. The index records the range of the file which has been
+        checked, the damaged regions found in it, and a checksum of the bytes
+        before the end of the range, so that an index for a file which has
+        since been replaced or truncated isn't trusted.
+        """
+        try:
+            with open(self.index_name(fname), 'rb') as f:
+                index = json.load(f)
+            tail_crc = self.tail_crc(fname, index['checked'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        if tail_crc != index['tail_crc']:
+            return None
+        return index
+
+    def tail_crc(self, fname, end):
+        """
+        Return the CRC-32 of the up to 64 bytes of ``fname`` before ``end``.
+        """
+        with open(fname, 'rb') as f:
+            f.seek(max(end - 64, 0))
+            return zlib.crc32(f.read(min(end, 64))) & 0xffffffff
+
+    def write_index(self, fname, index):
+        """
+        Write the sidecar index for ``fname``. Failures are logged rather
+        than raised, since the index is only an optimization, and nothing is
+        written if ``fname`` itself no longer exists.
+        """
+        iname = self.index_name(fname)
+        try:
+            index['tail_crc'] = self.tail_crc(fname, index['checked'])
+        except (IOError, OSError) as e:
+            log.debug('Not indexing %s: %s', fname, e)
+            return
+        try:
+            with open(iname + '.tmp', 'wb') as f:
+                json.dump(index, f)
+            os.rename(iname + '.tmp', iname)
+        except (IOError, OSError) as e:
+            log.warn('Could not write log index %s: %s', iname, e)
+
+    def update_index(self, fname, start, end, damaged):
+        """
+        Record in the sidecar index for ``fname`` that the range from
+        ``start`` to ``end`` has been checked, with the ``(start, end)``
+        damaged regions found in it. The index is left alone if the range
+        doesn't extend the range it already covers.
+        """
+        if not os.path.exists(fname):
+            # Deleted since it was read, so there is nothing to index.
+            return
+        index = self.read_index(fname)
+        if index is None:
+            index = {'start': start, 'checked': start, 'damaged': []}
+        elif not (index['start'] <= start <= index['checked'] < end):
+            return
+        index['damaged'].extend([s, e] for s, e in damaged
+                                if s >= index['checked'])
+        index['checked'] = end
+        self.write_index(fname, index)
+
+    def finished_with(self, fname, start, end):
+        """
+        Update the index for a file which the reader has read from ``start``
+        to ``end``, and is moving on from.
+        """
+        skipped = self.skipped
+        damaged = [(s, e) for fn, s, e in skipped if fn == fname]
+        self.skipped = [entry for entry in skipped if entry[0] != fname]
+        if end > start:
+            self.update_index(fname, start, end, damaged)
+
+    def scan(self, start_file=None, start_offset=None):
+        """
+        Check each log file from ``start_file`` onwards for damaged records,
+        reporting any that are found. Each file is only read from the end of
+        the range recorded in its sidecar index, and the first from no
+        earlier than ``start_offset``. Returns a list of ``(fname, start, end,
+        reason)`` for the damaged regions found.
+        """
+        damaged = []
+        fnames = self.segment_names()
+        if start_file in fnames:
+            fnames = fnames[fnames.index(start_file):]
+        for fname in fnames:
+            index = self.read_index(fname)
+            begin = index['checked'] if index else 0
+            if fname == start_file:
+                begin = max(begin, start_offset or 0)
+            found = []
+
+            def on_damage(start, end, reason):
+                log.error('Damaged log: %d bytes at %s:%d (%s)',
+                          end - start, fname, start, reason)
+                found.append((start, end))
+                damaged.append((fname, start, end, reason))
+
+            checked = begin
+            for records, end in self.segment_batches(
+                    fname, begin, 10000, closed=(fname != fnames[-1]),
+                    on_damage=on_damage):
+                checked = end
+            if checked > begin:
+                self.update_index(fname, begin, checked, found)
+        return damaged
+
+    def tail_batches(self, start_file, start_offset, size):
+        """
+        Return an iterator over all the matching log files, yielding
+        ``(fname, records, end)`` for batches of up to ``size`` parsed
+        records, where ``end`` is the offset in ``fname`` just past the
+        batch. At the end of all available files, wait for the last file to
+        grow and look for new files. If a new file is created, abandon the
+        previous file and follow that one.
+
+        Batches from the file being followed are yielded as soon as no more
+        records are available, rather than waiting for ``size`` records.
+        """
+        # Start watching before reading anything, so that no change after
+        # the initial read can be missed.
+        self.get_watcher()
+        f = None
+        try:
+            fnames = self.live_iter_glob(start_file=start_file)
+            this_file = next(fnames)
+            offset = start_offset or 0
+
+            while True:
+                if f is None:
+                    if self.is_closed(this_file):
+                        end = offset
+                        for records, end in self.segment_batches(
+                                this_file, offset, size):
+                            if records:
+                                yield this_file, records, end
+                        self.finished_with(this_file, offset, end)
+                        this_file = next(fnames)
+                        offset = 0
+                        continue
+                    f = open(this_file, 'rb')
+                    fmt = None
+                    rescan = True
+                    file_start = offset
+
+                if fmt is None:
+                    fmt = self.segment_format(f)
+                if fmt is not None:
+                    records, end = self.read_available(this_file, f, fmt,
+                                                       offset, size)
+                    if end != offset:
+                        offset = end
+                        if records:
+                            yield this_file, records, offset
+                        continue
+
+                if rescan or self.killed.is_set():
+                    next_file = next(fnames)
+                else:
+                    next_file = this_file
                 if next_file != this_file:
+                    f.close()
+                    f = None
+                    self.read_buffer = None
+                    self.finished_with(this_file, file_start, offset)
                     this_file = next_file
-                    f = open(this_file, 'rb')
+                    offset = 0
                 elif not self.killed.is_set():
-                    time.sleep(self.sleep_delay)
-                    f.seek(start)
+                    if self.on_idle:
+                        self.on_idle()
+                    rescan = self.wait_for_change()
                 else:
                     break
-            else:
-                pointer = '%s:%d' % (this_file, f.tell())
-                yield line, pointer
+        finally:
+            self.read_buffer = None
+            if f is not None:
+                f.close()
+                self.finished_with(this_file, file_start, offset)
+            self.close_watcher()
 
-    def process(self, process_from=None, stay_alive=False, killed_event=None):
+    def start(self, process_from, stay_alive, killed_event, on_idle=None):
+        """
+        Set up for processing, returning the file and offset to start at.
+        ``on_idle()`` is called each time the reader is about to wait for the
+        log to change.
+        """
         if not stay_alive:
             self.killed.set()
         if killed_event:
             self.killed = killed_event
+        self.on_idle = on_idle
 
+        start_file, start_offset = None, None
         if process_from:
             start_file, start_offset = process_from.rsplit(':', 1)
             start_offset = int(start_offset)
-        else:
-            start_file = start_offset = None
+        # Without a pointer, every file will be read (and indexed) anyway.
+        if self.scan_on_start and start_file:
+            self.scan(start_file, start_offset)
+        return start_file, start_offset
+
+    def process(self, process_from=None, stay_alive=False, killed_event=None,
+                on_idle=None):
+        start_file, start_offset = self.start(process_from, stay_alive,
+                                              killed_event, on_idle)
+        for fname, records, end in self.tail_batches(start_file,
+                                                     start_offset, 1):
+            yield records[0], '%s:%d' % (fname, end)
 
-        for line, pointer in self.tail_glob(start_file=start_file,
-                                            start_offset=start_offset):
-            yield self.parse(line.strip()), pointer
+    def process_batches(self, size=1000, process_from=None, stay_alive=False,
+                        killed_event=None, on_idle=None):
+        """
+        Like ``process()``, but yielding ``(records, pointer)`` for lists of
+        up to ``size`` records, where ``pointer`` follows the last of them.
+        """
+        start_file, start_offset = self.start(process_from, stay_alive,
+                                              killed_event, on_idle)
+        for fname, records, end in self.tail_batches(start_file,
+                                                     start_offset, size):
+            yield records, '%s:%d' % (fname, end)
@@ -0,0 +1,24 @@
+from __future__ import absolute_import, division, print_function
+import logging
+import argparse
+
+from manhattan.backend.persistence.sql import SQLPersistentStore
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description='Convert a Manhattan database written by an older '
+        'version to the current storage format.')
+    p.add_argument('-u', '--url', dest='url', type=str, required=True,
+                   help='SQL backend URL')
+    p.add_argument('--batch-size', type=int, default=1000,
+                   help='Number of rows to convert per transaction')
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    store = SQLPersistentStore(args.url)
+    counters = store.migrate_counters(batch_size=args.batch_size)
+    print('Migrated %d counter rows.' % counters)
+    histories = store.migrate_visitor_histories(batch_size=args.batch_size)
+    print('Migrated %d visitor histories.' % histories)
@@ -51,3 +51,16 @@ class SplitRecord(Record):
 
 _record_types = {cls.key: cls for cls in
                  (PageRecord, PixelRecord, GoalRecord, SplitRecord)}
+
+
+def is_valid_list(vals):
+    """
+    Return True if ``vals`` is a list of values which ``Record.from_list()``
+    can load: the current log version, a known record type, and no more
+    fields than it has. Missing trailing fields are left empty.
+    """
+    if len(vals) < 2 or vals[0] != unicode(log_version):
+        return False
+    cls = _record_types.get(vals[1])
+    return ((cls is not None) and
+            (len(vals) <= 2 + len(cls.base_fields) + len(cls.fields)))
@@ -176,3 +176,4 @@ def main(killed_event=None):
         worker.run(stay_alive=True, killed_event=killed_event)
     finally:
         server.kill()
+        backend.close()
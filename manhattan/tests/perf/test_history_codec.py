@@ -0,0 +1,80 @@
+from __future__ import absolute_import, division, print_function
+
+import cPickle as pickle
+from time import time
+
+from manhattan.record import PageRecord
+from manhattan.backend.model import (VisitorHistory, encode_history,
+                                     decode_history)
+
+
+def make_history(days=30, goals=10, tests=3, queued=0):
+    """
+    Build a history resembling a long-lived returning visitor, who has been
+    active on ``days`` separate days, converting on ``goals`` goals and seeing
+    ``tests`` tests each day.
+    """
+    history = VisitorHistory()
+    history.nonbot = not queued
+    history.user_agents.add(u'Mozilla/5.0 (Macintosh) Chrome/30.0')
+    history.ips.add(u'10.0.0.1')
+
+    test_names = [u'test number %d' % ii for ii in range(tests)]
+    for name in test_names:
+        history.variants.add((name, u'True'))
+
+    for ii in range(queued):
+        history.nonbot_queue.append(PageRecord(
+            timestamp=u'%d.1234' % (1350000000 + ii), vid=u'0' * 40,
+            site_id=u'1', ip=u'10.0.0.1', method=u'GET',
+            url=u'/some/page/%d' % ii, user_agent=u'ScroogleBot',
+            referer=u''))
+
+    for day in range(days):
+        day_bucket = 1350000000.0 + (day * 86400)
+        week_bucket = 1350000000.0 + ((day // 7) * 604800)
+        for goal in range(goals):
+            goal_name = u'goal number %d' % goal
+            history.goals.add(goal_name)
+            for rollup_key, bucket_id in (('all', 0),
+                                          ('pst_day', day_bucket),
+                                          ('pst_week', week_bucket),
+                                          ('browser', u'Chrome')):
+                history.conversion_keys.add(
+                    (goal_name, rollup_key, bucket_id, 1))
+                for name in test_names:
+                    history.variant_conversion_keys.add(
+                        (goal_name, name, u'True', rollup_key, bucket_id, 1))
+                    history.impression_keys.add(
+                        (name, u'True', rollup_key, bucket_id, 1))
+    return history
+
+
+def bench(label, history, trials=200):
+    pickled = pickle.dumps(history, 2)
+    encoded = encode_history(history)
+    print("%s: pickle %d bytes, codec %d bytes (%0.0f%%)" %
+          (label, len(pickled), len(encoded),
+           100. * len(encoded) / len(pickled)))
+
+    for name, dumps, loads, data in (
+            ('pickle', lambda h: pickle.dumps(h, 2), pickle.loads, pickled),
+            ('codec', encode_history, decode_history, encoded)):
+        start = time()
+        for ii in range(trials):
+            dumps(history)
+        mid = time()
+        for ii in range(trials):
+            loads(data)
+        end = time()
+        print("    %-6s encode %0.3f ms, decode %0.3f ms" %
+              (name, 1000. * (mid - start) / trials,
+               1000. * (end - mid) / trials))
+
+
+if __name__ == '__main__':
+    bench("New visitor", make_history(days=1, goals=1, tests=0))
+    bench("Returning visitor", make_history(days=5, goals=5, tests=1))
+    bench("Long-lived visitor", make_history(days=30, goals=10, tests=3))
+    bench("Bot", make_history(days=0, goals=0, tests=0, queued=500),
+          trials=50)
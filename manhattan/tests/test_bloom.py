@@ -0,0 +1,46 @@
+from __future__ import absolute_import, division, print_function
+import os
+
+from manhattan.backend.bloom import BloomFilter
+
+from .base import BaseTest, work_dir, work_path
+
+
+class TestBloomFilter(BaseTest):
+
+    def test_membership(self):
+        bf = BloomFilter(1000, error_rate=0.01)
+        added = [u'vid-%d' % ii for ii in range(1000)]
+        bf.update(added)
+
+        for vid in added:
+            self.assertIn(vid, bf)
+
+        false_positives = sum(1 for ii in range(10000)
+                              if (u'other-%d' % ii) in bf)
+        self.assertLess(false_positives, 300)
+        self.assertAlmostEqual(bf.false_positive_rate(), 0.01, places=2)
+
+    def test_save_load(self):
+        os.makedirs(work_dir)
+        path = work_path('vids.bloom')
+
+        bf = BloomFilter(100)
+        bf.update(['a', 'b', 'c'])
+        bf.tag = u'log.123:456'
+        bf.save(path)
+
+        loaded = BloomFilter.load(path)
+        self.assertEqual(loaded.tag, u'log.123:456')
+        self.assertEqual(loaded.count, 3)
+        self.assertEqual(loaded.bits, bf.bits)
+        self.assertIn('b', loaded)
+
+    def test_load_bad_file(self):
+        os.makedirs(work_dir)
+        path = work_path('junk.bloom')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+
+        with self.assertRaises(ValueError):
+            BloomFilter.load(path)
@@ -0,0 +1,232 @@
+from __future__ import absolute_import, division, print_function
+from unittest import TestCase
+
+from manhattan.backend.cache import DeferredLRUCache, QueryCache
+
+
+class FakeBackend(object):
+
+    def __init__(self, data=None):
+        self.data = data or {}
+        self.gets = []
+        self.get_manys = []
+
+    def get(self, key):
+        self.gets.append(key)
+        return self.data[key]
+
+    def get_many(self, keys):
+        self.get_manys.append(sorted(keys))
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def put(self, entries):
+        self.data.update(entries)
+
+
+class TestDeferredLRUCache(TestCase):
+
+    def _make_cache(self, backend, **kwargs):
+        return DeferredLRUCache(get_backend=backend.get,
+                                put_backend=backend.put,
+                                **kwargs)
+
+    def test_get_many(self):
+        backend = FakeBackend({'a': 1, 'b': 2, 'c': 3})
+        cache = self._make_cache(backend, get_many_backend=backend.get_many)
+        cache.get('a')
+
+        found = cache.get_many(['a', 'b', 'c', 'd'])
+        self.assertEqual(found, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(backend.get_manys, [['b', 'c', 'd']])
+
+        # Loaded values are now served from the cache.
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(backend.gets, ['a'])
+
+    def test_get_many_without_backend(self):
+        backend = FakeBackend({'a': 1, 'b': 2})
+        cache = self._make_cache(backend)
+
+        found = cache.get_many(['a', 'b', 'c'])
+        self.assertEqual(found, {'a': 1, 'b': 2})
+        self.assertEqual(sorted(backend.gets), ['a', 'b', 'c'])
+
+    def test_missing(self):
+        backend = FakeBackend({'a': 1})
+        cache = self._make_cache(backend, get_many_backend=backend.get_many,
+                                 max_missing=2)
+
+        # Keys which the backend doesn't have are only looked up once.
+        for ii in range(3):
+            with self.assertRaises(KeyError):
+                cache.get('b')
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1})
+        with self.assertRaises(KeyError):
+            cache.get('c')
+        self.assertEqual(backend.gets, ['b'])
+        self.assertEqual(backend.get_manys, [['a', 'c']])
+
+        # Putting a key forgets that it was missing.
+        cache.put('b', 2)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertNotIn('b', cache.missing)
+
+        # Only ``max_missing`` missing keys are remembered.
+        for key in 'def':
+            with self.assertRaises(KeyError):
+                cache.get(key)
+        self.assertEqual(list(cache.missing), ['e', 'f'])
+
+    def test_missing_max_bytes(self):
+        backend = FakeBackend()
+        cache = self._make_cache(backend, get_many_backend=backend.get_many,
+                                 max_size=None, max_bytes=40, sizeof=len,
+                                 max_missing=3)
+
+        # Missing keys are bounded even when entries are limited by size.
+        for key in range(10):
+            with self.assertRaises(KeyError):
+                cache.get(key)
+        cache.get_many(range(10, 20))
+        self.assertEqual(list(cache.missing), [17, 18, 19])
+
+    def test_evict_dirty(self):
+        backend = FakeBackend()
+        cache = self._make_cache(backend, max_size=2)
+
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.put('c', 3)
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+        self.assertEqual(cache.pending, {'a': 1})
+        self.assertIn('a', cache)
+
+        # Reading an evicted value returns it from the pending buffer, and
+        # keeps it dirty.
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(backend.gets, [])
+        self.assertEqual(cache.pending, {'b': 2})
+
+        cache.flush()
+        self.assertEqual(backend.data, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(cache.pending, {})
+        self.assertEqual(cache.dirty, set())
+
+    def test_evict_clean(self):
+        backend = FakeBackend({'a': 1, 'b': 2, 'c': 3})
+        cache = self._make_cache(backend, max_size=2)
+
+        for key in ('a', 'b', 'c'):
+            cache.get(key)
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+        self.assertEqual(cache.pending, {})
+        self.assertNotIn('a', cache)
+
+    def test_max_bytes(self):
+        backend = FakeBackend({'a': 'x' * 10, 'b': 'x' * 10, 'c': 'x' * 30})
+        cache = self._make_cache(backend, max_size=None, max_bytes=40,
+                                 sizeof=len)
+
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(cache.total_bytes, 20)
+        cache.get('c')
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+        self.assertEqual(cache.total_bytes, 40)
+
+        # Growing an entry evicts older entries to make room.
+        cache.put('c', 'x' * 35)
+        self.assertEqual(list(cache.entries), ['c'])
+        self.assertEqual(cache.total_bytes, 35)
+
+    def test_segmented_scan_resistance(self):
+        backend = FakeBackend({key: key for key in 'abcdefghij'})
+        cache = self._make_cache(backend, max_size=4, protected_fraction=0.5)
+
+        # 'a' and 'b' are used twice, so they are promoted.
+        for key in 'abab':
+            cache.get(key)
+        self.assertEqual(list(cache.protected), ['a', 'b'])
+
+        # A scan over keys which are used once only churns the probationary
+        # segment.
+        for key in 'cdefghij':
+            cache.get(key)
+        self.assertEqual(list(cache.protected), ['a', 'b'])
+        self.assertEqual(list(cache.entries), ['i', 'j'])
+
+        # Promoting a third key demotes the least recently used protected key.
+        cache.get('j')
+        self.assertEqual(list(cache.protected), ['b', 'j'])
+        self.assertEqual(list(cache.entries), ['i', 'a'])
+
+    def test_prefetch_does_not_promote(self):
+        backend = FakeBackend({'a': 1, 'b': 2})
+        cache = self._make_cache(backend, get_many_backend=backend.get_many,
+                                 protected_fraction=0.5)
+        cache.get_many(['a', 'b'])
+        cache.get('a')
+        self.assertEqual(list(cache.protected), [])
+        cache.get('a')
+        self.assertEqual(list(cache.protected), ['a'])
+
+    def test_probationary_capacity(self):
+        backend = FakeBackend({key: 'x' * 10 for key in 'abcd'})
+        cache = self._make_cache(backend, max_size=10,
+                                 protected_fraction=0.8)
+        self.assertEqual(cache.probationary_capacity(), 2)
+
+        # When limited by bytes, it depends on the average entry size.
+        cache = self._make_cache(backend, max_size=None, max_bytes=200,
+                                 sizeof=len, protected_fraction=0.5)
+        self.assertIsNone(cache.probationary_capacity())
+        cache.get('a')
+        self.assertEqual(cache.probationary_capacity(), 10)
+
+    def test_stats(self):
+        backend = FakeBackend({'a': 1, 'b': 2, 'c': 3})
+        cache = self._make_cache(backend, max_size=2)
+        for key in 'abac':
+            cache.get(key)
+        cache.put('c', 4)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['hit_rate'], 0.25)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['dirty'], 1)
+
+
+class TestQueryCache(TestCase):
+
+    def test_get(self):
+        calls = []
+
+        def compute(value):
+            def f():
+                calls.append(value)
+                return value
+            return f
+
+        cache = QueryCache(max_size=2)
+        self.assertEqual(cache.get('a', compute(1)), 1)
+        self.assertEqual(cache.get('a', compute(2)), 1)
+        self.assertEqual(cache.get('b', compute(3)), 3)
+        self.assertEqual(cache.get('a', compute(4)), 1)
+        # 'b' is the least recently used.
+        cache.get('c', compute(5))
+        self.assertEqual(cache.get('b', compute(6)), 6)
+        self.assertEqual(calls, [1, 3, 5, 6])
+
+        cache.clear()
+        self.assertEqual(cache.get('a', compute(7)), 7)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 5)
+
+    def test_disabled(self):
+        cache = QueryCache(max_size=0)
+        cache.get('a', lambda: 1)
+        self.assertEqual(cache.get('a', lambda: 2), 2)
+        self.assertEqual(len(cache), 0)
@@ -1,19 +1,24 @@
 from __future__ import absolute_import, division, print_function
 
+import time
 import logging
 
 from decimal import Decimal
+from threading import Event, Thread
 import warnings
 
-from sqlalchemy import MetaData, create_engine
+from sqlalchemy import MetaData, create_engine, event
 from sqlalchemy.exc import SAWarning
 
 from manhattan.worker import Worker
+from manhattan.record import Record, PageRecord, PixelRecord, SplitRecord
 
 from manhattan.log.memory import MemoryLog
 from manhattan.log.timerotating import TimeRotatingLog
 
-from manhattan.backend import Backend
+from manhattan.backend import Backend, default_rollups
+from manhattan.backend.flush import FlushPolicy
+from manhattan.backend.fanout import FanoutConfig
 
 from . import data
 from .base import BaseTest, work_path
@@ -42,6 +47,15 @@ def drop_existing_tables(engine):
         table.drop(bind=engine)
 
 
+class HourRollup(object):
+
+    def get_bucket(self, timestamp, history):
+        return float(timestamp - timestamp % 3600)
+
+    def bucket_end(self, bucket_id):
+        return bucket_id + 3600
+
+
 class TestCombinations(BaseTest):
 
     def _check_backend_queries(self, backend):
@@ -112,12 +126,16 @@ class TestCombinations(BaseTest):
             {'True': [2, 0, 2, Decimal('64.99')],
              'False': [2, 0, 2, Decimal('43.2')]})
 
-    def _get_backend(self, reset=False):
+    def _get_backend(self, reset=False, **kwargs):
         url = 'sqlite:////tmp/manhattan-test.db'
         if reset:
             drop_existing_tables(create_engine(url))
-        return Backend(url, flush_every=2, cache_size=5,
-                       complex_goals=data.test_complex_goals)
+        # The test clickstream is far in the past, so don't let the flush
+        # policy treat it as a backlog to catch up on.
+        kwargs.setdefault('flush_policy',
+                          FlushPolicy(every=2, catchup_lag=None))
+        kwargs.setdefault('cache_size', 5)
+        return Backend(url, complex_goals=data.test_complex_goals, **kwargs)
 
     def test_resume(self):
         path = work_path('resume')
@@ -170,3 +188,559 @@ class TestCombinations(BaseTest):
         worker1.run(resume=False)
 
         self._check_backend_queries(backend)
+
+    def test_vid_filter(self):
+        path = work_path('vid-filter')
+        filter_path = work_path('vids.bloom')
+
+        backend = self._get_backend(reset=True, vid_filter_capacity=1000,
+                                    vid_filter_path=filter_path)
+
+        log_w = TimeRotatingLog(path)
+        data.run_clickstream(log_w, first=0, last=25)
+
+        worker1 = Worker(TimeRotatingLog(path), backend)
+        worker1.run()
+        backend.save_vid_filter()
+        self.assertIn(u'a', backend.known_vids)
+
+        # A fresh backend should reuse the saved filter, since it was saved
+        # at the persisted pointer.
+        backend = self._get_backend(reset=False, vid_filter_capacity=1000,
+                                    vid_filter_path=filter_path)
+        self.assertEqual(backend.known_vids.tag, backend.get_pointer())
+        self.assertIn(u'a', backend.known_vids)
+
+        data.run_clickstream(log_w, first=25)
+        worker2 = Worker(TimeRotatingLog(path), backend)
+        worker2.run(resume=True)
+
+        self._check_backend_queries(backend)
+
+    def test_small_cache(self):
+        log = MemoryLog()
+        data.run_clickstream(log)
+
+        # Dirty histories will be evicted many times between flushes.
+        backend = self._get_backend(reset=True)
+        backend.flush_policy.every = 1000
+        for cache in (backend.visitors, backend.tests, backend.goals):
+            cache.max_size = 1
+
+        worker1 = Worker(log, backend)
+        worker1.run(resume=False)
+
+        self._check_backend_queries(backend)
+
+    def test_byte_limited_cache(self):
+        log = MemoryLog()
+        data.run_clickstream(log)
+
+        backend = self._get_backend(reset=True, cache_bytes=20000)
+
+        worker1 = Worker(log, backend)
+        worker1.run(resume=False)
+
+        self.assertGreater(backend.visitors.evictions, 0)
+        self.assertLessEqual(backend.visitors.total_bytes, 20000)
+        self._check_backend_queries(backend)
+
+    def test_background_flush(self):
+        path = work_path('background-flush')
+
+        backend = self._get_backend(reset=True, background_flush=True)
+
+        log_w = TimeRotatingLog(path)
+        data.run_clickstream(log_w, first=0, last=25)
+
+        worker1 = Worker(TimeRotatingLog(path), backend)
+        worker1.run()
+        backend.close()
+        self.assertEqual(len(backend.inflight), 0)
+
+        backend = self._get_backend(reset=False, background_flush=True,
+                                    max_pending_flushes=1)
+
+        data.run_clickstream(log_w, first=25)
+        worker2 = Worker(TimeRotatingLog(path), backend)
+        worker2.run(resume=True)
+
+        # Queries include batches which may not have been committed yet.
+        self._check_backend_queries(backend)
+        backend.wait_for_flushes()
+        self._check_backend_queries(backend)
+        backend.close()
+
+    def test_idle_flush(self):
+        path = work_path('idle-flush')
+        backend = self._get_backend(
+            reset=True, flush_policy=FlushPolicy(every=1000, interval=0.05))
+        log_w = TimeRotatingLog(path)
+        data.run_clickstream(log_w, first=0, last=25)
+
+        log_r = TimeRotatingLog(path)
+        log_r.sleep_delay = 0.01
+        killed = Event()
+        worker = Worker(log_r, backend)
+        thread = Thread(target=worker.run,
+                        kwargs=dict(resume=False, stay_alive=True,
+                                    killed_event=killed))
+        thread.start()
+        try:
+            # The records are flushed while the worker waits for more,
+            # without another record arriving.
+            for ii in range(200):
+                if backend.store.get_pointer():
+                    break
+                time.sleep(0.01)
+        finally:
+            killed.set()
+            thread.join()
+        self.assertEqual(backend.store.get_pointer(), backend.pointer)
+        self.assertEqual(backend.records_since_flush, 0)
+
+    def test_idle_drains_window(self):
+        path = work_path('idle-window')
+        backend = self._get_backend(
+            reset=True, flush_policy=FlushPolicy(every=1000, interval=0.05))
+        log_w = TimeRotatingLog(path)
+        data.run_clickstream(log_w, first=0, last=25)
+        entries = list(TimeRotatingLog(path).process())
+
+        # The records are old, so they are read ahead into a window which
+        # never fills, but are still handled and flushed while the worker
+        # waits for more.
+        log_r = TimeRotatingLog(path)
+        log_r.sleep_delay = 0.01
+        killed = Event()
+        worker = Worker(log_r, backend, batch_size=None, prefetch_size=1000)
+        thread = Thread(target=worker.run,
+                        kwargs=dict(resume=False, stay_alive=True,
+                                    killed_event=killed))
+        thread.start()
+        try:
+            for ii in range(200):
+                if backend.store.get_pointer():
+                    break
+                time.sleep(0.01)
+        finally:
+            killed.set()
+            thread.join()
+        self.assertEqual(worker.num_records, len(entries))
+        self.assertEqual(backend.store.get_pointer(), entries[-1][1])
+
+    def test_batched_results(self):
+        log = MemoryLog()
+        data.run_clickstream(log)
+
+        backend = self._get_backend(reset=True)
+        worker1 = Worker(log, backend)
+        worker1.run(resume=False)
+
+        goals = [u'viewed page', u'completed checkout', u'order margin',
+                 u'margin per session']
+        expected = {}
+        for name, selected in backend.tests.get(u'red checkout form').variants:
+            expected[selected] = [
+                backend.goal_value(goal, (name, selected), site_id=1)
+                for goal in goals]
+
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(backend.store.engine, 'before_cursor_execute',
+                     before_execute)
+        try:
+            results = backend.results(u'red checkout form', goals, site_id=1)
+        finally:
+            event.remove(backend.store.engine, 'before_cursor_execute',
+                         before_execute)
+
+        self.assertEqual(results, expected)
+        self.assertEqual(len(statements), 1)
+
+        # Repeated queries are answered from the query cache until the next
+        # flush is committed.
+        del statements[:]
+        event.listen(backend.store.engine, 'before_cursor_execute',
+                     before_execute)
+        try:
+            self.assertEqual(
+                backend.results(u'red checkout form', goals, site_id=1),
+                expected)
+            backend.all_tests()
+            backend.all_tests()
+            self.assertEqual(len(statements), 1)
+            backend.flush()
+            del statements[:]
+            backend.results(u'red checkout form', goals, site_id=1)
+            self.assertEqual(len(statements), 1)
+        finally:
+            event.remove(backend.store.engine, 'before_cursor_execute',
+                         before_execute)
+
+    def test_series(self):
+        log = MemoryLog()
+        data.run_clickstream(log)
+
+        # The clickstream only covers a couple of hours. Leave some counters
+        # unflushed.
+        rollups = dict(default_rollups, hour=HourRollup())
+        backend = self._get_backend(reset=True, rollups=rollups,
+                                    flush_policy=FlushPolicy(every=20))
+        worker1 = Worker(log, backend, batch_size=None)
+        worker1.run(resume=False)
+        self.assertTrue(backend.inc_conversions)
+
+        variant = (u'red checkout form', u'True')
+        for kwargs in [dict(goal=u'viewed page'),
+                       dict(variant=variant),
+                       dict(goal=u'completed checkout', variant=variant)]:
+            series = backend.count_series(rollup_key='hour', site_id=1,
+                                          **kwargs)
+            self.assertTrue(series)
+            self.assertEqual(series, sorted(series))
+            for bucket_id, count in series:
+                self.assertEqual(
+                    count, backend.count(rollup_key='hour',
+                                         bucket_id=bucket_id, site_id=1,
+                                         **kwargs))
+
+        # Ranges include the start bucket, and exclude the end bucket.
+        series = backend.count_series(u'viewed page', rollup_key='hour',
+                                      site_id=1)
+        self.assertEqual([bucket_id for bucket_id, count in series],
+                         [0, 3600, 7200])
+        self.assertEqual(
+            backend.count_series(u'viewed page', rollup_key='hour',
+                                 site_id=1, start=3600, end=7200),
+            series[1:2])
+
+        goals = [u'viewed page', u'add to cart', u'completed checkout',
+                 u'margin per session']
+        series = backend.results_series(u'red checkout form', goals,
+                                        rollup_key='hour', site_id=1)
+        self.assertEqual(sorted(series), ['False', 'True'])
+        for selected, buckets in series.iteritems():
+            self.assertTrue(buckets)
+            for bucket_id, values in buckets:
+                self.assertEqual(
+                    values,
+                    backend.results(u'red checkout form', goals, site_id=1,
+                                    rollup_key='hour',
+                                    bucket_id=bucket_id)[selected])
+
+        # Series queries wait for records which are being counted, rather
+        # than iterating over counters which are changing.
+        found = []
+        with backend.counter_lock:
+            thread = Thread(target=lambda: found.append(
+                backend.count_series(u'viewed page', rollup_key='hour',
+                                     site_id=1)))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        self.assertEqual(found, [backend.count_series(
+            u'viewed page', rollup_key='hour', site_id=1)])
+
+    def test_prune_histories(self):
+        log = MemoryLog()
+        data.run_clickstream(log)
+
+        rollups = dict(default_rollups, hour=HourRollup())
+        backend = self._get_backend(reset=True, rollups=rollups,
+                                    dedup_lateness=600)
+        worker1 = Worker(log, backend)
+        worker1.run(resume=False)
+        cutoff = backend.latest_timestamp - 600
+        self.assertGreater(cutoff, 3600)
+
+        # Histories are pruned when they are written.
+        vids = list(backend.store.iter_visitor_ids())
+        for vid, history in backend.get_visitor_histories(vids).iteritems():
+            backend.visitors.put(vid, history)
+        backend.flush()
+
+        histories = backend.store.get_visitor_histories(vids)
+        rollup_keys = set()
+        for history in histories.itervalues():
+            for keys in (history.conversion_keys, history.impression_keys,
+                         history.variant_conversion_keys):
+                for key in keys:
+                    rollup_keys.add(key[-3])
+                    if key[-3] == 'hour':
+                        self.assertGreaterEqual(key[-2], 3600)
+        self.assertIn('hour', rollup_keys)
+        self.assertIn('all', rollup_keys)
+        self._check_backend_queries(backend)
+
+    def test_pending_records(self):
+        log = MemoryLog()
+        data.run_clickstream(log)
+
+        backend = self._get_backend(reset=True)
+        worker1 = Worker(log, backend)
+        worker1.run(resume=False)
+        self._check_backend_queries(backend)
+
+        # Bots never get a history, just pending records. Visitors who
+        # loaded the pixel have none left.
+        store = backend.store
+        self.assertNotIn(u'bot', list(store.iter_visitor_ids()))
+        self.assertEqual(list(store.iter_pending_visitor_ids()), [u'bot'])
+        recs = store.get_pending_records(u'bot')
+        self.assertEqual(len(recs), 6)
+        self.assertEqual(recs[-1].url, u'http://localhost/fruit/cherries')
+        self.assertEqual(recs[-1].vid, u'bot')
+
+        # Pending records expire once they are older than the TTL.
+        backend.pending_ttl = backend.latest_timestamp - 1500
+        backend.flush()
+        self.assertEqual(len(store.get_pending_records(u'bot')), 4)
+
+    def test_bot_history_not_reloaded(self):
+        backend = self._get_backend(reset=True)
+        store = backend.store
+        loads = []
+        get_visitor_history = store.get_visitor_history
+
+        def counting_get_visitor_history(vid):
+            loads.append(vid)
+            return get_visitor_history(vid)
+
+        store.get_visitor_history = counting_get_visitor_history
+        for ii in range(100):
+            rec = PageRecord(timestamp=str(1000 + ii), vid=u'bot%d' % (ii % 2),
+                             site_id='1', url=u'/page/%d' % ii)
+            backend.handle(rec, None)
+        backend.flush()
+
+        # Bots have no history, but that is remembered after the first
+        # lookup, even across flushes.
+        self.assertLessEqual(len(loads), 2)
+        self.assertEqual(len(store.get_pending_records(u'bot0')), 50)
+
+    def test_prefetch_chunks(self):
+        backend = self._get_backend(reset=True)
+        vids = [u'vid%d' % ii for ii in range(10)]
+        for vid in vids:
+            backend.handle(PixelRecord(timestamp='1000', vid=vid, site_id='1'),
+                           None)
+        backend.flush()
+
+        # With 20 entries, 4 of which are probationary, histories are loaded
+        # 2 at a time, just before they are used.
+        backend = self._get_backend(cache_size=20)
+        store = backend.store
+        loads = []
+        get_visitor_history = store.get_visitor_history
+        get_visitor_histories = store.get_visitor_histories
+
+        def counting_get_visitor_history(vid):
+            loads.append([vid])
+            return get_visitor_history(vid)
+
+        def counting_get_visitor_histories(vids):
+            loads.append(sorted(vids))
+            return get_visitor_histories(vids)
+
+        store.get_visitor_history = counting_get_visitor_history
+        store.get_visitor_histories = counting_get_visitor_histories
+        backend.handle_batch(
+            [PageRecord(timestamp='1001', vid=vid, site_id='1', url=u'/')
+             for vid in vids], None)
+        self.assertEqual(loads, [sorted(vids[ii:ii + 2])
+                                 for ii in range(0, 10, 2)])
+        self.assertEqual(backend.count(u'viewed page', site_id=1), 10)
+
+    def test_unchanged_not_written(self):
+        log = MemoryLog()
+        data.run_clickstream(log)
+        records = [Record.from_list(vals) for vals in log.q]
+
+        backend = self._get_backend(reset=True)
+        worker1 = Worker(log, backend)
+        worker1.run(resume=False)
+        backend.flush()
+
+        # Replaying the same records changes no counts, so no histories,
+        # tests or goals should be written either.
+        for rec in records:
+            backend.handle(rec, None)
+        for cache in (backend.visitors, backend.tests, backend.goals):
+            self.assertEqual(cache.unflushed(), {})
+        self.assertEqual(backend.count(u'add to cart', site_id=1), 5)
+
+    def test_repeat_impressions_not_written(self):
+        backend = self._get_backend(reset=True)
+        store = backend.store
+        written = []
+        put_test = store.put_test
+
+        def counting_put_test(tests):
+            written.extend(tests)
+            return put_test(tests)
+
+        store.put_test = counting_put_test
+
+        def impressions(start):
+            for ts in range(start, start + 100, 10):
+                backend.handle(SplitRecord(timestamp=str(ts), vid=u'a',
+                                           site_id='1', test_name=u'foo',
+                                           selected=u'x'), None)
+
+        backend.handle(PixelRecord(timestamp='1000', vid=u'a', site_id='1'),
+                       None)
+        impressions(1000)
+        backend.flush()
+        self.assertEqual(written, [u'foo'])
+
+        # Repeat impressions of a variant don't rewrite the test, but the
+        # exact last timestamp is still reported.
+        impressions(1100)
+        backend.flush()
+        impressions(1200)
+        backend.flush()
+        self.assertEqual(written, [u'foo'])
+        self.assertEqual(backend.all_tests(), [(u'foo', 1000, 1290)])
+
+        # Once the last timestamp has moved on far enough, it is written.
+        impressions(5000)
+        backend.flush()
+        self.assertEqual(written, [u'foo', u'foo'])
+        self.assertEqual(store.get_test(u'foo').last_timestamp, 5000)
+
+    def test_fanout(self):
+        log = MemoryLog()
+        data.run_clickstream(log)
+
+        fanout = FanoutConfig(goal_rollups={u'viewed page': ['all']},
+                              test_rollups={u'red checkout form': ['all']},
+                              variant_goals=[u'completed checkout'])
+        backend = self._get_backend(reset=True, fanout=fanout)
+        worker1 = Worker(log, backend)
+        worker1.run(resume=False)
+
+        self.assertEqual(backend.count(u'viewed page', site_id=1), 6)
+        self.assertEqual(backend.count(u'add to cart', site_id=1), 5)
+        self.assertEqual(
+            backend.count(u'completed checkout',
+                          variant=(u'red checkout form', u'False'),
+                          site_id=1), 2)
+        self.assertEqual(
+            backend.goal_value(u'completed checkout',
+                               variant=(u'red checkout form', u'False'),
+                               site_id=1),
+            Decimal('43.2'))
+
+        # Counters which were turned off are never created.
+        self.assertEqual(backend.count_series(u'viewed page', site_id=1), [])
+        self.assertEqual(
+            backend.count(u'add to cart',
+                          variant=(u'red checkout form', u'False'),
+                          site_id=1), 0)
+        self.assertNotEqual(backend.count_series(u'add to cart', site_id=1),
+                            [])
+        table = backend.store.variant_conversion_counts_table
+        rollup_keys = set(row['rollup_id']
+                          for row in table.select().execute())
+        self.assertEqual(rollup_keys, set([backend.store.name_id('all')]))
+
+    def test_concluded_tests(self):
+        log = MemoryLog()
+        data.run_clickstream(log, first=0, last=25)
+
+        backend = self._get_backend(reset=True)
+        worker1 = Worker(log, backend)
+        worker1.run(resume=False)
+        self.assertFalse(backend.is_concluded(u'red checkout form'))
+        backend.conclude_test(u'red checkout form')
+        backend.flush()
+
+        # The conclusion is persisted, and concluded tests get no more
+        # variant conversions.
+        backend = self._get_backend(reset=False)
+        self.assertTrue(backend.is_concluded(u'red checkout form'))
+        data.run_clickstream(log, first=25)
+        worker2 = Worker(log, backend)
+        worker2.run(resume=False)
+        self.assertEqual(
+            backend.count(u'completed checkout',
+                          variant=(u'red checkout form', u'False'),
+                          site_id=1), 0)
+        self.assertEqual(backend.count(u'completed checkout', site_id=1), 3)
+
+        # Concluded tests are pruned from histories as they are loaded.
+        histories = backend.get_visitor_histories(
+            list(backend.store.iter_visitor_ids()))
+        for history in histories.itervalues():
+            self.assertEqual(history.variants, set())
+            self.assertEqual(history.variant_conversion_keys, set())
+
+        backend.conclude_test(u'red checkout form', False)
+        self.assertFalse(backend.is_concluded(u'red checkout form'))
+
+    def test_test_inactivity(self):
+        log = MemoryLog()
+        data.run_clickstream(log)
+
+        backend = self._get_backend(reset=True, test_inactivity=6000)
+        worker1 = Worker(log, backend)
+        worker1.run(resume=False)
+        # The last record is an impression.
+        self.assertFalse(backend.is_concluded(u'red checkout form'))
+
+        # Inactivity is only checked by a flush, and is then persisted.
+        name, first, last = backend.all_tests()[0]
+        backend.latest_timestamp = last + 6001
+        self.assertFalse(backend.is_concluded(u'red checkout form'))
+        store_all_tests = backend.store.all_tests
+        all_tests_calls = []
+
+        def counting_all_tests():
+            all_tests_calls.append(1)
+            return store_all_tests()
+
+        backend.store.all_tests = counting_all_tests
+        backend.flush()
+        self.assertTrue(backend.is_concluded(u'red checkout form'))
+        self.assertFalse(backend.is_concluded(u'no such test'))
+        # Only the first check reads every test.
+        self.assertEqual(all_tests_calls, [])
+
+        # A later impression doesn't reopen the test.
+        backend = self._get_backend(reset=False, test_inactivity=6000)
+        self.assertTrue(backend.is_concluded(u'red checkout form'))
+        backend.handle(SplitRecord(timestamp=str(last + 6002), vid=u'a',
+                                   site_id='1',
+                                   test_name=u'red checkout form',
+                                   selected=u'True'), None)
+        backend.flush()
+        self.assertTrue(backend.is_concluded(u'red checkout form'))
+
+    def test_unbatched(self):
+        log = MemoryLog()
+        data.run_clickstream(log)
+
+        backend = self._get_backend(reset=True)
+        worker1 = Worker(log, backend, batch_size=None)
+        worker1.run(resume=False)
+
+        self._check_backend_queries(backend)
+
+    def test_resume_small_batches(self):
+        path = work_path('resume-batches')
+
+        backend = self._get_backend(reset=True)
+        log_w = TimeRotatingLog(path)
+        data.run_clickstream(log_w, first=0, last=25)
+        Worker(TimeRotatingLog(path), backend, batch_size=3).run()
+
+        backend = self._get_backend(reset=False)
+        data.run_clickstream(log_w, first=25)
+        Worker(TimeRotatingLog(path), backend, batch_size=3).run(resume=True)
+
+        self._check_backend_queries(backend)
@@ -0,0 +1,66 @@
+from __future__ import absolute_import, division, print_function
+import random
+
+from manhattan.backend.complexgoals import ComplexGoalIndex
+
+from . import data
+from .base import BaseTest
+
+
+def reference_transitions(complex_goals, goals, new_name):
+    """
+    The complex goals converted and un-converted by reaching ``new_name``,
+    as originally computed by scanning every complex goal.
+    """
+    goals = goals | set([new_name])
+    converted = []
+    unconverted = []
+    for complex_name, include, exclude in complex_goals:
+        if (new_name in include) and (goals >= include):
+            converted.append(complex_name)
+        if goals & exclude == set([new_name]):
+            unconverted.append(complex_name)
+    return converted, unconverted
+
+
+class TestComplexGoalIndex(BaseTest):
+
+    def test_affected(self):
+        index = ComplexGoalIndex(data.test_complex_goals)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.affected(u'viewed page'), ())
+        self.assertEqual(index.affected(u'add to cart'),
+                         [(u'abandoned cart', frozenset(), None)])
+        self.assertEqual(
+            [name for name, _, _ in index.affected(u'completed checkout')],
+            [u'abandoned checkout', u'abandoned after validation failure',
+             u'abandoned after payment failure'])
+
+    def test_matches_scan(self):
+        rand = random.Random(42)
+        names = [u'goal %d' % ii for ii in range(8)]
+        complex_goals = [
+            (u'complex %d' % ii,
+             set(rand.sample(names, rand.randint(1, 3))),
+             set(rand.sample(names, rand.randint(1, 3))))
+            for ii in range(20)]
+        index = ComplexGoalIndex(complex_goals)
+
+        for ii in range(500):
+            goals = set(rand.sample(names, rand.randint(0, 6)))
+            new_name = rand.choice(names)
+            if new_name in goals:
+                continue
+            after = goals | set([new_name])
+            converted = []
+            unconverted = []
+            for complex_name, include_rest, exclude_rest in \
+                    index.affected(new_name):
+                if include_rest is not None and after >= include_rest:
+                    converted.append(complex_name)
+                if exclude_rest is not None and after.isdisjoint(
+                        exclude_rest):
+                    unconverted.append(complex_name)
+            self.assertEqual(
+                (converted, unconverted),
+                reference_transitions(complex_goals, goals, new_name))
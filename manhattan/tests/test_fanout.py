@@ -0,0 +1,32 @@
+from __future__ import absolute_import, division, print_function
+
+from manhattan.backend.fanout import FanoutConfig
+
+from .base import BaseTest
+
+
+class TestFanoutConfig(BaseTest):
+
+    def test_defaults(self):
+        fanout = FanoutConfig()
+        self.assertIsNone(fanout.rollups_for_goal(u'foo'))
+        self.assertIsNone(fanout.rollups_for_test(u'bar'))
+        self.assertTrue(fanout.counts_variant(u'foo', u'bar'))
+
+    def test_configured(self):
+        fanout = FanoutConfig(goal_rollups={u'foo': ['all', 'pst_day']},
+                              test_rollups={u'bar': ['all']},
+                              default_rollups=['all'],
+                              variant_goals=[u'foo'])
+        self.assertEqual(fanout.rollups_for_goal(u'foo'),
+                         set(['all', 'pst_day']))
+        self.assertEqual(fanout.rollups_for_goal(u'other'), set(['all']))
+        self.assertEqual(fanout.rollups_for_test(u'bar'), set(['all']))
+        self.assertTrue(fanout.counts_variant(u'foo', u'bar'))
+        self.assertFalse(fanout.counts_variant(u'other', u'bar'))
+
+    def test_check(self):
+        fanout = FanoutConfig(goal_rollups={u'foo': ['all', 'hour']})
+        fanout.check({'all': None, 'hour': None})
+        with self.assertRaises(ValueError):
+            fanout.check({'all': None})
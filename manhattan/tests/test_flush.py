@@ -0,0 +1,106 @@
+from __future__ import absolute_import, division, print_function
+from threading import Event
+from unittest import TestCase
+
+from manhattan.backend.flush import FlushThread, FlushError, FlushPolicy
+
+
+class TestFlushThread(TestCase):
+
+    def test_order(self):
+        written = []
+        flusher = FlushThread(written.append, max_pending=1)
+        flusher.start()
+        for ii in range(20):
+            flusher.submit(ii)
+        flusher.drain()
+        flusher.stop()
+        self.assertEqual(written, range(20))
+
+    def test_error_stops_writes(self):
+        written = []
+        failed = Event()
+
+        def write(batch):
+            if batch == 2:
+                failed.set()
+                raise ValueError('boom')
+            written.append(batch)
+
+        flusher = FlushThread(write, max_pending=5)
+        flusher.start()
+        for ii in range(5):
+            flusher.submit(ii)
+        failed.wait(1)
+
+        with self.assertRaisesRegexp(FlushError, 'ValueError: boom'):
+            flusher.drain()
+        with self.assertRaises(FlushError):
+            flusher.submit(5)
+        flusher.stop()
+        self.assertEqual(written, [0, 1])
+
+
+class FakeBackend(object):
+
+    def __init__(self, records=0, last_flush_time=0, counter_keys=0,
+                 history_bytes=0):
+        self.records_since_flush = records
+        self.last_flush_time = last_flush_time
+        self.counter_keys = counter_keys
+        self.history_bytes = history_bytes
+
+    def unflushed_counter_keys(self):
+        return self.counter_keys
+
+    def unflushed_history_bytes(self):
+        return self.history_bytes
+
+
+class TestFlushPolicy(TestCase):
+
+    def test_every(self):
+        policy = FlushPolicy(every=10)
+        self.assertFalse(policy.should_flush(FakeBackend(10), 100, 100))
+        self.assertTrue(policy.should_flush(FakeBackend(11), 100, 100))
+
+    def test_catchup_grows_batches(self):
+        policy = FlushPolicy(every=10, catchup_lag=60, max_growth=5)
+        self.assertEqual(policy.batch_size(30), 10)
+        self.assertEqual(policy.batch_size(120), 20)
+        self.assertEqual(policy.batch_size(6000), 50)
+        self.assertFalse(policy.should_flush(FakeBackend(11), 0, 120))
+        self.assertTrue(policy.should_flush(FakeBackend(21), 0, 120))
+
+        policy = FlushPolicy(every=10, catchup_lag=None)
+        self.assertEqual(policy.batch_size(6000), 10)
+
+    def test_interval(self):
+        policy = FlushPolicy(every=1000, interval=5, catchup_lag=60)
+        backend = FakeBackend(1, last_flush_time=100)
+        self.assertFalse(policy.should_flush(backend, 104, 104))
+        self.assertTrue(policy.should_flush(backend, 105, 105))
+        # Not while catching up.
+        self.assertFalse(policy.should_flush(backend, 0, 105))
+
+    def test_idle(self):
+        policy = FlushPolicy(every=1000, interval=5)
+        self.assertFalse(policy.should_flush_idle(
+            FakeBackend(1, last_flush_time=100), 104))
+        self.assertTrue(policy.should_flush_idle(
+            FakeBackend(1, last_flush_time=100), 105))
+        # Nothing to flush.
+        self.assertFalse(policy.should_flush_idle(
+            FakeBackend(0, last_flush_time=100), 105))
+        self.assertFalse(FlushPolicy(every=1000).should_flush_idle(
+            FakeBackend(1, last_flush_time=100), 105))
+
+    def test_limits(self):
+        policy = FlushPolicy(every=1000, max_counter_keys=50,
+                             max_dirty_bytes=1000)
+        self.assertFalse(policy.should_flush(
+            FakeBackend(1, counter_keys=49, history_bytes=999), 0, 0))
+        self.assertTrue(policy.should_flush(
+            FakeBackend(1, counter_keys=50), 0, 0))
+        self.assertTrue(policy.should_flush(
+            FakeBackend(1, history_bytes=1000), 0, 0))
@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, print_function
+import marshal
+import cPickle as pickle
+from unittest import TestCase
+
+from manhattan.record import PageRecord, GoalRecord
+from manhattan.backend.model import (VisitorHistory, encode_history,
+                                     decode_history, history_magic)
+
+
+def make_history():
+    history = VisitorHistory()
+    history.nonbot = True
+    history.nonbot_queue = [
+        PageRecord(timestamp=u'1350000000.1234', vid=u'abc', site_id=u'1',
+                   ip=u'1.2.3.4', method=u'GET', url=u'/foo',
+                   user_agent=u'Chrome/17', referer=u''),
+        GoalRecord(timestamp=u'1350000001.5', vid=u'abc', site_id=u'1',
+                   name=u'Goo\xf6al', value=u'12.5', value_type=u's',
+                   value_format=u'$'),
+    ]
+    history.goals = set([u'viewed page', u'Goo\xf6al'])
+    history.variants = set([(u'red checkout form', u'True')])
+    history.ips = set([u'1.2.3.4'])
+    history.user_agents = set([u'Chrome/17', u'Firefox/3'])
+    history.user_agent = u'Firefox/3'
+    history.conversion_keys = set([
+        (u'viewed page', 'all', 0, 1),
+        (u'viewed page', 'pst_day', 1349938800.0, 1),
+        (u'viewed page', 'browser', u'Chrome', 1),
+    ])
+    history.impression_keys = set([
+        (u'red checkout form', u'True', 'pst_week', 1349593200.0, 1),
+    ])
+    history.variant_conversion_keys = set([
+        (u'viewed page', u'red checkout form', u'True', 'all', 0, -3),
+        (u'viewed page', u'red checkout form', u'True', 'odd', 0.25, None),
+    ])
+    history.complex_keys = {
+        u'abandoned cart': [(u'abandoned cart', 'all', 0, 1),
+                            (u'abandoned cart', 'pst_day', 1349938800.0, 1)],
+    }
+    return history
+
+
+class TestHistoryCodec(TestCase):
+
+    def assertHistoriesEqual(self, a, b):
+        self.assertEqual(a.nonbot, b.nonbot)
+        self.assertEqual([r.__dict__ for r in a.nonbot_queue],
+                         [r.__dict__ for r in b.nonbot_queue])
+        self.assertEqual([type(r) for r in a.nonbot_queue],
+                         [type(r) for r in b.nonbot_queue])
+        for attr in ('goals', 'variants', 'ips', 'user_agents', 'user_agent',
+                     'conversion_keys', 'impression_keys',
+                     'variant_conversion_keys', 'complex_keys'):
+            self.assertEqual(getattr(a, attr), getattr(b, attr))
+
+    def test_round_trip(self):
+        history = make_history()
+        data = encode_history(history)
+        self.assertTrue(data.startswith(history_magic))
+        self.assertLess(len(data), len(pickle.dumps(history, 2)))
+        self.assertHistoriesEqual(decode_history(data), history)
+
+    def test_round_trip_preserves_types(self):
+        decoded = decode_history(encode_history(make_history()))
+        day_key, = [key for key in decoded.conversion_keys
+                    if key[1] == 'pst_day']
+        self.assertIsInstance(day_key[1], str)
+        self.assertIsInstance(day_key[2], float)
+        self.assertIsInstance(day_key[0], unicode)
+
+    def test_empty(self):
+        self.assertHistoriesEqual(
+            decode_history(encode_history(VisitorHistory())),
+            VisitorHistory())
+
+    def test_decode_pickle(self):
+        history = make_history()
+        self.assertHistoriesEqual(
+            decode_history(pickle.dumps(history, 2)), history)
+
+    def test_decode_version_1(self):
+        history = make_history()
+        data = encode_history(history)
+        payload = marshal.loads(data[len(history_magic) + 1:])
+        data = (history_magic + chr(1) +
+                marshal.dumps(payload[:14], 2))
+        decoded = decode_history(data)
+        # The first user agent wasn't stored, so the lowest one is used.
+        history.user_agent = u'Chrome/17'
+        self.assertHistoriesEqual(decoded, history)
+
+    def test_decode_pickle_without_user_agent(self):
+        history = make_history()
+        del history.user_agent
+        del history.user_agent_info
+        decoded = decode_history(pickle.dumps(history, 2))
+        self.assertEqual(decoded.user_agent, u'Chrome/17')
+        self.assertIsNone(decoded.user_agent_info)
+
+    def test_unknown_version(self):
+        data = bytearray(encode_history(VisitorHistory()))
+        data[len(history_magic)] = 99
+        with self.assertRaises(ValueError):
+            decode_history(bytes(data))
@@ -0,0 +1,242 @@
+from __future__ import absolute_import, division, print_function
+import types
+import cPickle as pickle
+from collections import Counter
+
+from sqlalchemy import Table, Column, event, types as sqltypes
+from sqlalchemy.sql import type_coerce
+
+from manhattan.backend.persistence.sql import SQLPersistentStore
+from manhattan.backend.model import VisitorHistory
+from manhattan.record import PageRecord, GoalRecord
+
+from .base import BaseTest
+
+
+class TestSQLPersistentStore(BaseTest):
+
+    def _get_store(self, native=True):
+        store = SQLPersistentStore('sqlite://')
+        if not native:
+            store.upsert_style = types.MethodType(lambda self: None, store)
+        return store
+
+    def _check_increment(self, store):
+        store.begin()
+        store.increment_impression_counters(
+            Counter({(u'foo', u'a', u'all', 0, 1): 3,
+                     (u'foo', u'b', u'all', 0, 1): 1}))
+        store.commit()
+
+        store.begin()
+        store.increment_impression_counters(
+            Counter({(u'foo', u'a', u'all', 0, 1): 2,
+                     (u'bar', u'a', u'all', 0, 1): 7}))
+        store.commit()
+
+        self.assertEqual(
+            store.count_impressions(u'foo', u'a', u'all', 0, 1), 5)
+        self.assertEqual(
+            store.count_impressions(u'foo', u'b', u'all', 0, 1), 1)
+        self.assertEqual(
+            store.count_impressions(u'bar', u'a', u'all', 0, 1), 7)
+
+    def test_increment_native(self):
+        self._check_increment(self._get_store(native=True))
+
+    def test_increment_fallback(self):
+        self._check_increment(self._get_store(native=False))
+
+    def test_put_visitor_history(self):
+        store = self._get_store()
+
+        first = VisitorHistory()
+        first.goals.add(u'foo')
+        store.begin()
+        store.put_visitor_history({'a': first, 'b': VisitorHistory()})
+        store.commit()
+
+        second = VisitorHistory()
+        second.goals.add(u'bar')
+        store.begin()
+        store.put_visitor_history({'a': second})
+        store.commit()
+
+        self.assertEqual(store.get_visitor_history('a').goals,
+                         set([u'bar']))
+        self.assertEqual(store.get_visitor_history('b').goals, set())
+
+    def test_get_visitor_histories(self):
+        store = self._get_store()
+        store.begin()
+        store.put_visitor_history({'a': VisitorHistory(),
+                                   'b': VisitorHistory(),
+                                   'c': VisitorHistory()})
+        store.commit()
+
+        found = store.get_visitor_histories(['a', 'c', 'd'], chunk_size=2)
+        self.assertEqual(sorted(found), ['a', 'c'])
+
+    def test_migrate_visitor_histories(self):
+        store = self._get_store()
+        history = VisitorHistory()
+        history.goals.add(u'foo')
+
+        t = store.history_table
+        t.insert().values(vid='old',
+                          history=type_coerce(pickle.dumps(history, 2),
+                                              sqltypes.LargeBinary)).execute()
+        store.begin()
+        store.put_visitor_history({'new': VisitorHistory()})
+        store.commit()
+
+        self.assertEqual(store.get_visitor_history('old').goals,
+                         set([u'foo']))
+        self.assertEqual(store.migrate_visitor_histories(batch_size=1), 1)
+        self.assertEqual(store.migrate_visitor_histories(), 0)
+        self.assertEqual(store.get_visitor_history('old').goals,
+                         set([u'foo']))
+
+    def test_bucket_ids(self):
+        store = self._get_store()
+        store.begin()
+        store.increment_conversion_counters(
+            Counter({(u'foo', 'pst_day', 1350028800.0, 1): 2,
+                     (u'foo', 'pst_day', -345600.0, 1): 3,
+                     (u'foo', 'browser', u'Chrome', 1): 4,
+                     (u'foo', 'browser', u'', 1): 5,
+                     (u'foo', 'pst_day', 0.25, 1): 6}),
+            {})
+        store.commit()
+
+        self.assertEqual(
+            store.count_conversions(u'foo', 'pst_day', 1350028800, 1)[0], 2)
+        self.assertEqual(
+            store.count_conversions(u'foo', 'pst_day', -345600, 1)[0], 3)
+        self.assertEqual(
+            store.count_conversions(u'foo', 'browser', u'Chrome', 1)[0], 4)
+        self.assertEqual(
+            store.count_conversions(u'foo', 'browser', u'', 1)[0], 5)
+        self.assertEqual(
+            store.count_conversions(u'foo', 'browser', u'Opera', 1)[0], 0)
+        # Numeric bucket IDs which aren't whole are stored like names, so
+        # they aren't included in series.
+        self.assertEqual(
+            store.count_conversions(u'foo', 'pst_day', 0.25, 1)[0], 6)
+        self.assertEqual(
+            store.conversion_series(u'foo', 'pst_day', 1),
+            {-345600: (3, 0), 1350028800: (2, 0)})
+
+    def test_series_range_scan(self):
+        store = self._get_store()
+        store.begin()
+        store.increment_variant_conversion_counters(
+            Counter({(u'buy', u'test', u'a', 'pst_day', 86400, 1): 1,
+                     (u'buy', u'test', u'b', 'pst_day', 172800, 1): 2}),
+            {})
+        store.commit()
+
+        statements = []
+
+        def before_execute(conn, cursor, statement, parameters, *args):
+            if statement.startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        event.listen(store.engine, 'before_cursor_execute', before_execute)
+        self.assertEqual(
+            store.test_variant_conversion_series(u'test', [u'buy'],
+                                                 'pst_day', 1, 0, 100000),
+            {(u'buy', u'a', 86400): (1, 0)})
+        event.remove(store.engine, 'before_cursor_execute', before_execute)
+
+        # The bucket range is part of the index search, although the query
+        # covers every population of the test.
+        statement, parameters = statements[-1]
+        plan = store.engine.execute('EXPLAIN QUERY PLAN ' + statement,
+                                    parameters).fetchall()
+        self.assertIn('bucket>? AND bucket<?', plan[0][3])
+
+    def test_names_rollback(self):
+        store = self._get_store()
+        store.begin()
+        store.increment_impression_counters(
+            Counter({(u'foo', u'a', u'all', 0, 1): 3}))
+        store.commit()
+        foo_id = store.name_id(u'foo')
+
+        store.begin()
+        store.increment_impression_counters(
+            Counter({(u'bar', u'a', u'all', 0, 1): 3}))
+        store.rollback()
+
+        self.assertEqual(store.name_id(u'foo'), foo_id)
+        self.assertIsNone(store.name_id(u'bar'))
+        self.assertEqual(
+            store.count_impressions(u'bar', u'a', u'all', 0, 1), 0)
+
+    def test_migrate_counters(self):
+        store = self._get_store()
+        legacy = Table(
+            'conversion_counts',
+            store.metadata,
+            Column('name', sqltypes.String(255), primary_key=True),
+            Column('rollup_key', sqltypes.String(255), primary_key=True),
+            Column('bucket_id', sqltypes.String(255), primary_key=True),
+            Column('site_id', sqltypes.Integer, primary_key=True),
+            Column('count', sqltypes.Integer, nullable=False, default=0),
+            Column('value', sqltypes.Float, nullable=False, default=0))
+        legacy.create()
+        legacy.insert().execute([
+            {'name': u'foo', 'rollup_key': u'all', 'bucket_id': u'0',
+             'site_id': 1, 'count': 3, 'value': 1.5},
+            {'name': u'foo', 'rollup_key': u'pst_day',
+             'bucket_id': u'1350028800.0', 'site_id': 1, 'count': 2,
+             'value': 0},
+            {'name': u'foo', 'rollup_key': u'browser', 'bucket_id': u'Chrome',
+             'site_id': 1, 'count': 1, 'value': 0},
+        ])
+
+        # Counters written before the migration are kept.
+        store.begin()
+        store.increment_conversion_counters(
+            Counter({(u'foo', 'all', 0, 1): 1}), {})
+        store.commit()
+
+        self.assertEqual(store.migrate_counters(batch_size=2), 3)
+        self.assertFalse(store.engine.has_table('conversion_counts'))
+        self.assertEqual(store.migrate_counters(), 0)
+
+        self.assertEqual(store.count_conversions(u'foo', 'all', 0, 1),
+                         (4, 1.5))
+        self.assertEqual(
+            store.count_conversions(u'foo', 'pst_day', 1350028800.0, 1)[0],
+            2)
+        self.assertEqual(
+            store.count_conversions(u'foo', 'browser', u'Chrome', 1)[0], 1)
+
+    def test_pending_records(self):
+        store = self._get_store()
+        store.begin()
+        store.append_pending_records({
+            u'a': [PageRecord(timestamp='10.5', vid=u'a', site_id='1',
+                              url=u'/foo'),
+                   GoalRecord(timestamp='20', vid=u'a', site_id='1',
+                              name=u'bar', value='')],
+            u'b': [PageRecord(timestamp='30', vid=u'b', site_id='1',
+                              url=u'/baz')]})
+        store.commit()
+
+        recs = store.get_pending_records(u'a')
+        self.assertEqual([rec.key for rec in recs], ['page', 'goal'])
+        self.assertEqual(recs[0].url, u'/foo')
+        self.assertEqual(recs[0].timestamp, '10.5')
+        self.assertEqual(recs[1].vid, u'a')
+        self.assertEqual(sorted(store.iter_pending_visitor_ids()),
+                         [u'a', u'b'])
+        newest = store.get_pending_records(u'a', limit=1)
+        self.assertEqual([rec.key for rec in newest], ['goal'])
+
+        self.assertEqual(store.expire_pending_records(15), 1)
+        store.delete_pending_records([u'b'])
+        self.assertEqual(len(store.get_pending_records(u'a')), 1)
+        self.assertEqual(store.get_pending_records(u'b'), [])
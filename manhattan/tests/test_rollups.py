@@ -0,0 +1,73 @@
+from __future__ import absolute_import, division, print_function
+import time
+import random
+from datetime import timedelta
+from unittest import TestCase
+
+from manhattan.backend.rollups import LocalDayRollup, LocalWeekRollup
+
+
+def reference_day_bucket(rollup, timestamp):
+    return time.mktime(rollup.start_date_for(timestamp).timetuple())
+
+
+def reference_week_bucket(rollup, timestamp):
+    day = rollup.start_date_for(timestamp)
+    day -= timedelta(days=day.isoweekday() % 7)
+    return time.mktime(day.timetuple())
+
+
+class TestLocalRollups(TestCase):
+    timezones = ['America/Los_Angeles', 'UTC', 'Europe/London',
+                 'America/Sao_Paulo', 'Australia/Lord_Howe', 'Asia/Kathmandu',
+                 'Pacific/Apia']
+
+    def _check(self, cls, reference, timestamps):
+        for tzname in self.timezones:
+            rollup = cls(tzname)
+            for ts in timestamps:
+                self.assertEqual(rollup.get_bucket(ts, None),
+                                 reference(rollup, ts),
+                                 '%s %s' % (tzname, ts))
+
+    def _timestamps(self):
+        r = random.Random(42)
+        # Late 2011 to early 2013, which covers DST changes in both
+        # hemispheres, and Samoa skipping a day.
+        start = 1317427200
+        ordered = range(start, start + 86400 * 500, 3599)
+        shuffled = [r.randint(start, start + 86400 * 500)
+                    for ii in range(1000)]
+        return ordered + shuffled
+
+    def test_day_matches_reference(self):
+        self._check(LocalDayRollup, reference_day_bucket, self._timestamps())
+
+    def test_week_matches_reference(self):
+        self._check(LocalWeekRollup, reference_week_bucket,
+                    self._timestamps())
+
+    def test_span_cache(self):
+        rollup = LocalDayRollup('America/Los_Angeles')
+        # 2012-11-04 is a 25 hour day.
+        first = rollup.get_bucket(1352012400, None)
+        self.assertEqual(len(rollup.spans), 1)
+        start, end, bucket = rollup.spans[0]
+        self.assertEqual((start, end, bucket), (1352012400, 1352102400, first))
+        self.assertEqual(rollup.get_bucket(end - 1, None), first)
+        self.assertEqual(len(rollup.spans), 1)
+        self.assertNotEqual(rollup.get_bucket(end, None), first)
+        self.assertEqual(len(rollup.spans), 2)
+
+    def test_bucket_end(self):
+        for tzname in self.timezones:
+            for cls in (LocalDayRollup, LocalWeekRollup):
+                for ts in self._timestamps()[::50]:
+                    rollup = cls(tzname)
+                    bucket = rollup.get_bucket(ts, None)
+                    # Computed without the cached spans.
+                    end = cls(tzname).bucket_end(bucket)
+                    self.assertGreater(end, ts)
+                    self.assertEqual(rollup.bucket_end(bucket), end)
+                    self.assertNotEqual(rollup.get_bucket(end, None), bucket)
+                    self.assertEqual(rollup.get_bucket(end - 1, None), bucket)
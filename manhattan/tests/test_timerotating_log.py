@@ -1,13 +1,17 @@
 from __future__ import absolute_import, division, print_function
+import os
 import types
 import time
 
 from threading import Thread
 
 from manhattan.record import Record, PageRecord, GoalRecord
+from manhattan.log import timerotating
 from manhattan.log.timerotating import TimeRotatingLog
+from manhattan.log.inotify import DirectoryWatcher, IN_CREATE
+from manhattan.log.binary import BinaryLogError, iter_frames
 
-from .base import BaseTest, work_path
+from .base import BaseTest, work_dir, work_path
 
 
 def set_fake_name(log, index):
@@ -173,3 +177,426 @@ class TimeRotatingLogTest(BaseTest):
             self.assertEqual(consumed[0].url, '/derp')
         finally:
             log_r2.killed.set()
+
+    def test_stay_alive_polling(self):
+        path = work_path('trl-stayalive-polling')
+        log_r = TimeRotatingLog(path, use_inotify=False)
+        consumed, consumer, _ = make_thread_consumer(log_r)
+
+        try:
+            log_w = TimeRotatingLog(path)
+            set_fake_name(log_w, '357')
+            log_w.write(PageRecord(url='/baz').to_list())
+            time.sleep(log_r.sleep_delay * 10)
+            self.assertEqual([rec.url for rec in consumed], ['/baz'])
+
+            set_fake_name(log_w, '358')
+            log_w.write(PageRecord(url='/herp').to_list())
+            time.sleep(log_r.sleep_delay * 10)
+            self.assertEqual([rec.url for rec in consumed], ['/baz', '/herp'])
+            self.assertIsNone(log_r.watcher)
+        finally:
+            log_r.killed.set()
+            consumer.join()
+
+    def test_inotify_wakeup(self):
+        path = work_path('trl-inotify')
+        log_w = TimeRotatingLog(path)
+        set_fake_name(log_w, '001')
+        log_w.write(PageRecord(url='/foo').to_list())
+
+        # With a long latency bound, new records can only be seen this
+        # quickly if the reader is woken by inotify.
+        log_r = TimeRotatingLog(path, max_latency=1.0)
+        consumed, consumer, _ = make_thread_consumer(log_r)
+        log_r.sleep_delay = 1.0
+
+        try:
+            time.sleep(0.05)
+            self.assertEqual(len(consumed), 1)
+            self.assertIsNotNone(log_r.watcher)
+
+            log_w.write(PageRecord(url='/bar').to_list())
+            time.sleep(0.05)
+            self.assertEqual(len(consumed), 2)
+
+            set_fake_name(log_w, '002')
+            log_w.write(PageRecord(url='/baz').to_list())
+            time.sleep(0.05)
+            self.assertEqual([rec.url for rec in consumed],
+                             ['/foo', '/bar', '/baz'])
+        finally:
+            log_r.killed.set()
+            consumer.join()
+        self.assertIsNone(log_r.watcher)
+
+    def test_segment_batches(self):
+        path = work_path('trl-segment')
+        log_w = TimeRotatingLog(path)
+        set_fake_name(log_w, '001')
+        urls = ['/page/%d' % ii for ii in range(50)]
+        for url in urls:
+            log_w.write(PageRecord(url=url).to_list())
+        fname = log_w.current_log_name
+        with open(fname, 'ab') as f:
+            f.write(b'1\tpage\tpartial')
+
+        log_r = TimeRotatingLog(path)
+        log_r.chunk_bytes = 100
+        lines = open(fname, 'rb').read().split(b'\n')[:-1]
+        batches = [(batch, end) for batch, end
+                   in log_r.segment_batches(fname, 0, 7) if batch]
+        self.assertEqual(sum((batch for batch, end in batches), []),
+                         [log_r.parse(line.strip()) for line in lines])
+        self.assertTrue(all(len(batch) <= 7 for batch, end in batches))
+        for batch, end in batches:
+            last = open(fname, 'rb').read(end).split(b'\n')[-2]
+            self.assertEqual(log_r.parse(last.strip()), batch[-1])
+
+        # Reading can resume from any record boundary.
+        offset = batches[2][1]
+        resumed = list(log_r.segment_batches(fname, offset, 1000))
+        self.assertEqual(resumed[0][0][0], batches[3][0][0])
+
+    def test_process_closed(self):
+        path = work_path('trl-closed')
+        log_w = TimeRotatingLog(path)
+        for index in ('001', '002', '003'):
+            set_fake_name(log_w, index)
+            for ii in range(10):
+                log_w.write(PageRecord(url='/%s/%d' % (index, ii)).to_list())
+
+        # The first two files are read in bulk, and the last one line by
+        # line, with the same pointers either way.
+        log_r = TimeRotatingLog(path)
+        log_r.chunk_bytes = 64
+        records = list(log_r.process(stay_alive=False))
+        self.assertEqual(len(records), 30)
+        self.assertEqual(Record.from_list(records[-1][0]).url, '/003/9')
+        for vals, pointer in records:
+            fname, offset = pointer.rsplit(':', 1)
+            data = open(fname, 'rb').read(int(offset))
+            self.assertTrue(data.endswith(b'\n'))
+            last = data[:-1].rsplit(b'\n', 1)[-1]
+            self.assertEqual(log_r.parse(last.strip()), vals)
+
+        # Resuming from the middle of a closed file.
+        pointer = records[14][1]
+        resumed = list(TimeRotatingLog(path).process(process_from=pointer))
+        self.assertEqual(resumed, records[15:])
+
+    def test_process_batches(self):
+        path = work_path('trl-batches')
+        log_w = TimeRotatingLog(path)
+        for index in ('001', '002'):
+            set_fake_name(log_w, index)
+            for ii in range(10):
+                log_w.write(PageRecord(url='/%s/%d' % (index, ii)).to_list())
+        records = list(TimeRotatingLog(path).process())
+
+        batches = list(TimeRotatingLog(path).process_batches(size=4))
+        self.assertEqual([len(vals) for vals, pointer in batches],
+                         [4, 4, 2, 4, 4, 2])
+        self.assertEqual(sum((vals for vals, pointer in batches), []),
+                         [vals for vals, pointer in records])
+        self.assertEqual([pointer for vals, pointer in batches],
+                         [records[ii][1] for ii in (3, 7, 9, 13, 17, 19)])
+
+        resumed = list(TimeRotatingLog(path).process_batches(
+            size=100, process_from=batches[1][1]))
+        self.assertEqual([len(vals) for vals, pointer in resumed], [2, 10])
+
+    def test_binary(self):
+        path = work_path('trl-binary')
+        log_w = TimeRotatingLog(path, binary=True)
+        set_fake_name(log_w, '001')
+        urls = [u'/a', u'/line\nbreak', u'/tab\there', u'/\u2603']
+        for url in urls:
+            log_w.write(PageRecord(url=url).to_list())
+        log_w.write(GoalRecord(name=u'foo', value=u'1.5').to_list())
+        # A new writer appends in the format the file was started in.
+        set_fake_name(log_w, '002')
+        log_w.write(PageRecord(url=u'/b').to_list())
+        log_a = TimeRotatingLog(path)
+        set_fake_name(log_a, '002')
+        log_a.write(PageRecord(url=u'/c').to_list())
+
+        records = list(TimeRotatingLog(path).process())
+        recs = [Record.from_list(vals) for vals, pointer in records]
+        self.assertEqual([rec.url for rec in recs[:4]], urls)
+        self.assertEqual(recs[4].name, u'foo')
+        self.assertEqual(recs[4].value, u'1.5')
+        self.assertEqual([rec.url for rec in recs[5:]], [u'/b', u'/c'])
+
+        # Once a newer file exists, the old ones are read as closed files,
+        # with the same records and pointers.
+        open(path + '.003', 'ab').close()
+        self.assertEqual(list(TimeRotatingLog(path).process()), records)
+
+        resumed = list(TimeRotatingLog(path).process(
+            process_from=records[2][1]))
+        self.assertEqual(resumed, records[3:])
+
+    def test_binary_long_field(self):
+        path = work_path('trl-binary-long')
+        log_w = TimeRotatingLog(path, binary=True)
+        set_fake_name(log_w, '001')
+        # Fields which don't fit in the binary format are truncated, without
+        # splitting a character, rather than failing the write.
+        url = u'/' + u'\u2603' * 30000
+        log_w.write(PageRecord(url=url).to_list())
+        log_w.write(PageRecord(url=u'/b').to_list())
+
+        recs = [Record.from_list(vals)
+                for vals, pointer in TimeRotatingLog(path).process()]
+        self.assertEqual(recs[0].url, url[:21845])
+        self.assertEqual(recs[1].url, u'/b')
+
+    def test_binary_read_buffer(self):
+        path = work_path('trl-binary-buffer')
+        log_w = TimeRotatingLog(path, binary=True)
+        set_fake_name(log_w, '001')
+        for ii in range(200):
+            log_w.write(PageRecord(url='/%d' % ii).to_list())
+        size = os.path.getsize(log_w.current_log_name)
+
+        reads = []
+
+        class CountingFile(object):
+            def __init__(self, f):
+                self.f = f
+
+            def read(self, n=-1):
+                data = self.f.read(n)
+                reads.append(len(data))
+                return data
+
+            def __getattr__(self, name):
+                return getattr(self.f, name)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                self.f.close()
+
+        timerotating.open = lambda *args: CountingFile(open(*args))
+        try:
+            # Reading a record at a time from the live file doesn't read the
+            # same data again for each record, and frames larger than a
+            # chunk are still read whole.
+            for chunk_bytes in (1000, 10):
+                del reads[:]
+                log_r = TimeRotatingLog(path, scan_on_start=False)
+                log_r.chunk_bytes = chunk_bytes
+                urls = [Record.from_list(vals).url
+                        for vals, pointer in log_r.process()]
+                self.assertEqual(urls, ['/%d' % ii for ii in range(200)])
+                self.assertLess(sum(reads), 2 * size)
+        finally:
+            del timerotating.open
+
+    def test_mixed_formats(self):
+        path = work_path('trl-mixed')
+        log_text = TimeRotatingLog(path)
+        log_binary = TimeRotatingLog(path, binary=True)
+        for index, log_w in (('001', log_text), ('002', log_binary),
+                             ('003', log_text), ('004', log_binary)):
+            set_fake_name(log_w, index)
+            for ii in range(3):
+                log_w.write(PageRecord(url='/%s/%d' % (index, ii)).to_list())
+
+        self.assertTrue(open(path + '.002', 'rb').read().startswith(b'\xff'))
+        self.assertEqual(open(path + '.003', 'rb').read(1), b'1')
+
+        batches = list(TimeRotatingLog(path).process_batches(size=2))
+        urls = [Record.from_list(vals).url
+                for batch, pointer in batches for vals in batch]
+        self.assertEqual(urls, ['/%s/%d' % (index, ii)
+                                for index in ('001', '002', '003', '004')
+                                for ii in range(3)])
+
+    def test_binary_partial_and_damaged(self):
+        path = work_path('trl-damaged')
+        log_w = TimeRotatingLog(path, binary=True)
+        set_fake_name(log_w, '001')
+        for ii in range(3):
+            log_w.write(PageRecord(url='/%d' % ii).to_list())
+        fname = log_w.current_log_name
+        data = open(fname, 'rb').read()
+
+        # A frame which is still being written is left for later.
+        with open(fname, 'ab') as f:
+            f.write(data[8:20])
+        records = list(TimeRotatingLog(path).process())
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[-1][1], '%s:%d' % (fname, len(data)))
+
+        # If the writer died, the next writer's frames are still read.
+        log_w = TimeRotatingLog(path, binary=True)
+        set_fake_name(log_w, '001')
+        log_w.write(PageRecord(url='/3').to_list())
+        log_r = TimeRotatingLog(path, scan_on_start=False)
+        urls = [Record.from_list(vals).url for vals, pointer
+                in log_r.process()]
+        self.assertEqual(urls, ['/0', '/1', '/2', '/3'])
+        self.assertEqual(log_r.damaged_regions, 1)
+        self.assertEqual(log_r.damaged_bytes, 12)
+
+        # A frame with a bad checksum is skipped, and can be quarantined.
+        data = open(fname, 'rb').read()
+        with open(fname, 'r+b') as f:
+            f.seek(data.index(b'/1'))
+            f.write(b'!')
+        with self.assertRaises(BinaryLogError):
+            list(iter_frames(data.replace(b'/1', b'!1'), 8, len(data)))
+        quarantine = work_path('quarantine')
+        log_r = TimeRotatingLog(path, quarantine_dir=quarantine,
+                                scan_on_start=False)
+        urls = [Record.from_list(vals).url for vals, pointer
+                in log_r.process()]
+        self.assertEqual(urls, ['/0', '/2', '/3'])
+        self.assertEqual(log_r.damaged_regions, 2)
+        self.assertEqual(len(os.listdir(quarantine)), 2)
+
+    def test_text_damaged(self):
+        path = work_path('trl-text-damaged')
+
+        def page(url):
+            return PageRecord(timestamp='1', vid='a', site_id='1',
+                              ip='127.0.0.1', method='GET', url=url,
+                              user_agent='ua', referer='ref').to_list()
+
+        for index in ('001', '002'):
+            log_w = TimeRotatingLog(path)
+            set_fake_name(log_w, index)
+            log_w.write(page('/%s/0' % index))
+            # A writer dies part way through a line, and the next writer's
+            # line is appended to it.
+            with open(log_w.current_log_name, 'ab') as f:
+                f.write(b'1\tpage\t12')
+            log_w.write(page('/%s/1' % index))
+            log_w.write(page('/%s/2' % index))
+
+        log_r = TimeRotatingLog(path, scan_on_start=False)
+        urls = [Record.from_list(vals).url for vals, pointer
+                in log_r.process()]
+        self.assertEqual(urls, ['/001/0', '/001/2', '/002/0', '/002/2'])
+        self.assertEqual(log_r.damaged_regions, 2)
+
+    def test_scan(self):
+        path = work_path('trl-scan')
+        for index, is_binary in (('001', True), ('002', False)):
+            log_w = TimeRotatingLog(path, binary=is_binary)
+            set_fake_name(log_w, index)
+            for ii in range(3):
+                log_w.write(PageRecord(url='/%s/%d' % (index, ii)).to_list())
+        first, second = path + '.001', path + '.002'
+        first_size = os.path.getsize(first)
+
+        log_r = TimeRotatingLog(path)
+        self.assertEqual(log_r.scan(), [])
+        self.assertEqual(log_r.read_index(first)['checked'], first_size)
+        self.assertEqual(log_r.read_index(second)['checked'],
+                         os.path.getsize(second))
+
+        # Only what was written since the last scan is read.
+        with open(first, 'ab') as f:
+            f.write(b'\xa5\x5a\x00\x00')
+        offsets = []
+        segment_batches = log_r.segment_batches
+
+        def record_offset(fname, offset, *args, **kwargs):
+            offsets.append((fname, offset))
+            return segment_batches(fname, offset, *args, **kwargs)
+
+        log_r.segment_batches = record_offset
+        self.assertEqual(log_r.scan(), [(first, first_size, first_size + 4,
+                                         'partial record at end of file')])
+        self.assertEqual(offsets, [(first, first_size),
+                                   (second, os.path.getsize(second))])
+        self.assertEqual(log_r.read_index(first)['damaged'],
+                         [[first_size, first_size + 4]])
+
+        # An index for a file which has been replaced isn't used.
+        with open(second, 'r+b') as f:
+            f.write(b'2')
+        self.assertIsNone(log_r.read_index(second))
+        del offsets[:]
+        self.assertEqual(len(log_r.scan(second)), 1)
+        self.assertEqual(offsets, [(second, 0)])
+
+        # The index files aren't read as log files.
+        records = list(TimeRotatingLog(path).process())
+        self.assertEqual(len(records), 5)
+
+    def test_reader_updates_index(self):
+        path = work_path('trl-reader-index')
+        for index in ('001', '002'):
+            log_w = TimeRotatingLog(path, binary=True)
+            set_fake_name(log_w, index)
+            for ii in range(3):
+                log_w.write(PageRecord(url='/%s/%d' % (index, ii)).to_list())
+        first, second = path + '.001', path + '.002'
+        second_size = os.path.getsize(second)
+
+        offsets = []
+
+        def recording_log():
+            log_r = TimeRotatingLog(path)
+            segment_batches = log_r.segment_batches
+
+            def record_offset(fname, offset, *args, **kwargs):
+                offsets.append((fname, offset))
+                return segment_batches(fname, offset, *args, **kwargs)
+
+            log_r.segment_batches = record_offset
+            return log_r
+
+        # Without a pointer, files are only read once, and indexed as they
+        # are read.
+        records = list(recording_log().process())
+        self.assertEqual(len(records), 6)
+        self.assertEqual(offsets, [(first, 0)])
+        log_r = TimeRotatingLog(path)
+        self.assertEqual(log_r.read_index(first)['checked'],
+                         os.path.getsize(first))
+        self.assertEqual(log_r.read_index(second)['checked'], second_size)
+
+        # Resuming only checks what was written since.
+        for ii in range(3, 5):
+            log_w.write(PageRecord(url='/002/%d' % ii).to_list())
+        del offsets[:]
+        resumed = list(recording_log().process(process_from=records[-1][1]))
+        self.assertEqual(len(resumed), 2)
+        self.assertEqual(offsets, [(second, second_size)])
+        self.assertEqual(log_r.read_index(second)['checked'],
+                         os.path.getsize(second))
+
+        # Files which have been deleted since they were read are skipped.
+        os.remove(first)
+        log_r.finished_with(first, 0, 100)
+        log_r.write_index(first, {'start': 0, 'checked': 100,
+                                  'damaged': []})
+        self.assertIsNone(log_r.read_index(first))
+
+
+class DirectoryWatcherTest(BaseTest):
+
+    def test_events(self):
+        os.makedirs(work_dir)
+        watcher = DirectoryWatcher(work_dir)
+        try:
+            self.assertIsNone(watcher.wait(0.01))
+            with open(work_path('foo.1'), 'ab') as f:
+                f.write(b'bar\n')
+            events = watcher.wait(1.0)
+            names = set(name for mask, name in events)
+            self.assertEqual(names, set([b'foo.1']))
+            self.assertTrue(any(mask & IN_CREATE for mask, name in events))
+        finally:
+            watcher.close()
+
+    def test_missing_directory(self):
+        with self.assertRaises(OSError):
+            DirectoryWatcher(work_path('missing'))
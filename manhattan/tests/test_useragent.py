@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, print_function
+from unittest import TestCase
+
+from manhattan.backend.model import VisitorHistory
+from manhattan.backend.rollups import BrowserRollup, OSRollup, DeviceRollup
+from manhattan.backend.useragent import (UserAgentInfo, UserAgentClassifier,
+                                         classify_user_agent,
+                                         history_user_agent_info)
+
+
+samples = [
+    ('Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like '
+     'Gecko) Chrome/30.0.1599.101 Safari/537.36',
+     (u'Chrome', u'Windows', u'Desktop')),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_8_5) AppleWebKit/536.30.1 '
+     '(KHTML, like Gecko) Version/6.0.5 Safari/536.30.1',
+     (u'Safari', u'Mac OS X', u'Desktop')),
+    ('Mozilla/5.0 (iPhone; CPU iPhone OS 7_0_2 like Mac OS X) '
+     'AppleWebKit/537.51.1 (KHTML, like Gecko) Version/7.0 Mobile/11A501 '
+     'Safari/9537.53',
+     (u'Safari', u'iOS', u'Mobile')),
+    ('Mozilla/5.0 (iPad; CPU OS 7_0_2 like Mac OS X) AppleWebKit/537.51.1 '
+     '(KHTML, like Gecko) Version/7.0 Mobile/11A501 Safari/9537.53',
+     (u'Safari', u'iOS', u'Tablet')),
+    ('Mozilla/5.0 (Linux; Android 4.3; Nexus 7 Build/JSS15Q) '
+     'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/29.0.1547.72 '
+     'Safari/537.36',
+     (u'Chrome', u'Android', u'Tablet')),
+    ('Mozilla/5.0 (Linux; Android 4.3; Nexus 4 Build/JWR66Y) '
+     'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/29.0.1547.72 Mobile '
+     'Safari/537.36',
+     (u'Chrome', u'Android', u'Mobile')),
+    ('Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:24.0) Gecko/20100101 '
+     'Firefox/24.0',
+     (u'Firefox', u'Linux', u'Desktop')),
+    ('Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.2; Trident/6.0)',
+     (u'IE', u'Windows', u'Desktop')),
+    ('Mozilla/5.0 (Windows NT 6.3; Trident/7.0; rv:11.0) like Gecko',
+     (u'IE', u'Windows', u'Desktop')),
+    ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, '
+     'like Gecko) Chrome/42.0.2311.135 Safari/537.36 Edge/12.10136',
+     (u'Edge', u'Windows', u'Desktop')),
+    ('Opera/9.80 (Windows NT 6.1) Presto/2.12.388 Version/12.16',
+     (u'Opera', u'Windows', u'Desktop')),
+    ('Mozilla/5.0 (compatible; Googlebot/2.1; '
+     '+http://www.google.com/bot.html)',
+     (u'Bot', u'Unknown', u'Bot')),
+    ('', (u'Unknown', u'Unknown', u'Unknown')),
+]
+
+
+class TestUserAgentClassification(TestCase):
+
+    def test_samples(self):
+        for user_agent, expected in samples:
+            self.assertEqual(tuple(classify_user_agent(user_agent)), expected,
+                             user_agent)
+
+    def test_classifier_cache(self):
+        calls = []
+
+        def classify(user_agent):
+            calls.append(user_agent)
+            return classify_user_agent(user_agent)
+
+        classifier = UserAgentClassifier(max_size=2, classify=classify)
+        classifier.classify('Chrome/1')
+        classifier.classify('Firefox/1')
+        classifier.classify('Chrome/1')
+        self.assertEqual(calls, ['Chrome/1', 'Firefox/1'])
+
+        classifier.classify('MSIE 9')
+        self.assertEqual(list(classifier.cache), ['Chrome/1', 'MSIE 9'])
+        classifier.classify('Firefox/1')
+        self.assertEqual(calls, ['Chrome/1', 'Firefox/1', 'MSIE 9',
+                                 'Firefox/1'])
+
+    def test_history_info_cached(self):
+        calls = []
+
+        def classify(user_agent):
+            calls.append(user_agent)
+            return UserAgentInfo(u'X', u'Y', u'Z')
+
+        classifier = UserAgentClassifier(classify=classify)
+        history = VisitorHistory()
+        self.assertIsNone(history_user_agent_info(history, classifier))
+
+        history.user_agent = u'Foo/1'
+        history_user_agent_info(history, classifier)
+        # Not even looked up in the classifier cache again.
+        classifier.cache.clear()
+        history_user_agent_info(history, classifier)
+        self.assertEqual(calls, [u'Foo/1'])
+
+
+class TestUserAgentRollups(TestCase):
+
+    def test_buckets(self):
+        history = VisitorHistory()
+        self.assertEqual(BrowserRollup().get_bucket(0, history), u'')
+
+        history.user_agent = samples[2][0]
+        history.user_agents = set([samples[2][0], samples[0][0]])
+        self.assertEqual(BrowserRollup().get_bucket(0, history), u'Safari')
+        self.assertEqual(OSRollup().get_bucket(0, history), u'iOS')
+        self.assertEqual(DeviceRollup().get_bucket(0, history), u'Mobile')
@@ -10,11 +10,24 @@ log = logging.getLogger(__name__)
 
 class Worker(object):
 
-    def __init__(self, log, backend, stats_every=50):
+    def __init__(self, log, backend, stats_every=50, prefetch_size=100,
+                 prefetch_lag=60, batch_size=1000):
         self.log = log
         self.backend = backend
         self.stats_every = stats_every
 
+        # If the log supports it, records are read and handled in batches of
+        # up to ``batch_size``. Set it to None to handle one at a time.
+        self.batch_size = batch_size
+
+        # When the records being read are more than ``prefetch_lag`` seconds
+        # old, read ahead up to ``prefetch_size`` records and load their
+        # visitor histories in one batch before handling them.
+        self.prefetch_size = prefetch_size
+        self.prefetch_lag = prefetch_lag
+        self.window = []
+        self.num_records = 0
+
         self.last_live_ts = None
         self.last_record_ts = None
         self.last_num_records = None
@@ -36,22 +49,83 @@ class Worker(object):
                      '%d secs behind, ETA: %0.1f seconds',
                      num_records, record_rate, clock_rate, secs_behind,
                      clock_eta)
+            log.info('Cache stats: %r', self.backend.cache_stats())
 
         self.last_live_ts = live_ts
         self.last_record_ts = record_ts
         self.last_num_records = num_records
 
+    def is_behind(self, record):
+        return (time.time() - float(record.timestamp)) > self.prefetch_lag
+
+    def run_records(self, **kwargs):
+        """
+        Handle records one at a time, reading ahead and prefetching visitor
+        histories while the log is behind. Read-ahead stops as soon as a
+        recent record is read, or the log has nothing more to read, so that a
+        live log is never held up waiting for a window to fill.
+        """
+        for vals, pointer in self.log.process(**kwargs):
+            record = Record.from_list(vals)
+            self.window.append((record, pointer))
+            if ((len(self.window) >= self.prefetch_size) or
+                    not self.is_behind(record)):
+                self.drain_window()
+        self.drain_window()
+
+    def drain_window(self):
+        """
+        Handle the records in the read-ahead window, prefetching their
+        histories together.
+        """
+        window = self.window
+        self.window = []
+        if len(window) > 1:
+            self.backend.prefetch([record.vid for record, ptr in window])
+        for record, pointer in window:
+            self.backend.handle(record, pointer)
+            if (self.num_records % self.stats_every) == 0:
+                self.dump_stats(self.num_records,
+                                int(float(record.timestamp)))
+            self.num_records += 1
+
+    def idle(self):
+        """
+        Called while the log waits for more records. Records still in the
+        read-ahead window are handled first, so that they aren't held back
+        while the backend flushes a pointer which follows them.
+        """
+        self.drain_window()
+        self.backend.idle()
+
     def run(self, resume=True, **kwargs):
         log.info('Worker started processing.')
 
         if resume:
             kwargs['process_from'] = self.backend.get_pointer()
             log.info('Resuming from %s', kwargs['process_from'])
+        if kwargs.get('stay_alive'):
+            # Following a live log, so give the backend a chance to flush
+            # while waiting for records.
+            kwargs['on_idle'] = self.idle
 
-        for ii, (vals, pointer) in enumerate(self.log.process(**kwargs)):
-            record = Record.from_list(vals)
-            self.backend.handle(record, pointer)
-            if (ii % self.stats_every) == 0:
-                self.dump_stats(ii, int(float(record.timestamp)))
+        if self.batch_size and hasattr(self.log, 'process_batches'):
+            self.run_batches(**kwargs)
+        else:
+            self.run_records(**kwargs)
 
         log.info('Worker finished processing.')
+
+    def run_batches(self, **kwargs):
+        num_records = 0
+        next_stats = 0
+        from_list = Record.from_list
+        for vals, pointer in self.log.process_batches(self.batch_size,
+                                                      **kwargs):
+            records = [from_list(v) for v in vals]
+            self.backend.handle_batch(records, pointer)
+            num_records += len(records)
+            if num_records >= next_stats:
+                self.dump_stats(num_records,
+                                int(float(records[-1].timestamp)))
+                next_stats = num_records + self.stats_every
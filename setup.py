@@ -30,6 +30,7 @@ setup(name="manhattan",
               'manhattan-server=manhattan.server:main',
               'manhattan-client=manhattan.client:main',
               'manhattan-log-server=manhattan.log.remote:server',
+              'manhattan-migrate=manhattan.migrate:main',
           ]
       ),
       test_suite='nose.collector',